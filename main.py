@@ -8,11 +8,22 @@ They can be either a single large input image or the bottom level tiles
 from pr0nmap.map import ImageMapSource, TileMapSource
 from pr0nmap.gmap import GMap
 from pr0nmap.groupxiv import GroupXIV
+from pr0nmap import reduce
+from pr0nmap import encoder
+from pr0nmap.store import LINK_MODES
+from pr0nmap import budget
+from pr0nmap.events import EventLog
+from pr0nmap.profiling import Profiler
+from pr0nmap.tile import WorkerPool, parse_region
 
 import argparse
+import concurrent.futures
 import multiprocessing
 import os
 import re
+import sys
+import time
+import traceback
 
 
 # Keep pr0nmap/main.py and sipr0n/img2doku.py in sync
@@ -29,7 +40,46 @@ def parse_image_name(fn):
     return (fnbase, vendor, chipid, flavor)
 
 
+def run_batch(maps, max_maps):
+    '''
+    Build maps through one shared worker pool, max_maps at a time
+    Biggest first so the small ones fill in around the big ones' narrow top levels
+    Returns the number that failed
+    '''
+    maps = sorted(maps,
+                  key=lambda m: m.source.width() * m.source.height(),
+                  reverse=True)
+    tstart = time.time()
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_maps) as executor:
+        futures = dict((executor.submit(m.run), m) for m in maps)
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                failed += 1
+                print('WARNING: %s failed' % futures[future].out_dir)
+                traceback.print_exc()
+    print('Batch: %u maps, %u failed in %0.1f sec' %
+          (len(maps), failed, time.time() - tstart))
+    return failed
+
+
 if __name__ == "__main__":
+    # Subcommands import their module on use so plain map builds don't pay for them
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        from pr0nmap import bench
+        sys.exit(bench.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'microbench':
+        from pr0nmap import microbench
+        sys.exit(microbench.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'daemon':
+        from pr0nmap import daemon
+        sys.exit(daemon.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from pr0nmap import tileserver
+        sys.exit(tileserver.main(sys.argv[2:]))
+
     parser = argparse.ArgumentParser(
         description='Generate Google Maps code from image file(s)')
     parser.add_argument('images_in', nargs='+', help='image file or dir in')
@@ -47,7 +97,35 @@ if __name__ == "__main__":
     parser.add_argument(
         '--out-extension',
         default=None,
-        help='Select output image extension (and type), .jpg, .png, .tif, etc')
+        help=
+        'Select output image extension (and type), .jpg, .png, .tif, .webp, .avif, etc'
+    )
+    parser.add_argument(
+        '--quality',
+        type=int,
+        default=None,
+        help='Output quality for .jpg / .webp / .avif (default: PIL default)')
+    parser.add_argument(
+        '--level-quality',
+        default=None,
+        help=
+        'Per level quality overrides as level=quality,... (level 0 is the most zoomed out). Ex: 0=50,1=50,2=60'
+    )
+    parser.add_argument('--progressive',
+                        action="store_true",
+                        default=False,
+                        help='Write progressive JPEGs')
+    parser.add_argument('--subsampling',
+                        choices=encoder.SUBSAMPLING,
+                        default=None,
+                        help='JPEG chroma subsampling (default: PIL default)')
+    parser.add_argument(
+        '--optimize',
+        action="store_true",
+        default=False,
+        help=
+        'Spend more time encoding for smaller files (.jpg / .png optimize, .webp method 6)'
+    )
     parser.add_argument('--name',
                         dest="title_name",
                         help='SiMap: <name> title')
@@ -60,18 +138,172 @@ if __name__ == "__main__":
     parser.add_argument('--threads',
                         type=int,
                         default=multiprocessing.cpu_count())
+    parser.add_argument(
+        '--stream',
+        action="store_true",
+        default=False,
+        help=
+        'Decode single input images one strip at a time to bound memory usage')
+    parser.add_argument(
+        '--in-memory',
+        action="store_true",
+        default=False,
+        help=
+        'Keep shrunk levels in shared memory instead of re-decoding tiles from disk'
+    )
+    parser.add_argument(
+        '--block-levels',
+        type=int,
+        default=0,
+        help=
+        'Give each worker 2^N x 2^N base tile blocks and build their sub-pyramids in one go (default: schedule by rows)'
+    )
+    parser.add_argument(
+        '--incremental',
+        action="store_true",
+        default=False,
+        help=
+        'Keep existing output and only rebuild tiles whose source changed since the last run'
+    )
+    parser.add_argument(
+        '--store',
+        choices=['dir', 'sqlite', 'pack'],
+        default='dir',
+        help=
+        'Write tiles as one file each (dir), into a single MBTiles style .mbtiles database (sqlite) or a .pack archive + .pack.idx index for serving (pack)'
+    )
+    parser.add_argument(
+        '--dedupe',
+        action="store_true",
+        default=False,
+        help=
+        'Store identical tiles (ex: blank margins) once: hardlinks for dir, shared rows / data for sqlite and pack'
+    )
+    parser.add_argument(
+        '--reduce',
+        choices=reduce.KERNELS,
+        default='pil',
+        help=
+        'Kernel to shrink 2x2 tiles into their parent. pil: PIL LANCZOS (original), draft: decode JPEG children at half scale (fastest for .jpg output), box: faster and softer, good for previews (requires numpy)'
+    )
+    parser.add_argument(
+        '--link-mode',
+        choices=LINK_MODES,
+        default='copy',
+        help=
+        'How a tile directory input becomes the base level of a dir store. Each mode falls back to the next one if the filesystem can not do it: hardlink (output tiles are the source files, do not edit them in place), reflink (copy on write clone, btrfs / XFS), copy_file_range (copy in the kernel / server side), copy (default)'
+    )
+    parser.add_argument(
+        '--events',
+        default=None,
+        help=
+        'Write JSON lines progress events (stage start / end, tiles, bytes, tiles/s, ETA, worker busy / idle) to this file, - for stdout or fd:N'
+    )
+    parser.add_argument(
+        '--prometheus',
+        default=None,
+        help='Keep a Prometheus textfile collector file of progress up to date'
+    )
+    parser.add_argument(
+        '--max-memory',
+        type=budget.parse_size,
+        default=None,
+        help=
+        'Memory budget for the whole build (ex: 4G). Picks whole image decode, streaming or spooling to an uncompressed temp file and fewer workers to fit, then prints the peak RSS of each process'
+    )
+    parser.add_argument(
+        '--profile',
+        default=None,
+        help=
+        'Profile every worker task and the main process into this directory: .pstats and flamegraph .collapsed files per stage / level plus summary.txt'
+    )
+    parser.add_argument(
+        '--profile-memory',
+        action="store_true",
+        default=False,
+        help=
+        'With --profile, also record peak and top allocations with tracemalloc'
+    )
+    parser.add_argument(
+        '--region',
+        type=parse_region,
+        action='append',
+        default=None,
+        help=
+        'x0,y0,x1,y1 base pixel rectangle that changed since the map was built, may be given more than once. Only the tiles it overlaps and the zoomed out tiles above them are rebuilt, the rest of the existing map is left alone. The source must be the same size as before'
+    )
+    parser.add_argument(
+        '--base-only',
+        action="store_true",
+        default=False,
+        help=
+        'Only write the base level, for main.py serve to render the levels above on demand'
+    )
+    parser.add_argument(
+        '--batch',
+        action="store_true",
+        default=False,
+        help=
+        'Plan every input up front and build them through one shared pool of --threads workers, interleaving their tasks. With --out and several inputs each goes to --out/<input name>'
+    )
+    parser.add_argument(
+        '--batch-maps',
+        type=int,
+        default=2,
+        help=
+        'With --batch, maps in progress at once. Each holds its own decoded source image'
+    )
     parser.add_argument('--target',
                         choices=['gmap', 'groupxiv'],
                         default='groupxiv',
                         help='')
     args = parser.parse_args()
+    events = None
+    if args.events or args.prometheus:
+        events = EventLog(args.events, args.prometheus)
+    profile = None
+    if args.profile:
+        profile = Profiler(args.profile, memory=args.profile_memory)
+    pool = None
+    if args.batch:
+        pool = WorkerPool(args.threads,
+                          reduce=args.reduce,
+                          profile=profile.worker_mode() if profile else None)
+    encode_opts = {
+        'quality': args.quality,
+        'level_quality': encoder.parse_level_quality(args.level_quality),
+        'progressive': args.progressive,
+        'subsampling': args.subsampling,
+        'optimize': args.optimize,
+    }
 
+    maps = []
     for image_in in args.images_in:
         out_dir = args.out
+        if out_dir and args.batch and len(args.images_in) > 1:
+            # One directory per input under --out
+            out_dir = os.path.join(
+                out_dir,
+                os.path.splitext(os.path.basename(
+                    os.path.normpath(image_in)))[0])
 
         if os.path.isdir(image_in):
             print('Working on directory of max zoomed tiles')
-            source = TileMapSource(image_in, threads=args.threads)
+            source = TileMapSource(image_in,
+                                   threads=args.threads,
+                                   in_memory=args.in_memory,
+                                   block_levels=args.block_levels,
+                                   incremental=args.incremental,
+                                   store=args.store,
+                                   dedupe=args.dedupe,
+                                   reduce=args.reduce,
+                                   encode_opts=encode_opts,
+                                   link_mode=args.link_mode,
+                                   events=events,
+                                   profile=profile,
+                                   max_memory=args.max_memory,
+                                   pool=pool,
+                                   regions=args.region)
         else:
             print(('Working on single input image %s' % image_in))
             # Do auto-magic renaming for standard named die on sipr0n
@@ -87,7 +319,21 @@ if __name__ == "__main__":
                     out_dir = os.path.join(
                         os.path.dirname(os.path.dirname(image_in)), flavor)
                     print(('Auto-naming output file for sipr0n: %s' % out_dir))
-            source = ImageMapSource(image_in, threads=args.threads)
+            source = ImageMapSource(image_in,
+                                    threads=args.threads,
+                                    stream=args.stream,
+                                    in_memory=args.in_memory,
+                                    block_levels=args.block_levels,
+                                    incremental=args.incremental,
+                                    store=args.store,
+                                    dedupe=args.dedupe,
+                                    reduce=args.reduce,
+                                    encode_opts=encode_opts,
+                                    events=events,
+                                    profile=profile,
+                                    max_memory=args.max_memory,
+                                    pool=pool,
+                                    regions=args.region)
 
         if not out_dir:
             out_dir = "map"
@@ -105,7 +351,29 @@ if __name__ == "__main__":
         m.set_js_only(args.js_only)
         m.set_skip_missing(args.skip_missing)
         m.set_out_dir(out_dir)
+        # Region runs touch up the existing map, don't start over
+        m.set_incremental(args.incremental or bool(args.region))
+        m.set_base_only(args.base_only)
         if args.out_extension:
             m.set_im_ext(args.out_extension)
+        if pool:
+            # Planned up front, built below
+            maps.append(m)
+        else:
+            m.run()
 
-        m.run()
+    if pool:
+        out_dirs = [m.out_dir for m in maps]
+        if len(set(out_dirs)) != len(out_dirs):
+            parser.error(
+                '--batch needs a different output directory per input')
+        for out_dir in out_dirs:
+            # The map makes its own directory but not the ones above it
+            os.makedirs(os.path.dirname(os.path.abspath(out_dir)),
+                        exist_ok=True)
+        pool.start()
+        try:
+            failed = run_batch(maps, args.batch_maps)
+        finally:
+            pool.stop()
+        sys.exit(1 if failed else 0)
@@ -0,0 +1,362 @@
+'''
+End to end benchmark: pr0nmap bench [options]
+
+Generates a deterministic synthetic die (as a single image and / or a directory of base tiles),
+builds a GroupXIV map from it and reports per stage:
+wall time, CPU time (this process + workers), tiles/s, bytes written and peak RSS
+plus checksums of the output pyramid so a faster implementation can be checked for identical output
+
+Results go to stdout (and --json) as JSON
+--check compares checksums against an earlier --json, exiting non-zero on a mismatch
+
+Peak RSS is the kernel's high water mark for this process / its biggest worker so far,
+so it only ever goes up from stage to stage
+'''
+
+from pr0nmap.map import ImageMapSource, TileMapSource
+from pr0nmap.groupxiv import GroupXIV
+from pr0nmap import pack
+from pr0nmap import reduce
+from pr0nmap import tile
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import time
+from PIL import Image
+from PIL import ImageDraw
+from PIL import TiffImagePlugin
+
+# Fraction of the canvas that is blank margin around the die, like a real scan
+MARGIN = 0.05
+# .tif inputs are uncompressed with this many rows per strip like scanner output
+# so --stream and the shared memory decode have to stitch regions across strips
+TIF_STRIP_ROWS = 64
+
+
+def die_tile(seed, row, col, width, height, tw=250, th=250):
+    '''
+    Tile row, col of a width x height synthetic die, the same every time for the same arguments
+    Blank margin, a few background colors, standard cell like rectangles and metal lines
+    '''
+    im = Image.new('RGB', (tw, th))
+    x0 = col * tw
+    y0 = row * th
+    mx = int(width * MARGIN)
+    my = int(height * MARGIN)
+    die_box = (mx, my, width - mx, height - my)
+    # Entirely in the margin => solid black, exercises solid tiles / dedupe
+    if x0 + tw <= die_box[0] or y0 + th <= die_box[1] or x0 >= die_box[
+            2] or y0 >= die_box[3]:
+        return im
+    rand = random.Random('%s %u %u' % (seed, row, col))
+    draw = ImageDraw.Draw(im)
+    # Die area only, margins stay black
+    draw.rectangle(
+        (die_box[0] - x0, die_box[1] - y0, die_box[2] - x0 - 1,
+         die_box[3] - y0 - 1),
+        fill=(90 + (row // 8) % 3 * 20, 80, 60 + (col // 8) % 3 * 20))
+    for _i in range(rand.randint(10, 40)):
+        x = rand.randrange(tw)
+        y = rand.randrange(th)
+        w = rand.randint(2, 40)
+        h = rand.randint(2, 40)
+        draw.rectangle((x, y, x + w, y + h),
+                       fill=(rand.randint(100, 255), rand.randint(100, 200),
+                             rand.randint(0, 120)))
+    for _i in range(rand.randint(2, 10)):
+        if rand.random() < 0.5:
+            y = rand.randrange(th)
+            draw.line((0, y, tw, y), fill=(200, 200, 210), width=3)
+        else:
+            x = rand.randrange(tw)
+            draw.line((x, 0, x, th), fill=(200, 200, 210), width=3)
+    # Anything past the die edge in this tile goes back to margin
+    if die_box[2] - x0 < tw:
+        draw.rectangle((die_box[2] - x0, 0, tw, th), fill=(0, 0, 0))
+    if die_box[3] - y0 < th:
+        draw.rectangle((0, die_box[3] - y0, tw, th), fill=(0, 0, 0))
+    return im
+
+
+def make_image(fn, width, height, seed, tw=250, th=250):
+    '''Synthetic die as a single width x height image (held in memory while generating)'''
+    im = Image.new('RGB', (width, height))
+    for row in range((height + th - 1) // th):
+        for col in range((width + tw - 1) // tw):
+            im.paste(die_tile(seed, row, col, width, height, tw, th),
+                     (col * tw, row * th))
+    if fn.endswith('.tif'):
+        im.save(fn,
+                compression='raw',
+                tiffinfo={TiffImagePlugin.ROWSPERSTRIP: TIF_STRIP_ROWS})
+    else:
+        im.save(fn)
+
+
+def make_tiles(dst_dir, width, height, seed, tw=250, th=250):
+    '''Synthetic die as a directory of y000_x000.jpg base tiles, one tile in memory at a time'''
+    os.makedirs(dst_dir, exist_ok=True)
+    for row in range((height + th - 1) // th):
+        for col in range((width + tw - 1) // tw):
+            die_tile(seed, row, col, width, height, tw, th).save(
+                tile.get_tile_name_pr0nts(dst_dir, row, col, '.jpg'))
+
+
+def pyramid_checksums(out_dir, store):
+    '''
+    {'levels': {level: sha256}, 'total': sha256, 'tiles': count} of every tile in the map
+    Tiles are keyed by level / row / col so every store gives the same checksums
+    '''
+    # level => [(tile id, sha256 of its bytes)]
+    tiles = {}
+    basedir = os.path.join(out_dir, 'l1-tiles')
+    if store == 'dir':
+        for root, _dirs, fns in os.walk(basedir):
+            for fn in fns:
+                if fn.endswith('.json'):
+                    continue
+                path = os.path.join(root, fn)
+                # GroupXIV.get_tile_name(): level + 1 / col / row.ext
+                level, col, row = os.path.relpath(path, basedir).split(os.sep)
+                level = int(level) - 1
+                row = int(os.path.splitext(row)[0])
+                with open(path, 'rb') as f:
+                    tiles.setdefault(str(level), []).append(
+                        ('%u/%u/%s' % (level, row, col),
+                         hashlib.sha256(f.read()).hexdigest()))
+    elif store == 'sqlite':
+        conn = sqlite3.connect(basedir + '.mbtiles')
+        for level, col, row, data in conn.execute(
+                'SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles'
+        ):
+            tiles.setdefault(str(level),
+                             []).append(('%u/%u/%u' % (level, row, col),
+                                         hashlib.sha256(data).hexdigest()))
+        conn.close()
+    elif store == 'pack':
+        reader = pack.PackReader(basedir + '.pack')
+        for level, row, col in reader.keys():
+            tiles.setdefault(str(level), []).append(
+                ('%u/%u/%u' % (level, row, col),
+                 hashlib.sha256(reader.get(level, row, col)).hexdigest()))
+        reader.close()
+    else:
+        raise ValueError('Unknown tile store %s' % store)
+
+    ret = {'levels': {}}
+    total = hashlib.sha256()
+    for level in sorted(tiles.keys(), key=int):
+        h = hashlib.sha256()
+        for rel, digest in sorted(tiles[level]):
+            h.update(('%s %s\n' % (rel, digest)).encode())
+        ret['levels'][level] = h.hexdigest()
+        total.update(h.hexdigest().encode())
+    ret['total'] = total.hexdigest()
+    ret['tiles'] = sum(len(level_tiles) for level_tiles in tiles.values())
+    return ret
+
+
+def output_size(out_dir):
+    '''(files, bytes) of everything written under out_dir'''
+    files = 0
+    size = 0
+    for root, _dirs, fns in os.walk(out_dir):
+        for fn in fns:
+            files += 1
+            size += os.path.getsize(os.path.join(root, fn))
+    return files, size
+
+
+class Stage(object):
+    '''Times a block of work, CPU includes workers that exited during it'''
+
+    def __init__(self, results, name):
+        self.results = results
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.rself = resource.getrusage(resource.RUSAGE_SELF)
+        self.rchildren = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.ret = {}
+        return self.ret
+
+    def __exit__(self, exc_type, exc_value, tb):
+        rself = resource.getrusage(resource.RUSAGE_SELF)
+        rchildren = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        def cpu(before, after):
+            return (after.ru_utime - before.ru_utime) + (after.ru_stime -
+                                                         before.ru_stime)
+
+        self.ret['wall'] = time.time() - self.wall
+        self.ret['cpu'] = cpu(self.rself, rself) + cpu(self.rchildren,
+                                                       rchildren)
+        # Linux reports KiB
+        self.ret['peak_rss'] = rself.ru_maxrss * 1024
+        self.ret['peak_rss_workers'] = rchildren.ru_maxrss * 1024
+        self.results[self.name] = self.ret
+
+
+def run_map(source, out_dir):
+    m = GroupXIV(source)
+    m.set_title('bench')
+    m.set_out_dir(out_dir)
+    m.run()
+
+
+def run_case(args, kind, workdir, quiet):
+    '''Generate kind's input, map it and return its results'''
+    ret = {'stages': {}}
+    stages = ret['stages']
+    # GroupXIV clears out any old map
+    out_dir = os.path.join(workdir, 'map_' + kind)
+    opts = {
+        'threads': args.threads,
+        'in_memory': args.in_memory,
+        'block_levels': args.block_levels,
+        'store': args.store,
+        'reduce': args.reduce,
+    }
+    with quiet():
+        if kind == 'image':
+            src = os.path.join(
+                workdir, 'die_%ux%u_%s%s%s' %
+                (args.width, args.height, args.seed, '_s%u' %
+                 TIF_STRIP_ROWS if args.input_ext == '.tif' else '',
+                 args.input_ext))
+            with Stage(stages, 'generate') as stage:
+                if not os.path.exists(src):
+                    make_image(src, args.width, args.height, args.seed)
+                stage['bytes'] = os.path.getsize(src)
+            with Stage(stages, 'load'):
+                source = ImageMapSource(src, stream=args.stream, **opts)
+        else:
+            src = os.path.join(
+                workdir,
+                'die_%ux%u_%s_tiles' % (args.width, args.height, args.seed))
+            with Stage(stages, 'generate') as stage:
+                if not os.path.exists(src):
+                    make_tiles(src + '.tmp', args.width, args.height,
+                               args.seed)
+                    os.rename(src + '.tmp', src)
+                _files, stage['bytes'] = output_size(src)
+            with Stage(stages, 'load'):
+                source = TileMapSource(src, **opts)
+        with Stage(stages, 'tile') as stage:
+            run_map(source, out_dir)
+        _files, stage['bytes'] = output_size(out_dir)
+        with Stage(stages, 'checksum'):
+            ret['checksums'] = pyramid_checksums(out_dir, args.store)
+        stage['tiles'] = ret['checksums']['tiles']
+        stage['tiles_per_sec'] = stage['tiles'] / stage['wall']
+    if not args.keep:
+        shutil.rmtree(out_dir)
+    return ret
+
+
+def check(results, golden):
+    '''Print checksum differences against golden results, True if they match'''
+    ok = True
+    for kind, case in results['cases'].items():
+        want = golden.get('cases', {}).get(kind, {}).get('checksums')
+        if want is None:
+            print('%s: no golden checksums' % kind, file=sys.stderr)
+            continue
+        got = case['checksums']
+        if got['total'] == want['total']:
+            continue
+        ok = False
+        for level in sorted(set(got['levels']) | set(want['levels']), key=int):
+            if got['levels'].get(level) != want['levels'].get(level):
+                print('%s: level %s differs' % (kind, level), file=sys.stderr)
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='pr0nmap bench',
+        description='Time map generation on a synthetic die')
+    parser.add_argument('--width', type=int, default=8000)
+    parser.add_argument('--height', type=int, default=6000)
+    parser.add_argument('--seed', default='pr0nmap')
+    parser.add_argument('--kind',
+                        choices=['image', 'tiles', 'both'],
+                        default='both',
+                        help='Single input image, directory of base tiles')
+    parser.add_argument('--input-ext',
+                        choices=['.jpg', '.png', '.tif'],
+                        default='.jpg',
+                        help='Single input image format (.tif for --stream, written in %u row strips)' % TIF_STRIP_ROWS)
+    parser.add_argument(
+        '--workdir',
+        default='bench',
+        help='Inputs are cached here across runs, maps are written here')
+    parser.add_argument('--keep',
+                        action="store_true",
+                        default=False,
+                        help='Keep the generated maps')
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    parser.add_argument('--stream', action="store_true", default=False)
+    parser.add_argument('--in-memory', action="store_true", default=False)
+    parser.add_argument('--block-levels', type=int, default=0)
+    parser.add_argument('--store',
+                        choices=['dir', 'sqlite', 'pack'],
+                        default='dir')
+    parser.add_argument('--reduce', choices=reduce.KERNELS, default='pil')
+    parser.add_argument('--json', default=None, help='Also write results here')
+    parser.add_argument(
+        '--check',
+        default=None,
+        help='Earlier --json results to compare output checksums against')
+    parser.add_argument('--verbose',
+                        action="store_true",
+                        default=False,
+                        help='Show map generation output')
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.workdir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def quiet():
+        if args.verbose:
+            yield
+            return
+        with open(os.devnull, 'w') as f:
+            with contextlib.redirect_stdout(f):
+                yield
+
+    results = {
+        'config': dict(vars(args)),
+        'cases': {},
+    }
+    for opt in ('json', 'check', 'verbose', 'keep', 'workdir'):
+        del results['config'][opt]
+    kinds = ['image', 'tiles'] if args.kind == 'both' else [args.kind]
+    for kind in kinds:
+        results['cases'][kind] = run_case(args, kind, args.workdir, quiet)
+
+    out = json.dumps(results, indent=4, sort_keys=True)
+    print(out)
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(out + '\n')
+    if args.check:
+        with open(args.check) as f:
+            if not check(results, json.load(f)):
+                print('Output checksums differ from %s' % args.check,
+                      file=sys.stderr)
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
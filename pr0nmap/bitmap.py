@@ -0,0 +1,42 @@
+'''
+Compact record of which tiles exist at a level
+Lets workers skip stat()ing every candidate source tile, which is slow on network filesystems
+'''
+
+
+class TileBitmap(object):
+
+    def __init__(self, rows, cols, row0=0, bits=None):
+        self.rows = rows
+        self.cols = cols
+        # First row covered, so a task can be shipped just the rows it needs
+        self.row0 = row0
+        self.bits = bits if bits is not None else bytearray(
+            (rows * cols + 7) // 8)
+
+    def index(self, row, col):
+        row -= self.row0
+        if row < 0 or row >= self.rows or col < 0 or col >= self.cols:
+            return None
+        return row * self.cols + col
+
+    def set(self, row, col):
+        i = self.index(row, col)
+        self.bits[i >> 3] |= 1 << (i & 7)
+
+    def has(self, row, col):
+        i = self.index(row, col)
+        if i is None:
+            return False
+        return bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+    def slice(self, row0, row1):
+        '''Rows row0 to row1 (exclusive) as their own bitmap'''
+        row0 = max(row0, self.row0)
+        row1 = min(row1, self.row0 + self.rows)
+        ret = TileBitmap(max(0, row1 - row0), self.cols, row0)
+        for row in range(row0, row1):
+            for col in range(self.cols):
+                if self.has(row, col):
+                    ret.set(row, col)
+        return ret
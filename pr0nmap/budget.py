@@ -0,0 +1,184 @@
+'''
+Fit a map build into a memory budget (--max-memory)
+
+Peak memory is estimated from the source size, mode and worker count:
+main process: the interpreter plus the source pixels, depending on how they are decoded
+    whole: decode in full then copy into shared memory for the workers (twice the image while copying)
+    stream: workers decode their own strips from an uncompressed file, nothing up front
+    spool: decode in full once, write it out as an uncompressed temp file and drop it,
+        workers then stream strips from that file (out of core for compressed sources)
+in memory levels (--in-memory): the two shared memory canvases alive at once
+each worker: the interpreter plus the largest task it runs (a strip, a 2x2 quad batch or a block)
+The fastest strategy that fits wins, then workers are dropped until the total fits
+Shared memory counts against container limits like any other memory
+
+Estimates are rough, Tiler records the peak RSS of every process to check them against
+'''
+
+from pr0nmap import reduce as tile_reduce
+
+import re
+import resource
+from PIL import Image
+
+STRATEGIES = ('whole', 'stream', 'spool')
+# Interpreter, PIL and NumPy in the main process
+PROCESS_BYTES = 50 * 2**20
+# Forked worker: pages it stops sharing with the main process plus encode buffers and such
+WORKER_BYTES = 30 * 2**20
+
+
+def parse_size(s):
+    '''"512M" => 536870912, plain numbers are bytes'''
+    m = re.match(r'^\s*([0-9.]+)\s*([kmgt]?)i?b?\s*$', s.lower())
+    if not m:
+        raise ValueError('Bad size %s, expected ex: 512M or 4G' % s)
+    return int(float(m.group(1)) * 1024**' kmgt'.index(m.group(2) or ' '))
+
+
+def format_size(n):
+    return '%0.1f MB' % (n / 1e6)
+
+
+def pil_bpp(mode):
+    '''Bytes per pixel PIL uses in memory (3 band images are padded to 4)'''
+    if mode in ('1', 'L', 'P'):
+        return 1
+    if mode.startswith('I;16'):
+        return 2
+    return 4
+
+
+def raw_bpp(mode):
+    '''Bytes per pixel in shared memory / uncompressed files'''
+    return len(Image.new(mode, (1, 1)).tobytes())
+
+
+def peak_rss():
+    '''Peak resident set size of this process in bytes'''
+    # Linux reports KiB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Plan(object):
+
+    def __init__(self, strategy, threads, in_memory, peak):
+        # One of STRATEGIES, None for tile directory sources
+        self.strategy = strategy
+        self.threads = threads
+        self.in_memory = in_memory
+        # Estimated peak bytes over every process
+        self.peak = peak
+
+    def __str__(self):
+        return '%s%u workers%s, estimated peak %s' % (
+            '' if self.strategy is None else self.strategy + ' decode, ',
+            self.threads, ', in memory levels' if self.in_memory else '',
+            format_size(self.peak))
+
+
+class Estimator(object):
+    '''
+    width, height, mode: base level pixels
+    streamable: source is an uncompressed file workers can read strips from directly
+    decode: the source has to be decoded (False for tile directories)
+    '''
+
+    def __init__(self,
+                 width,
+                 height,
+                 mode,
+                 tw=250,
+                 th=250,
+                 decode=True,
+                 streamable=False,
+                 block_k=0,
+                 reduce='pil'):
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.tw = tw
+        self.th = th
+        self.decode = decode
+        self.streamable = streamable
+        self.block_k = block_k
+        self.reduce = reduce
+
+    def image_bytes(self):
+        return self.width * self.height * pil_bpp(self.mode)
+
+    def shared_bytes(self):
+        return self.width * self.height * raw_bpp(self.mode)
+
+    def tile_bytes(self):
+        return self.tw * self.th * pil_bpp(self.mode)
+
+    def task_bytes(self):
+        '''Largest working set of a single worker task'''
+        # 2x2 => 1 shrinks: the children, the 2x canvas and the parent
+        ret = 8 * self.tile_bytes()
+        if self.decode:
+            # Row task: one strip of the source plus the tiles cut from it
+            ret = max(ret, self.width * self.th * pil_bpp(self.mode) * 2)
+        if self.reduce not in ('pil', 'draft'):
+            # CHUNK uint8 quads loaded and stacked, the stack as uint16
+            # and the uint16 sums of a quarter its size, see reduce.py
+            quads = tile_reduce.CHUNK * 4 * self.tw * self.th * len(
+                Image.new(self.mode, (1, 1)).getbands())
+            ret = max(ret, quads * 5)
+        if self.block_k:
+            # Base region, its tiles and the sub-pyramid above them
+            n = 2**self.block_k
+            ret = max(ret, int(n * n * self.tile_bytes() * 2.5))
+        return ret
+
+    def canvas_bytes(self):
+        '''--in-memory: the level being shrunk and the one being shrunk into'''
+        return int(self.shared_bytes() * (1 / 4 + 1 / 16))
+
+    def peak(self, strategy, threads, in_memory):
+        workers = threads * WORKER_BYTES
+        # Workers sit idle while the main process decodes
+        decode = 0
+        # Source pixels held while tiling
+        source = 0
+        if strategy == 'whole':
+            decode = self.image_bytes() + self.shared_bytes()
+            source = self.shared_bytes()
+        elif strategy == 'spool':
+            decode = self.image_bytes()
+        tiling = source + threads * self.task_bytes()
+        if in_memory:
+            tiling += self.canvas_bytes()
+        return PROCESS_BYTES + workers + max(decode, tiling)
+
+    def strategies(self, stream=False):
+        '''Decode strategies to try, fastest first'''
+        if not self.decode:
+            return [None]
+        if self.streamable:
+            # Asked to stream: don't decode in full even if it would fit
+            return ['stream'] if stream else ['whole', 'stream']
+        return ['whole', 'spool']
+
+    def plan(self, max_memory, threads, stream=False, in_memory=False):
+        '''Returns the Plan that fits max_memory with the most workers'''
+        best = None
+        for strategy in self.strategies(stream):
+            # Shared memory levels are an optimization, give them up before workers
+            for use_in_memory in ([True, False] if in_memory else [False]):
+                for n in range(threads, 0, -1):
+                    peak = self.peak(strategy, n, use_in_memory)
+                    if peak <= max_memory:
+                        plan = Plan(strategy, n, use_in_memory, peak)
+                        # Fewer than half the workers: try a slower decode that leaves room for more
+                        if n * 2 >= threads:
+                            return plan
+                        if best is None or n > best.threads:
+                            best = plan
+                        break
+        if best:
+            return best
+        # Nothing fits, go with the smallest footprint and hope the estimate is pessimistic
+        strategy = self.strategies(stream)[-1]
+        return Plan(strategy, 1, False, self.peak(strategy, 1, False))
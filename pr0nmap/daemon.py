@@ -0,0 +1,491 @@
+'''
+Tiling daemon: pr0nmap daemon [options]
+
+Keeps a warm worker pool and builds maps on request instead of paying for
+interpreter startup, imports and worker spawn on every upload
+Jobs are JSON over HTTP, either on a Unix socket (default pr0nmap.sock) or on 127.0.0.1:
+
+POST /jobs {"source": "in.jpg", "out": "map_dir", ...} => job
+    out is replaced wholesale, see check_out()
+    optional: target (groupxiv / gmap), priority (higher starts first and gets workers first),
+    title, copyright, out_extension, quality, level_quality, progressive, subsampling, optimize,
+    store, dedupe, incremental, stream, in_memory, block_levels, link_mode, js_only, skip_missing,
+    base_only, regions (list of "x0,y0,x1,y1" or [x0, y0, x1, y1] like --region)
+GET /jobs => [job], GET /jobs/<id> => job
+    state is queued, running, done, failed or cancelled, progress is the latest progress event
+DELETE /jobs/<id> => job, cancels it whether it is queued or running
+GET /status => pool and queue summary
+
+Ex: curl --unix-socket pr0nmap.sock http://localhost/jobs -d '{"source": "die.jpg", "out": "map"}'
+'''
+
+from pr0nmap.map import ImageMapSource, TileMapSource
+from pr0nmap.gmap import GMap
+from pr0nmap.groupxiv import GroupXIV
+from pr0nmap import encoder
+from pr0nmap import reduce
+from pr0nmap import tile
+from pr0nmap.events import EventLog
+
+import argparse
+import http.server
+import json
+import multiprocessing
+import os
+import queue
+import re
+import signal
+import socketserver
+import sys
+import threading
+import time
+import traceback
+
+# Job spec key => default
+SPEC = {
+    'source': None,
+    'out': None,
+    'target': 'groupxiv',
+    'priority': 0,
+    'title': None,
+    'copyright': None,
+    'out_extension': None,
+    'quality': None,
+    'level_quality': None,
+    'progressive': False,
+    'subsampling': None,
+    'optimize': False,
+    'store': 'dir',
+    'dedupe': False,
+    'incremental': False,
+    'stream': False,
+    'in_memory': False,
+    'block_levels': 0,
+    'link_mode': 'copy',
+    'js_only': False,
+    'skip_missing': False,
+    'base_only': False,
+    'regions': None,
+}
+# Finished jobs to remember for GET /jobs
+KEEP_JOBS = 1000
+
+
+def check_out(out, source):
+    '''Raises ValueError unless out is somewhere a job may replace with its map'''
+    if not isinstance(out, str) or any(ord(c) < 0x20 or c == '\x7f'
+                                       for c in out):
+        raise ValueError('Bad out %r' % (out, ))
+    path = os.path.realpath(out)
+    # The map replaces out wholesale: not a file, not a directory we or the source live in
+    for keep in (os.getcwd(), os.path.realpath(source)):
+        if keep == path or keep.startswith(path.rstrip(os.sep) + os.sep):
+            raise ValueError('out %s would remove %s' % (out, keep))
+    if os.path.exists(path) and not os.path.isdir(path):
+        raise ValueError('out %s is not a directory' % out)
+
+
+def check_spec(spec):
+    '''Returns spec with defaults filled in, raises ValueError if it can't be built'''
+    if not isinstance(spec, dict):
+        raise ValueError('Job must be a JSON object')
+    for key in spec:
+        if key not in SPEC:
+            raise ValueError('Unknown job option %s' % key)
+    ret = dict(SPEC)
+    ret.update(spec)
+    for key in ('source', 'out'):
+        if not ret[key]:
+            raise ValueError('Job needs %s' % key)
+    if not isinstance(ret['source'], str) or not os.path.exists(
+            ret['source']):
+        raise ValueError('No such source %s' % ret['source'])
+    check_out(ret['out'], ret['source'])
+    if ret['target'] not in ('groupxiv', 'gmap'):
+        raise ValueError('Unknown target %s' % ret['target'])
+    # "0=60,1=70" like --level-quality or {"0": 60, "1": 70}
+    if isinstance(ret['level_quality'], dict):
+        ret['level_quality'] = dict(
+            (int(level), int(quality))
+            for level, quality in ret['level_quality'].items())
+    else:
+        ret['level_quality'] = encoder.parse_level_quality(
+            ret['level_quality'])
+    if ret['regions']:
+        ret['regions'] = [
+            tile.parse_region(region if isinstance(region, str) else ','.join(
+                str(x) for x in region)) for region in ret['regions']
+        ]
+    return ret
+
+
+def make_map(spec, pool, events=None):
+    '''GroupXIV / GMap for a checked job spec, building through pool'''
+    opts = {
+        'threads': pool.threads,
+        'in_memory': spec['in_memory'],
+        'block_levels': spec['block_levels'],
+        'incremental': spec['incremental'],
+        'store': spec['store'],
+        'dedupe': spec['dedupe'],
+        'reduce': pool.reduce,
+        'encode_opts': {
+            'quality': spec['quality'],
+            'level_quality': spec['level_quality'],
+            'progressive': spec['progressive'],
+            'subsampling': spec['subsampling'],
+            'optimize': spec['optimize'],
+        },
+        'events': events,
+        'pool': pool,
+        'regions': spec['regions'],
+    }
+    if os.path.isdir(spec['source']):
+        source = TileMapSource(spec['source'],
+                               link_mode=spec['link_mode'],
+                               **opts)
+    else:
+        source = ImageMapSource(spec['source'], stream=spec['stream'], **opts)
+    if spec['target'] == 'gmap':
+        m = GMap(source, copyright_=spec['copyright'])
+    else:
+        m = GroupXIV(source, copyright_=spec['copyright'])
+    m.set_title(spec['title'])
+    m.set_js_only(spec['js_only'])
+    m.set_skip_missing(spec['skip_missing'])
+    m.set_out_dir(spec['out'])
+    # Region jobs touch up the existing map, don't start over
+    m.set_incremental(spec['incremental'] or bool(spec['regions']))
+    m.set_base_only(spec['base_only'])
+    if spec['out_extension']:
+        m.set_im_ext(spec['out_extension'])
+    return m
+
+
+class JobPool(object):
+    '''
+    The daemon's WorkerPool as one job's tilers see it
+    Gives their pool jobs the job's priority and cancels all of them at once
+    '''
+
+    def __init__(self, pool, priority):
+        self.pool = pool
+        self.priority = priority
+        # Pool jobs of our tilers
+        self.jobs = set()
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    def open_job(self, priority=0):
+        job = self.pool.open_job(self.priority)
+        with self.lock:
+            self.jobs.add(job)
+            if self.cancelled:
+                self.pool.cancel(job)
+        return job
+
+    def close_job(self, job):
+        with self.lock:
+            self.jobs.discard(job)
+        self.pool.close_job(job)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            for job in self.jobs:
+                self.pool.cancel(job)
+
+
+class Job(object):
+    '''A map to build, also the events log its tiler reports progress to'''
+
+    def __init__(self, id_, spec, events=None):
+        self.id = id_
+        self.spec = spec
+        self.priority = spec['priority']
+        # queued, running, done, failed or cancelled
+        self.state = 'queued'
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        # Latest progress event
+        self.progress = None
+        # Daemon wide events.EventLog to pass events on to
+        self.events = events
+        # Seconds between progress events, see events.EventLog
+        self.interval = 0.5
+        # JobPool while running
+        self.pool = None
+
+    def emit(self, event, **fields):
+        if event == 'progress':
+            self.progress = dict(fields, ts=time.time())
+        if self.events:
+            self.events.emit(event, job=self.id, **fields)
+
+    def describe(self):
+        return {
+            'id': self.id,
+            'state': self.state,
+            'priority': self.priority,
+            'source': self.spec['source'],
+            'out': self.spec['out'],
+            'error': self.error,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            'progress': self.progress,
+        }
+
+
+class Daemon(object):
+
+    def __init__(self, pool, max_jobs=2, events=None):
+        self.pool = pool
+        # Jobs building at once, each holds its own decoded source
+        self.max_jobs = max_jobs
+        self.events = events
+        # id => Job
+        self.jobs = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        # (-priority, id, Job) of jobs waiting to start
+        self.waiting = queue.PriorityQueue()
+        self.runners = []
+
+    def start(self):
+        self.pool.start()
+        for _i in range(self.max_jobs):
+            runner = threading.Thread(target=self.runner, daemon=True)
+            runner.start()
+            self.runners.append(runner)
+
+    def stop(self):
+        for job in list(self.jobs.values()):
+            self.cancel(job.id)
+        self.pool.stop()
+
+    def submit(self, spec):
+        spec = check_spec(spec)
+        with self.lock:
+            job = Job(self.next_id, spec, events=self.events)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            self.prune()
+        self.waiting.put((-job.priority, job.id, job))
+        print('Job %u: queued %s => %s' %
+              (job.id, spec['source'], spec['out']))
+        return job
+
+    def prune(self):
+        '''Forget the oldest finished jobs past KEEP_JOBS (lock held)'''
+        finished = [
+            job.id for job in self.jobs.values()
+            if job.state in ('done', 'failed', 'cancelled')
+        ]
+        for id_ in sorted(finished)[:max(0, len(self.jobs) - KEEP_JOBS)]:
+            del self.jobs[id_]
+
+    def cancel(self, id_):
+        with self.lock:
+            job = self.jobs[id_]
+            if job.state == 'queued':
+                # The runner skips it
+                job.state = 'cancelled'
+                job.finished = time.time()
+            elif job.state == 'running':
+                job.pool.cancel()
+        return job
+
+    def runner(self):
+        while True:
+            _priority, _id, job = self.waiting.get()
+            with self.lock:
+                if job.state != 'queued':
+                    continue
+                job.state = 'running'
+                job.started = time.time()
+                job.pool = JobPool(self.pool, job.priority)
+            print('Job %u: started after %0.3f sec' %
+                  (job.id, job.started - job.submitted))
+            try:
+                make_map(job.spec, job.pool, events=job).run()
+                state = 'done'
+            except tile.Cancelled:
+                state = 'cancelled'
+            except Exception as e:
+                traceback.print_exc()
+                job.error = str(e)
+                state = 'failed'
+            with self.lock:
+                job.state = state
+                job.finished = time.time()
+                job.pool = None
+            print('Job %u: %s in %0.3f sec' %
+                  (job.id, state, job.finished - job.started))
+
+    def status(self):
+        with self.lock:
+            states = {}
+            for job in self.jobs.values():
+                states[job.state] = states.get(job.state, 0) + 1
+        return {
+            'threads': self.pool.threads,
+            'reduce': self.pool.reduce,
+            'max_jobs': self.max_jobs,
+            'jobs': states,
+        }
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    def address_string(self):
+        # Unix sockets don't have a client address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def reply(self, code, obj):
+        data = (json.dumps(obj, sort_keys=True) + '\n').encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def job_id(self):
+        '''/jobs/<id> => id, None for other paths'''
+        m = re.match(r'^/jobs/([0-9]+)$', self.path)
+        return int(m.group(1)) if m else None
+
+    def do_GET(self):
+        daemon = self.server.daemon
+        id_ = self.job_id()
+        if self.path == '/status':
+            self.reply(200, daemon.status())
+        elif self.path == '/jobs':
+            with daemon.lock:
+                jobs = [
+                    daemon.jobs[id_].describe()
+                    for id_ in sorted(daemon.jobs.keys())
+                ]
+            self.reply(200, jobs)
+        elif id_ in daemon.jobs:
+            self.reply(200, daemon.jobs[id_].describe())
+        else:
+            self.reply(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            self.reply(404, {'error': 'Not found'})
+            return
+        try:
+            spec = json.loads(
+                self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            job = self.server.daemon.submit(spec)
+        except ValueError as e:
+            self.reply(400, {'error': str(e)})
+            return
+        self.reply(201, job.describe())
+
+    def do_DELETE(self):
+        id_ = self.job_id()
+        try:
+            job = self.server.daemon.cancel(id_)
+        except KeyError:
+            self.reply(404, {'error': 'Not found'})
+            return
+        self.reply(200, job.describe())
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class LocalHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def make_server(daemon, socket_fn=None, http_addr=None, verbose=False):
+    if http_addr:
+        host, _sep, port = http_addr.rpartition(':')
+        server = LocalHTTPServer((host or '127.0.0.1', int(port)), Handler)
+    else:
+        # Left over from a daemon that didn't exit cleanly
+        if os.path.exists(socket_fn):
+            os.unlink(socket_fn)
+        server = UnixHTTPServer(socket_fn, Handler)
+    server.daemon = daemon
+    server.verbose = verbose
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='pr0nmap daemon',
+        description='Build maps on request from a warm worker pool')
+    parser.add_argument('--socket',
+                        default='pr0nmap.sock',
+                        help='Unix socket to listen on (default)')
+    parser.add_argument(
+        '--http',
+        default=None,
+        help=
+        'Listen on [host:]port instead of a Unix socket (host defaults to 127.0.0.1)'
+    )
+    parser.add_argument('--threads',
+                        type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--max-jobs',
+                        type=int,
+                        default=2,
+                        help='Maps building at once')
+    parser.add_argument('--reduce',
+                        choices=reduce.KERNELS,
+                        default='pil',
+                        help='Kernel to shrink 2x2 tiles into their parent')
+    parser.add_argument(
+        '--events',
+        default=None,
+        help='Also write every job\'s progress events here as JSON lines')
+    parser.add_argument('--verbose',
+                        action="store_true",
+                        default=False,
+                        help='Log requests')
+    args = parser.parse_args(argv)
+
+    events = EventLog(args.events) if args.events else None
+    daemon = Daemon(tile.WorkerPool(args.threads, reduce=args.reduce),
+                    max_jobs=args.max_jobs,
+                    events=events)
+    daemon.start()
+    server = make_server(daemon,
+                         socket_fn=args.socket,
+                         http_addr=args.http,
+                         verbose=args.verbose)
+    # Service managers stop us with SIGTERM
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: sys.exit(0))
+    print('Listening on %s, %u workers' %
+          (args.http or args.socket, args.threads))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.stop()
+        # Someone may have cleaned it up already
+        if not args.http and os.path.exists(args.socket):
+            os.unlink(args.socket)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
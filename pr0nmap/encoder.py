@@ -0,0 +1,117 @@
+'''
+How output tiles are encoded
+One Encoder is shared by every store so the same settings apply whether a tile
+ends up as a file, a sqlite row or part of a pack
+
+Options only go to the formats that understand them:
+quality: JPEG, WebP, AVIF (None for PIL's default, 75 for JPEG)
+progressive, subsampling: JPEG
+optimize: JPEG, PNG (extra passes for smaller files), WebP (slowest / best method)
+'''
+
+import io
+import os
+from PIL import Image
+
+# Chroma subsampling choices, as PIL spells them
+SUBSAMPLING = ('4:4:4', '4:2:2', '4:2:0')
+
+
+def im_format(im_ext):
+    '''.jpg => JPEG'''
+    try:
+        return Image.registered_extensions()[im_ext.lower()]
+    except KeyError:
+        raise ValueError('Unsupported output extension %s' % im_ext)
+
+
+def parse_level_quality(s):
+    '''"0=60,1=70" => {0: 60, 1: 70}'''
+    ret = {}
+    if not s:
+        return ret
+    for part in s.split(','):
+        level, quality = part.split('=')
+        ret[int(level)] = int(quality)
+    return ret
+
+
+class Encoder(object):
+
+    def __init__(self,
+                 im_ext,
+                 quality=None,
+                 level_quality=None,
+                 progressive=False,
+                 subsampling=None,
+                 optimize=False):
+        self.im_ext = im_ext
+        self.format = im_format(im_ext)
+        if self.format not in Image.SAVE:
+            raise ValueError('PIL can not write %s (%s)' %
+                             (self.format, im_ext))
+        if subsampling is not None and subsampling not in SUBSAMPLING:
+            raise ValueError('Unknown subsampling %s' % subsampling)
+        self.quality = quality
+        # level => quality, overrides quality
+        # Ex: lower quality for the zoomed out levels that are just for navigating
+        self.level_quality = level_quality or {}
+        self.progressive = progressive
+        self.subsampling = subsampling
+        self.optimize = optimize
+
+    def options(self, level=None):
+        '''PIL save() keyword arguments for a tile at level'''
+        ret = {}
+        quality = self.level_quality.get(level, self.quality)
+        if quality is not None and self.format in ('JPEG', 'WEBP', 'AVIF'):
+            ret['quality'] = quality
+        if self.format == 'JPEG':
+            if self.progressive:
+                ret['progressive'] = True
+            if self.subsampling is not None:
+                ret['subsampling'] = self.subsampling
+        if self.optimize:
+            if self.format in ('JPEG', 'PNG'):
+                ret['optimize'] = True
+            elif self.format == 'WEBP':
+                ret['method'] = 6
+        return ret
+
+    def key(self, level=None):
+        '''Identifies the output of encoding at level, for caching encodes'''
+        return (self.format, ) + tuple(sorted(self.options(level).items()))
+
+    def describe(self):
+        '''Settings that change the output, for the manifest'''
+        return {
+            'format':
+            self.format,
+            'quality':
+            self.quality,
+            'level_quality':
+            dict((str(level), quality)
+                 for level, quality in sorted(self.level_quality.items())),
+            'progressive':
+            self.progressive,
+            'subsampling':
+            self.subsampling,
+            'optimize':
+            self.optimize,
+        }
+
+    def encode(self, im, level=None):
+        buf = io.BytesIO()
+        self.save(im, buf, level)
+        return buf.getvalue()
+
+    def save(self, im, fp, level=None):
+        '''fp: file name or file object'''
+        im.save(fp, format=self.format, **self.options(level))
+
+    def can_copy(self, src_fn):
+        '''Can an existing tile file be stored as is instead of re-encoded?'''
+        try:
+            return im_format(os.path.splitext(src_fn)[1]) == self.format
+        except ValueError:
+            return False
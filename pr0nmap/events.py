@@ -0,0 +1,124 @@
+'''
+Structured progress events for job supervisors
+
+The tiler emits one JSON object per line:
+    run_start, run_end: a whole map (dst, levels, tiles, bytes, wall, ok)
+    stage_start, stage_end: one pass over a level (stage is the worker task: imtile, subtile, copy, block, fingerprint)
+    progress: at most every interval seconds while a stage runs
+        tasks_done / tasks, tiles and bytes written so far this run, stage tiles/s, ETA of the stage
+        and per worker busy / idle seconds
+Every event has ts (unix time) and event, tiler events also have map (the tile directory)
+so several maps can share a log
+
+Optionally the latest progress is also written as a Prometheus textfile
+(for node_exporter's textfile collector) so stalls can be alerted on
+'''
+
+import json
+import os
+import sys
+import threading
+import time
+
+
+class EventLog(object):
+
+    def __init__(self, fn=None, prometheus_fn=None, interval=1.0):
+        '''
+        fn: file to append JSON lines to, '-' for stdout or fd:N for an already open file descriptor
+        prometheus_fn: Prometheus textfile to keep up to date
+        '''
+        self.f = None
+        if fn == '-':
+            self.f = sys.stdout
+        elif fn and fn.startswith('fd:'):
+            self.f = os.fdopen(int(fn[3:]), 'w', closefd=False)
+        elif fn:
+            self.f = open(fn, 'a')
+        self.prometheus_fn = prometheus_fn
+        # Seconds between progress events
+        self.interval = interval
+        # map => {'running': 0 or 1, 'last': latest progress / run_end event}
+        self.maps = {}
+        # Maps may be built from several threads at once
+        self.lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        fields['ts'] = time.time()
+        with self.lock:
+            if self.f:
+                self.f.write(json.dumps(fields, sort_keys=True) + '\n')
+                self.f.flush()
+            state = self.maps.setdefault(fields.get('map', ''), {
+                'running': 0,
+                'last': {}
+            })
+            if event == 'run_start':
+                state['running'] = 1
+                state['last'] = {}
+            elif event == 'run_end':
+                state['running'] = 0
+            elif event != 'progress':
+                return
+            if 'tiles' in fields:
+                state['last'] = fields
+            self.write_prometheus()
+
+    def write_prometheus(self):
+        if not self.prometheus_fn:
+            return
+        lines = []
+
+        def labels(map_, **extra):
+            extra['map'] = map_
+            return ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                            for k, v in sorted(extra.items()))
+
+        def metric(name, kind, help_, values):
+            '''values: [(labels, value)], None values are left out'''
+            values = [(l, v) for l, v in values if v is not None]
+            if not values:
+                return
+            lines.append('# HELP pr0nmap_%s %s' % (name, help_))
+            lines.append('# TYPE pr0nmap_%s %s' % (name, kind))
+            for l, v in values:
+                lines.append('pr0nmap_%s{%s} %s' % (name, l, v))
+
+        def per_map(key):
+            return [(labels(map_), state['last'].get(key))
+                    for map_, state in sorted(self.maps.items())]
+
+        metric('running', 'gauge', '1 while a map is being built',
+               [(labels(map_), state['running'])
+                for map_, state in sorted(self.maps.items())])
+        metric('tiles_written_total', 'counter', 'Tiles written this run',
+               per_map('tiles'))
+        metric('bytes_written_total', 'counter', 'Tile bytes written this run',
+               per_map('bytes'))
+        metric('tiles_per_second', 'gauge', 'Current stage throughput',
+               per_map('tiles_per_sec'))
+        metric('stage_eta_seconds', 'gauge',
+               'Estimated seconds left in the current stage', per_map('eta'))
+        metric('level', 'gauge', 'Zoom level being built', per_map('level'))
+        metric('stage_tasks_done', 'gauge', 'Tasks done in the current stage',
+               per_map('tasks_done'))
+        metric('stage_tasks', 'gauge', 'Tasks in the current stage',
+               per_map('tasks'))
+        metric('last_progress_timestamp_seconds', 'gauge',
+               'When progress was last reported', per_map('ts'))
+        for kind in ('busy', 'idle'):
+            metric('worker_%s_seconds_total' % kind, 'counter',
+                   'Seconds each worker spent %s' % kind,
+                   [(labels(map_, worker=wi), worker[kind])
+                    for map_, state in sorted(self.maps.items()) for wi, worker
+                    in enumerate(state['last'].get('workers') or [])])
+        # Replace atomically so the collector never reads half a file
+        with open(self.prometheus_fn + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(self.prometheus_fn + '.tmp', self.prometheus_fn)
+
+    def close(self):
+        if self.f and self.f is not sys.stdout:
+            self.f.close()
+        self.f = None
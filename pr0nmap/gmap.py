@@ -1,4 +1,5 @@
 import os
+import shutil
 
 
 class GMap:
@@ -16,7 +17,11 @@ class GMap:
         self.image = None
         # don't error on missing tiles in grid
         self.skip_missing = False
-        self.set_im_ext('.jpg')
+        # Keep old output and only rebuild changed tiles
+        self.incremental = False
+        # Only write the base level, see tileserver.py
+        self.base_only = False
+        self.set_im_ext(self.source.im_ext())
         self.tw = 250
         self.th = 250
 
@@ -32,9 +37,15 @@ class GMap:
     def set_out_dir(self, out_dir):
         self.out_dir = out_dir
 
+    def set_incremental(self, incremental):
+        self.incremental = incremental
+
+    def set_base_only(self, base_only):
+        self.base_only = base_only
+
     def set_im_ext(self, s):
         self.im_ext = s
-        self.source.im_ext = s
+        self.source.set_im_ext(s)
         self.out_format = s.replace('.', '')
         if self.out_format == 'png':
             self.is_png_str = 'isPng: true,'
@@ -251,8 +262,9 @@ siMap.setOptions({
             self.page_title = 'SiMap: %s' % self.source.get_name()
 
         # If it looks like there is old output and we are trying to re-generate js don't nuke it
-        if os.path.exists(self.out_dir) and not self.js_only:
-            os.system('rm -rf %s' % self.out_dir)
+        if os.path.exists(
+                self.out_dir) and not self.js_only and not self.incremental:
+            shutil.rmtree(self.out_dir)
         if not os.path.exists(self.out_dir):
             os.mkdir(self.out_dir)
 
@@ -270,8 +282,11 @@ siMap.setOptions({
     @staticmethod
     def get_tile_name(dst_dir, level, row, col, im_ext):
         zoom_dir = '%s/%s' % (dst_dir, level + 1)
-        if not os.path.exists(zoom_dir):
+        # Workers race to create this
+        try:
             os.mkdir(zoom_dir)
+        except OSError:
+            pass
         return '%s/y%03d_x%03d%s' % (zoom_dir, row, col, im_ext)
 
     def run(self):
@@ -285,8 +300,8 @@ siMap.setOptions({
             print()
             print()
 
-            self.source.generate_tiles(self.max_level,
-                                       self.min_level,
-                                       self.get_tile_name,
-                                       dst_basedir='%s/tiles_out' %
-                                       self.out_dir)
+            self.source.generate_tiles(
+                self.max_level,
+                self.max_level if self.base_only else self.min_level,
+                self.get_tile_name,
+                dst_basedir='%s/tiles_out' % self.out_dir)
@@ -1,4 +1,5 @@
 import os
+import shutil
 import math
 import json
 """
@@ -68,6 +69,10 @@ class GroupXIV:
         # GroupXIV default is 500, but pr0nmap was 250
         self.tile_size = 250
         self.js_only = False
+        # Keep old output and only rebuild changed tiles
+        self.incremental = False
+        # Only write the base level, see tileserver.py
+        self.base_only = False
 
     def set_title(self, titile):
         self.title = titile
@@ -81,6 +86,15 @@ class GroupXIV:
     def set_out_dir(self, out_dir):
         self.out_dir = out_dir
 
+    def set_incremental(self, incremental):
+        self.incremental = incremental
+
+    def set_base_only(self, base_only):
+        self.base_only = base_only
+
+    def set_im_ext(self, s):
+        self.source.set_im_ext(s)
+
     # FIXME / TODO: this isn't the google reccomended naming scheme, look into that more
     # part of it was that I wanted them to sort nicely in file list view
     @staticmethod
@@ -103,8 +117,9 @@ class GroupXIV:
 
     def gen_js(self):
         # If it looks like there is old output and we are trying to re-generate js don't nuke it
-        if os.path.exists(self.out_dir) and not self.js_only:
-            os.system('rm -rf %s' % self.out_dir)
+        if os.path.exists(
+                self.out_dir) and not self.js_only and not self.incremental:
+            shutil.rmtree(self.out_dir)
         if not os.path.exists(self.out_dir):
             os.mkdir(self.out_dir)
 
@@ -153,8 +168,8 @@ class GroupXIV:
             print()
             print()
 
-            self.source.generate_tiles(self.max_level,
-                                       self.min_level,
-                                       self.get_tile_name,
-                                       dst_basedir='%s/l1-tiles' %
-                                       self.out_dir)
+            self.source.generate_tiles(
+                self.max_level,
+                self.max_level if self.base_only else self.min_level,
+                self.get_tile_name,
+                dst_basedir='%s/l1-tiles' % self.out_dir)
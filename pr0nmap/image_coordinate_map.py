@@ -1,6 +1,18 @@
+from pr0nmap.pimage import PImage
+
+import array
 import math
 import os
-from pr0nmap.pimage import PImage
+import re
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# ImageCoordinateMap.index values, others are indexes into ImageCoordinateMap.names
+MISSING = -1
+# File name is ImageCoordinateMap.template filled in with the row / col
+TEMPLATED = -2
 
 
 class MissingImage(Exception):
@@ -104,6 +116,82 @@ def get_row_col(file_name):
     return (row, col)
 
 
+def name_template(file_name, row, col):
+    '''
+    File name like dir/y012_x034.jpg => format string giving it back from row / col
+    None if file_name doesn't fit that pattern
+    Zero padding is taken from file_name, names padded some other way don't fit the template
+    '''
+    dirname, basename = os.path.split(file_name)
+    core_file_name, dot, extension = basename.partition('.')
+    parts = []
+    keys = []
+    for part in core_file_name.split('_'):
+        m = re.match(r'^([xcyr])([0-9]+)$', part)
+        if not m:
+            return None
+        letter, digits = m.groups()
+        # Same letters as get_row_col()
+        key = 'col' if letter in 'xc' else 'row'
+        keys.append(key)
+        if len(digits) > 1 and digits[0] == '0':
+            parts.append('%s{%s:0%ud}' % (letter, key, len(digits)))
+        else:
+            parts.append('%s{%s:d}' % (letter, key))
+    if sorted(keys) != ['col', 'row']:
+        return None
+
+    def escape(s):
+        return s.replace('{', '{{').replace('}', '}}')
+
+    template = escape(os.path.join(
+        dirname, '')) + '_'.join(parts) + escape(dot + extension)
+    try:
+        if template.format(row=row, col=col) != file_name:
+            return None
+    except (KeyError, ValueError):
+        # Ex: two row parts
+        return None
+    return template
+
+
+def template_pieces(template):
+    '''name_template() template => [(literal text, key or None, zero pad width or None)]'''
+    # [literal, key, width, literal, key, width, literal]
+    pieces = re.split(r'\{(row|col):(?:0([0-9]+))?d\}',
+                      template) + [None, None]
+    return [(pieces[i].replace('{{',
+                               '{').replace('}}',
+                                            '}'), pieces[i + 1], pieces[i + 2])
+            for i in range(0,
+                           len(pieces) - 2, 3)]
+
+
+def template_regex(template):
+    '''Regex matching exactly the names template gives, with row and col groups'''
+    ret = ''
+    for literal, key, width in template_pieces(template):
+        ret += re.escape(literal)
+        if key and width:
+            # Exactly width digits, more only once the number needs them
+            ret += '(?P<%s>[0-9]{%s}|[1-9][0-9]{%s,})' % (key, width, width)
+        elif key:
+            ret += '(?P<%s>0|[1-9][0-9]*)' % key
+    return ret + '$'
+
+
+def template_printf(template):
+    '''template => (% format string, keys in the order it takes them)'''
+    ret = ''
+    keys = []
+    for literal, key, width in template_pieces(template):
+        ret += literal.replace('%', '%%')
+        if key:
+            ret += '%0' + width + 'd' if width else '%d'
+            keys.append(key)
+    return ret, tuple(keys)
+
+
 class ImageCoordinateMap:
     '''
     Note that the values are undefined
@@ -117,24 +205,49 @@ class ImageCoordinateMap:
     '''
 
     def __init__(self, cols, rows):
-        # The actual imageimage_file_names position mapping
-        # Maps rows and cols to image file names
-        # would like to change this to managed PImages or something
-        # layout[col/x][row/y]
-        layout = None
         # ie x in range(0, cols)
         self.cols = cols
         # ie y in range(0, rows)
         self.rows = rows
-        self.layout = {}
+        # Row major rows x cols grid of MISSING, TEMPLATED or an index into names
+        # 4 bytes per position instead of a dict entry, a (col, row) tuple and a string
+        self.index = array.array('i', [MISSING]) * (cols * rows)
+        # Format string for the usual dir/y000_x000.jpg names, see name_template()
+        # Taken from the first name set, '' if that one didn't fit
+        self.template = None
+        # File names that don't fit template
+        self.names = []
+        # (col, row) => file name of images set outside cols x rows (check_bounds=False)
+        self.outside = {}
+
+    @property
+    def layout(self):
+        '''{(col, row): file name} of every image, built on each call'''
+        return dict(((col, row), image) for image, row, col in self.images())
+
+    def grid(self):
+        '''index as a rows x cols NumPy array, shares memory with index'''
+        return np.frombuffer(self.index,
+                             dtype=np.intc).reshape(self.rows, self.cols)
+
+    def name(self, i, row, col):
+        '''File name for index value i at row, col'''
+        if i == MISSING:
+            return None
+        if i == TEMPLATED:
+            return self.template.format(row=row, col=col)
+        return self.names[i]
 
     def images(self):
         '''Returns a generator giving (file name, row, col) tuples'''
-        for (col, row), image, in self.layout.items():
+        for col, row in self.gen_set():
+            yield (self.name(self.index[row * self.cols + col], row,
+                             col), row, col)
+        for (col, row), image, in self.outside.items():
             yield (image, row, col)
 
     def n_images(self):
-        return len(self.layout)
+        return len(self.index) - self.index.count(MISSING) + len(self.outside)
 
     def width(self):
         '''Return number of cols'''
@@ -146,14 +259,19 @@ class ImageCoordinateMap:
 
     def is_complete(self, check_bounds=True):
         '''Raise MissingImage on first missing image found or return if no missing images'''
-        for col in range(self.cols):
-            for row in range(self.rows):
-                if self.layout.get((col, row), None) is None:
-                    raise MissingImage('Row %d, col %d missing' % (row, col))
-        if check_bounds:
-            for (col, row), image, in self.layout.items():
-                if col < 0 or col >= self.cols or row < 0 or row >= self.rows:
-                    raise Exception('Row %d, col %d unexpected' % (row, col))
+        if MISSING in self.index:
+            if np is not None:
+                # Column major like the original scan
+                col, row = np.argwhere(self.grid().T == MISSING)[0]
+            else:
+                col, row = next(
+                    (col, row) for col in range(self.cols)
+                    for row in range(self.rows)
+                    if self.index[row * self.cols + col] == MISSING)
+            raise MissingImage('Row %d, col %d missing' % (row, col))
+        if check_bounds and self.outside:
+            col, row = next(iter(self.outside))
+            raise Exception('Row %d, col %d unexpected' % (row, col))
 
     def debug_print(self):
         print('height %d rows, width %d cols' % (self.height(), self.width()))
@@ -174,7 +292,8 @@ class ImageCoordinateMap:
             raise IndexError(
                 'col %d row %d out of range for width %d height %d' %
                 (col, row, self.width(), self.height()))
-        return self.layout.get((col, row), default)
+        ret = self.name(self.index[row * self.cols + col], row, col)
+        return default if ret is None else ret
 
     def get_images_from_pair(self, pair):
         # ImageCoordinatePair
@@ -187,7 +306,21 @@ class ImageCoordinateMap:
             raise Exception(
                 'row %d, col %d are out of bounds height %d, width %d' %
                 (row, col, self.height(), self.width()))
-        self.layout[(col, row)] = file_name
+        if row >= self.height() or col >= self.width() or row < 0 or col < 0:
+            self.outside[(col, row)] = file_name
+            return
+        i = row * self.cols + col
+        if file_name is None:
+            self.index[i] = MISSING
+            return
+        if self.template is None:
+            self.template = name_template(file_name, row, col) or ''
+        if self.template and self.template.format(row=row,
+                                                  col=col) == file_name:
+            self.index[i] = TEMPLATED
+        else:
+            self.index[i] = len(self.names)
+            self.names.append(file_name)
 
     def set_image(self, col, row, file_name):
         self.set_image_rc(row, col, file_name)
@@ -233,6 +366,24 @@ class ImageCoordinateMap:
         if rows is None and not cols is None:
             cols = math.ceil(len(file_names) / rows)
 
+        file_names = sorted(file_names)
+        # Names the first one's template gives back parse with a single regex match
+        template = None
+        regex = None
+        if file_names:
+            template = name_template(file_names[0],
+                                     *get_row_col(file_names[0]))
+        if template:
+            regex = re.compile(template_regex(template))
+        # (row, col, templated) of each file name
+        parsed = []
+        for file_name in file_names:
+            m = regex.match(file_name) if regex else None
+            if m:
+                parsed.append((int(m.group('row')), int(m.group('col')), True))
+            else:
+                parsed.append(get_row_col(file_name) + (False, ))
+
         if rows is None or cols is None:
             print(
                 'Row / col hints insufficient, guessing row / col layout from file names'
@@ -240,8 +391,7 @@ class ImageCoordinateMap:
             row_parts = set([0])
             col_parts = set([0])
 
-            for fn in file_names:
-                (row, col) = get_row_col(fn)
+            for row, col, _templated in parsed:
                 row_parts.add(row)
                 col_parts.add(col)
 
@@ -256,10 +406,13 @@ class ImageCoordinateMap:
               (cols, rows))
 
         ret = ImageCoordinateMap(cols, rows)
-        file_names = sorted(file_names)
-        for file_name in file_names:
+        ret.template = template or ''
+        for file_name, (row, col, templated) in zip(file_names, parsed):
+            if templated and 0 <= row < rows and 0 <= col < cols:
+                # What set_image_rc() would do, the regex already made its checks
+                ret.index[row * cols + col] = TEMPLATED
+                continue
             # Not canonical, but resolved well enough
-            (row, col) = get_row_col(file_name)
             if row is None or col is None:
                 raise Exception('Bad file name %s' % file_name)
             ret.set_image_rc(row, col, file_name, check_bounds=check_bounds)
@@ -268,9 +421,13 @@ class ImageCoordinateMap:
 
     def gen_set(self):
         '''Get all pairs that are actually in the map'''
+        if np is not None:
+            cols, rows = np.nonzero(self.grid().T != MISSING)
+            yield from zip(cols.tolist(), rows.tolist())
+            return
         for col in range(self.cols):
             for row in range(self.rows):
-                if (col, row) in self.layout:
+                if self.index[row * self.cols + col] != MISSING:
                     yield (col, row)
 
     def gen_pairs(self, row_spread=1, col_spread=1):
@@ -294,11 +451,22 @@ class ImageCoordinateMap:
                         yield to_yield
 
     def __repr__(self):
+        line = '(col/x=%d, row/y=%d) = %s\n'
+        if self.template:
+            # Templated images in one % format each
+            fmt, keys = template_printf(self.template)
+            templated = '(col/x=%d, row/y=%d) = ' + fmt + '\n'
+            row_first = keys == ('row', 'col')
         ret = ''
         for row in range(0, self.rows):
-            for col in range(0, self.cols):
-                ret += '(col/x=%d, row/y=%d) = %s\n' % (
-                    col, row, self.get_image(col, row))
+            i = row * self.cols
+            ret += ''.join([
+                templated % ((col, row, row, col) if row_first else
+                             (col, row, col, row))
+                if self.index[i + col] == TEMPLATED else line %
+                (col, row, self.name(self.index[i + col], row, col))
+                for col in range(0, self.cols)
+            ])
         return ret
 
     def active_box(self):
@@ -307,9 +475,18 @@ class ImageCoordinateMap:
         x1 = -1
         y0 = self.height()
         y1 = -1
-        for (fn, row, col) in self.images():
-            if fn is None:
-                continue
+        if np is not None:
+            present = self.grid() != MISSING
+            rows = np.flatnonzero(present.any(axis=1))
+            cols = np.flatnonzero(present.any(axis=0))
+            if len(rows):
+                x0, x1 = int(cols[0]), int(cols[-1])
+                y0, y1 = int(rows[0]), int(rows[-1])
+            # Only the images off the grid are left
+            rest = self.outside.keys()
+        else:
+            rest = ((col, row) for _fn, row, col in self.images())
+        for col, row in rest:
             x0 = min(x0, col)
             x1 = max(x1, col)
             y0 = min(y0, row)
@@ -0,0 +1,87 @@
+'''
+Tile manifest for incremental map generation
+Records a fingerprint for every output tile so a re-run only rebuilds what changed
+
+Base tiles are fingerprinted from their input (source tile mtime/size or source pixels)
+Everything above is fingerprinted from its four children
+'''
+
+import hashlib
+import json
+import os
+
+
+def file_fingerprint(fn):
+    '''Cheap fingerprint of a file: mtime + size, None if it doesn't exist'''
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return None
+    return '%x:%x' % (st.st_mtime_ns, st.st_size)
+
+
+def pixel_fingerprint(im):
+    h = hashlib.sha1()
+    h.update(('%s %u %u ' % (im.mode, im.size[0], im.size[1])).encode())
+    h.update(im.tobytes())
+    return h.hexdigest()[0:16]
+
+
+def parent_fingerprint(children):
+    '''children: the four child fingerprints in row major order, None if missing'''
+    h = hashlib.sha1()
+    h.update('|'.join([child or '-' for child in children]).encode())
+    return h.hexdigest()[0:16]
+
+
+class Manifest(object):
+
+    def __init__(self, fn, config):
+        self.fn = fn
+        # Anything that changes every tile (tile size, extension, levels, etc)
+        self.config = config
+        # Fingerprint of the whole source, if it has one
+        self.source = None
+        # level => {(row, col): fingerprint}
+        self.levels = {}
+
+    @staticmethod
+    def load(fn, config):
+        '''Return the manifest at fn or an empty one if it is missing or was made with a different config'''
+        ret = Manifest(fn, config)
+        if not os.path.exists(fn):
+            print('Manifest: %s not found, building everything' % fn)
+            return ret
+        j = json.load(open(fn))
+        if j['config'] != config:
+            print('Manifest: config changed, building everything')
+            return ret
+        ret.source = j['source']
+        for level, tiles in j['levels'].items():
+            ret.levels[int(level)] = dict(
+                (tuple(int(x) for x in rc.split('_')), fp)
+                for rc, fp in tiles.items())
+        return ret
+
+    def get(self, level):
+        return self.levels.get(level, {})
+
+    def set_level(self, level, fps):
+        self.levels[level] = dict(fps)
+
+    def save(self):
+        j = {
+            'config':
+            self.config,
+            'source':
+            self.source,
+            'levels':
+            dict((str(level),
+                  dict(('%u_%u' % rc, fp) for rc, fp in tiles.items()))
+                 for level, tiles in self.levels.items()),
+        }
+        # Don't leave a half written manifest around if we get killed
+        tmp = self.fn + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(j, f)
+        os.replace(tmp, self.fn)
@@ -1,6 +1,8 @@
 from pr0nmap.pimage import PImage
 from pr0nmap import pimage
 from pr0nmap.tile import Tiler, calc_max_level
+from pr0nmap.store import open_store
+from pr0nmap.encoder import Encoder
 from pr0nmap.image_coordinate_map import ImageCoordinateMap
 import os
 import os.path
@@ -37,10 +39,47 @@ class MapSource:
 # Input to map generator algorithm is a large input image
 class ImageMapSource(MapSource):
 
-    def __init__(self, image_in, threads=1):
+    def __init__(self,
+                 image_in,
+                 threads=1,
+                 stream=False,
+                 in_memory=False,
+                 block_levels=0,
+                 incremental=False,
+                 store='dir',
+                 dedupe=False,
+                 reduce='pil',
+                 encode_opts=None,
+                 events=None,
+                 profile=None,
+                 max_memory=None,
+                 pool=None,
+                 regions=None):
         self.image_in = image_in
         self.pim = PImage.from_file(self.image_in)
         self.threads = threads
+        # Decode the base level in strips to bound memory on huge images
+        self.stream = stream
+        self.in_memory = in_memory
+        self.block_levels = block_levels
+        self.incremental = incremental
+        # Tile store kind, see store.open_store()
+        self.store = store
+        self.dedupe = dedupe
+        # 2x2 => 1 shrink kernel, see reduce.KERNELS
+        self.reduce = reduce
+        # encoder.Encoder() options, ex: quality
+        self.encode_opts = encode_opts or {}
+        # events.EventLog for structured progress
+        self.events = events
+        # profiling.Profiler to record the tiler in
+        self.profile = profile
+        # Bytes the build has to fit in, None for no limit
+        self.max_memory = max_memory
+        # Changed (x0, y0, x1, y1) base pixel rectangles, None to build everything
+        self.regions = regions
+        # tile.WorkerPool shared with other maps, None for the tiler's own
+        self.pool = pool
         self.tw = 250
         self.th = 250
         _root, extension = os.path.splitext(image_in)
@@ -87,18 +126,72 @@ class ImageMapSource(MapSource):
                     threads=self.threads,
                     pim=self.pim,
                     im_ext=self.im_ext(),
-                    get_tile_name=get_tile_name)
+                    get_tile_name=get_tile_name,
+                    stream=self.stream,
+                    in_memory=self.in_memory,
+                    block_levels=self.block_levels,
+                    incremental=self.incremental,
+                    store=open_store(self.store,
+                                     dst_basedir,
+                                     get_tile_name,
+                                     self.im_ext(),
+                                     dedupe=self.dedupe,
+                                     encoder=Encoder(self.im_ext(),
+                                                     **self.encode_opts)),
+                    reduce=self.reduce,
+                    events=self.events,
+                    profile=self.profile,
+                    max_memory=self.max_memory,
+                    regions=self.regions,
+                    pool=self.pool)
 
         gen.run()
 
 
 class TileMapSource(MapSource):
 
-    def __init__(self, dir_in, threads=1):
+    def __init__(self,
+                 dir_in,
+                 threads=1,
+                 in_memory=False,
+                 block_levels=0,
+                 incremental=False,
+                 store='dir',
+                 dedupe=False,
+                 reduce='pil',
+                 encode_opts=None,
+                 link_mode='copy',
+                 events=None,
+                 profile=None,
+                 max_memory=None,
+                 pool=None,
+                 regions=None):
         print('TileMapSource()')
         self.tw = 250
         self.th = 250
         self.threads = threads
+        self.in_memory = in_memory
+        self.block_levels = block_levels
+        self.incremental = incremental
+        # Tile store kind, see store.open_store()
+        self.store = store
+        self.dedupe = dedupe
+        # 2x2 => 1 shrink kernel, see reduce.KERNELS
+        self.reduce = reduce
+        # encoder.Encoder() options, ex: quality
+        self.encode_opts = encode_opts or {}
+        # events.EventLog for structured progress
+        self.events = events
+        # profiling.Profiler to record the tiler in
+        self.profile = profile
+        # Bytes the build has to fit in, None for no limit
+        self.max_memory = max_memory
+        # Changed (x0, y0, x1, y1) base pixel rectangles, None to build everything
+        self.regions = regions
+        # tile.WorkerPool shared with other maps, None for the tiler's own
+        self.pool = pool
+        # How base tiles are placed in a dir store, see store.LINK_MODES
+        self.link_mode = link_mode
 
         self.file_names = set()
         for f in os.listdir(dir_in):
@@ -109,6 +202,9 @@ class TileMapSource(MapSource):
             else:
                 self.file_names.add(dir_in + "/" + f)
         self.src_dir = dir_in
+        # Source tiles are always .jpg, output defaults to the same
+        self.src_im_ext = '.jpg'
+        self._im_ext = self.src_im_ext
 
         self.map = ImageCoordinateMap.from_tagged_file_names(self.file_names)
 
@@ -120,8 +216,11 @@ class TileMapSource(MapSource):
 
         MapSource.__init__(self)
 
+    def set_im_ext(self, im_ext):
+        self._im_ext = im_ext
+
     def im_ext(self):
-        return ".jpg"
+        return self._im_ext
 
     def get_name(self):
         # Get the last directory component
@@ -147,5 +246,23 @@ class TileMapSource(MapSource):
                     threads=self.threads,
                     pim=None,
                     im_ext=self.im_ext(),
-                    get_tile_name=get_tile_name)
+                    get_tile_name=get_tile_name,
+                    src_im_ext=self.src_im_ext,
+                    in_memory=self.in_memory,
+                    block_levels=self.block_levels,
+                    incremental=self.incremental,
+                    store=open_store(self.store,
+                                     dst_basedir,
+                                     get_tile_name,
+                                     self.im_ext(),
+                                     dedupe=self.dedupe,
+                                     encoder=Encoder(self.im_ext(),
+                                                     **self.encode_opts),
+                                     link_mode=self.link_mode),
+                    reduce=self.reduce,
+                    events=self.events,
+                    profile=self.profile,
+                    max_memory=self.max_memory,
+                    regions=self.regions,
+                    pool=self.pool)
         gen.run()
@@ -0,0 +1,343 @@
+'''
+Microbenchmarks of the per tile / per file name hot paths: pr0nmap microbench [options]
+
+Each case times one function on its own and reports:
+ops/s (calls) and items/s (ex: file names per from_tagged_file_names() call)
+allocations during one call as seen by tracemalloc:
+blocks / bytes still allocated afterwards (leaks, caches, whatever the call returns)
+and peak bytes allocated at once
+(tracemalloc only sees Python allocations, PIL's pixel buffers aren't included)
+
+--json saves results, --compare prints the speedup against a saved run (ex: from another commit)
+'''
+
+from pr0nmap.gmap import GMap
+from pr0nmap.groupxiv import GroupXIV
+from pr0nmap import image_coordinate_map
+from pr0nmap.image_coordinate_map import ImageCoordinateMap
+from pr0nmap import pimage
+from pr0nmap.pimage import PImage
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import PIL
+from PIL import Image
+
+
+def case_groupxiv_get_tile_name(args):
+    tmp = args.tmp
+    rcs = [(row, col) for row in range(32) for col in range(32)]
+
+    def run():
+        for row, col in rcs:
+            GroupXIV.get_tile_name(tmp, 3, row, col, '.jpg')
+
+    return run, len(rcs)
+
+
+def case_gmap_get_tile_name(args):
+    tmp = args.tmp
+    rcs = [(row, col) for row in range(32) for col in range(32)]
+
+    def run():
+        for row, col in rcs:
+            GMap.get_tile_name(tmp, 3, row, col, '.jpg')
+
+    return run, len(rcs)
+
+
+def case_get_row_col(args):
+    fns = [
+        'tiles/y%03u_x%03u.jpg' % (row, col) for row in range(32)
+        for col in range(32)
+    ]
+
+    def run():
+        for fn in fns:
+            image_coordinate_map.get_row_col(fn)
+
+    return run, len(fns)
+
+
+def tagged_file_names(n):
+    '''n y000_x000.jpg names in a roughly square grid'''
+    cols = max(1, int(n**0.5))
+    return ['tiles/y%03u_x%03u.jpg' % (i // cols, i % cols) for i in range(n)]
+
+
+def coordinate_map(fns):
+    # It prints its progress
+    with open(os.devnull, 'w') as f:
+        with contextlib.redirect_stdout(f):
+            return ImageCoordinateMap.from_tagged_file_names(fns)
+
+
+def case_from_tagged_file_names(args):
+    fns = tagged_file_names(args.names)
+
+    def run():
+        # Returned so live bytes is the size of the map
+        return coordinate_map(fns)
+
+    return run, len(fns)
+
+
+def case_map_is_complete(args):
+    icm = coordinate_map(tagged_file_names(args.names))
+
+    def run():
+        try:
+            icm.is_complete()
+        except image_coordinate_map.MissingImage:
+            # Last row of a non square count is short
+            pass
+
+    return run, icm.n_images()
+
+
+def case_map_active_box(args):
+    icm = coordinate_map(tagged_file_names(args.names))
+
+    def run():
+        icm.active_box()
+
+    return run, icm.n_images()
+
+
+def case_map_gen_set(args):
+    icm = coordinate_map(tagged_file_names(args.names))
+
+    def run():
+        for _rc in icm.gen_set():
+            pass
+
+    return run, icm.n_images()
+
+
+def case_map_repr(args):
+    icm = coordinate_map(tagged_file_names(args.names))
+
+    def run():
+        repr(icm)
+
+    return run, icm.n_images()
+
+
+def tile_images(tw=250, th=250):
+    '''4 different RGB tiles'''
+    return [
+        Image.new('RGB', (tw, th), (i * 60, 255 - i * 60, 128))
+        for i in range(4)
+    ]
+
+
+def case_from_fns(args):
+    ims = tile_images()
+
+    def run():
+        # from_fns() replaces entries in its argument
+        pimage.from_fns([[ims[0], ims[1]], [ims[2], None]], tw=250, th=250)
+
+    return run, 1
+
+
+def case_rescale(args):
+    im = Image.new('RGB', (500, 500), (10, 20, 30))
+
+    def run():
+        pimage.rescale(im, 0.5, filt=Image.LANCZOS)
+
+    return run, 1
+
+
+def case_resize(args):
+    # A right / bottom edge tile being padded out to full size
+    im = Image.new('RGB', (170, 250), (10, 20, 30))
+
+    def run():
+        pimage.resize(im, 250, 250)
+
+    return run, 1
+
+
+def case_trim_verbose(args):
+    # Black border around a white box, trim_verbose() looks at every pixel
+    im = Image.new('RGB', (args.trim_size, args.trim_size))
+    im.paste((255, 255, 255),
+             (args.trim_size // 4, args.trim_size // 4,
+              args.trim_size * 3 // 4, args.trim_size * 3 // 4))
+    pim = PImage.from_image(im)
+
+    def run():
+        pim.trim_verbose()
+
+    return run, args.trim_size * args.trim_size
+
+
+# name => setup(args) returning (function to time, items it handles per call)
+CASES = {
+    'groupxiv_get_tile_name': case_groupxiv_get_tile_name,
+    'gmap_get_tile_name': case_gmap_get_tile_name,
+    'get_row_col': case_get_row_col,
+    'from_tagged_file_names': case_from_tagged_file_names,
+    'map_is_complete': case_map_is_complete,
+    'map_active_box': case_map_active_box,
+    'map_gen_set': case_map_gen_set,
+    'map_repr': case_map_repr,
+    'from_fns': case_from_fns,
+    'rescale': case_rescale,
+    'resize': case_resize,
+    'trim_verbose': case_trim_verbose,
+}
+
+
+def time_case(run, min_time, repeat):
+    '''Best seconds per call over repeat rounds of at least min_time each'''
+    # Warm up caches, first mkdir()s and such
+    run()
+    best = None
+    for _i in range(repeat):
+        n = 0
+        tstart = time.perf_counter()
+        while True:
+            run()
+            n += 1
+            dt = time.perf_counter() - tstart
+            if dt >= min_time:
+                break
+        if best is None or dt / n < best:
+            best = dt / n
+    return best
+
+
+def trace_case(run):
+    '''Allocations during one call: (blocks still allocated, bytes still allocated, peak bytes)'''
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        base, _peak = tracemalloc.get_traced_memory()
+        ret = run()
+        _current, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        del ret
+    finally:
+        tracemalloc.stop()
+    # Leave out the snapshots themselves
+    filters = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__)
+    ]
+    diff = after.filter_traces(filters).compare_to(
+        before.filter_traces(filters), 'lineno')
+    return (sum(stat.count_diff for stat in diff),
+            sum(stat.size_diff for stat in diff), peak - base)
+
+
+def git_rev():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='pr0nmap microbench',
+        description='Time pr0nmap hot path functions on their own')
+    parser.add_argument('cases',
+                        nargs='*',
+                        help='Cases to run (default: all): %s' %
+                        ', '.join(CASES.keys()))
+    parser.add_argument(
+        '--names',
+        type=int,
+        default=1000000,
+        help='File names for from_tagged_file_names and the map_* cases')
+    parser.add_argument('--trim-size',
+                        type=int,
+                        default=200,
+                        help='Image width / height for trim_verbose')
+    parser.add_argument('--min-time',
+                        type=float,
+                        default=0.2,
+                        help='Seconds to run each round for')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help='Rounds per case, the best one counts')
+    parser.add_argument('--json', default=None, help='Also write results here')
+    parser.add_argument(
+        '--compare',
+        default=None,
+        help='Earlier --json results to print speedups against')
+    args = parser.parse_args(argv)
+
+    for name in args.cases:
+        if name not in CASES:
+            parser.error('Unknown case %s' % name)
+    names = args.cases or list(CASES.keys())
+
+    old = None
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)['cases']
+
+    results = {
+        'rev': git_rev(),
+        'python': platform.python_version(),
+        'pil': PIL.__version__,
+        'config': {
+            'names': args.names,
+            'trim_size': args.trim_size,
+        },
+        'cases': {},
+    }
+    print('%-24s %12s %14s %12s %12s %12s%s' %
+          ('case', 'ops/s', 'items/s', 'live blocks', 'live bytes',
+           'peak bytes', '  speedup' if old else ''))
+    tmp = tempfile.TemporaryDirectory(prefix='pr0nmap_microbench_')
+    # Where the get_tile_name() cases make their directories
+    args.tmp = tmp.name
+    for name in names:
+        run, items = CASES[name](args)
+        dt = time_case(run, args.min_time, args.repeat)
+        blocks, size, peak = trace_case(run)
+        res = {
+            'ops_per_sec': 1 / dt,
+            'items_per_sec': items / dt,
+            'alloc_live_blocks': blocks,
+            'alloc_live_bytes': size,
+            'alloc_peak_bytes': peak,
+        }
+        results['cases'][name] = res
+        speedup = ''
+        if old and name in old:
+            speedup = '  %0.2fx' % (res['ops_per_sec'] /
+                                    old[name]['ops_per_sec'])
+        print('%-24s %12.1f %14.1f %12d %12d %12d%s' %
+              (name, res['ops_per_sec'], res['items_per_sec'], blocks, size,
+               peak, speedup))
+
+    tmp.cleanup()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+            f.write('\n')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+'''
+Packed tile archive for serving
+fn holds every tile's encoded bytes back to back
+fn.idx is a fixed size table of (offset, length) for every (level, row, col) in the pyramid
+
+Index layout (little endian):
+    magic 'PR0NIDX1', u32 levels
+    per level: u32 level, u32 rows, u32 cols, u64 first entry
+    entries: u64 offset, u32 length (0 if the tile is missing), row major within each level
+
+Tiles are written coarsest level first and Z-order (Morton order) within a level
+so a viewer's neighborhood of tiles is mostly one contiguous read
+'''
+
+import hashlib
+import mmap
+import os
+import struct
+
+MAGIC = b'PR0NIDX1'
+HEADER = struct.Struct('<8sI')
+LEVEL = struct.Struct('<IIIQ')
+ENTRY = struct.Struct('<QI')
+
+
+def morton(row, col):
+    '''Interleave row and col bits so nearby tiles sort near each other'''
+    ret = 0
+    bit = 0
+    while row or col:
+        ret |= (col & 1) << bit
+        ret |= (row & 1) << (bit + 1)
+        row >>= 1
+        col >>= 1
+        bit += 2
+    return ret
+
+
+def write_pack(fn, keys, get, dedupe=False):
+    '''
+    keys: (level, row, col) of every tile
+    get(level, row, col) => tile bytes
+    dedupe: point identical tiles at one copy of the data
+    '''
+    keys = list(keys)
+    # level => (rows, cols)
+    dims = {}
+    for level, row, col in keys:
+        rows, cols = dims.get(level, (0, 0))
+        dims[level] = (max(rows, row + 1), max(cols, col + 1))
+    levels = sorted(dims.keys())
+    first = {}
+    n = 0
+    for level in levels:
+        first[level] = n
+        rows, cols = dims[level]
+        n += rows * cols
+
+    entries = bytearray(ENTRY.size * n)
+    offset = 0
+    # sha1 => offset of the first tile with that data
+    offsets = {}
+    with open(fn + '.tmp', 'wb') as f:
+        for level, row, col in sorted(keys,
+                                      key=lambda k:
+                                      (k[0], morton(k[1], k[2]))):
+            data = get(level, row, col)
+            _rows, cols = dims[level]
+            i = ENTRY.size * (first[level] + row * cols + col)
+            if dedupe:
+                h = hashlib.sha1(data).digest()
+                if h in offsets:
+                    ENTRY.pack_into(entries, i, offsets[h], len(data))
+                    continue
+                offsets[h] = offset
+            f.write(data)
+            ENTRY.pack_into(entries, i, offset, len(data))
+            offset += len(data)
+
+    with open(fn + '.idx.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(levels)))
+        for level in levels:
+            rows, cols = dims[level]
+            f.write(LEVEL.pack(level, rows, cols, first[level]))
+        f.write(entries)
+    os.replace(fn + '.tmp', fn)
+    os.replace(fn + '.idx.tmp', fn + '.idx')
+    return len(keys), offset
+
+
+class PackReader(object):
+    '''
+    Map an archive and hand out tiles without copying them
+    Returned memoryviews point into the mapping, so keep the reader open while using them
+    '''
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.f = open(fn, 'rb')
+        self.fidx = open(fn + '.idx', 'rb')
+        # Empty files can't be mapped
+        self.data = mmap.mmap(self.f.fileno(), 0,
+                              access=mmap.ACCESS_READ) if os.fstat(
+                                  self.f.fileno()).st_size else b''
+        self.idx = mmap.mmap(self.fidx.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, nlevels = HEADER.unpack_from(self.idx, 0)
+        if magic != MAGIC:
+            raise ValueError('%s: not a tile pack index' % (fn + '.idx', ))
+        # level => (rows, cols, first entry)
+        self.levels = {}
+        for i in range(nlevels):
+            level, rows, cols, first = LEVEL.unpack_from(
+                self.idx, HEADER.size + i * LEVEL.size)
+            self.levels[level] = (rows, cols, first)
+        self.entries = HEADER.size + nlevels * LEVEL.size
+        self.view = memoryview(self.data)
+
+    def keys(self):
+        for level, (rows, cols, _first) in sorted(self.levels.items()):
+            for row in range(rows):
+                for col in range(cols):
+                    if self.get(level, row, col) is not None:
+                        yield (level, row, col)
+
+    def get(self, level, row, col):
+        '''Tile bytes as a memoryview into the archive, None if missing'''
+        try:
+            rows, cols, first = self.levels[level]
+        except KeyError:
+            return None
+        if row < 0 or row >= rows or col < 0 or col >= cols:
+            return None
+        offset, length = ENTRY.unpack_from(
+            self.idx, self.entries + ENTRY.size * (first + row * cols + col))
+        if not length:
+            return None
+        return self.view[offset:offset + length]
+
+    def close(self):
+        self.view.release()
+        for closeme in (self.data, self.idx, self.f, self.fidx):
+            if hasattr(closeme, 'close'):
+                closeme.close()
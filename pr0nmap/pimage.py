@@ -3,9 +3,12 @@ TODO: get rid of this file
 '''
 
 from PIL import Image
+from PIL import ImageFile
 
 Image.MAX_IMAGE_PIXELS = None
+import io
 import os
+from multiprocessing import shared_memory
 
 PALETTES = bool(os.getenv('PR0N_PALETTES', ''))
 
@@ -315,11 +318,37 @@ class PImage:
                 '.bmp') > 0
 
 
-def from_fns(images_in, tw=None, th=None):
+def open_image(src):
+    '''src may be a file name or an already loaded PIL image'''
+    if isinstance(src, Image.Image):
+        return src
+    return Image.open(src)
+
+
+def open_half(src):
+    '''
+    Open src decoded at half size
+    JPEGs are scaled by libjpeg while decoding (draft mode), about a quarter of the work
+    Anything else (or an already loaded image) is box filtered after a full decode
+    '''
+    im = open_image(src)
+    w, h = im.size
+    size = (w // 2, h // 2)
+    if im.format == 'JPEG':
+        im.draft(im.mode, size)
+    if im.size != size:
+        im = im.resize(size,
+                       Image.NEAREST if im.mode in ('1', 'P') else Image.BOX)
+    return im
+
+
+def from_fns(images_in, tw=None, th=None, half=False):
     '''
     Return an image constructed from a 2-D array of image file names
     [[r0c0, r0c1],
      [r1c0, r1c1]]
+    Already loaded PIL images may be given in place of file names
+    half: decode each image at half size (see open_half) so the result is already shrunk 2:1
     '''
     mode = None
 
@@ -342,16 +371,18 @@ def from_fns(images_in, tw=None, th=None):
 
                 # im should in theory work but accessing pixels
                 # is for some reason causing corruption
-                iml = Image.open(src_last)
-                imf = Image.new(mode, (tw, th))
+                # (half size images are already decoded)
+                iml = im if half else open_image(src_last)
+                imw, imh = iml.size
+                imf = Image.new(mode, (imw, imh))
                 if PALETTES:
                     imf.putpalette(iml.palette)
-                pix = iml.getpixel((tw - 1, th - 1))
-                imf.paste(pix, (0, 0, tw, th))
+                pix = iml.getpixel((imw - 1, imh - 1))
+                imf.paste(pix, (0, 0, imw, imh))
 
                 images_in[rowi][coli] = imf
             else:
-                im = Image.open(src)
+                im = open_image(src)
                 imw, imh = im.size
 
                 if mode is None:
@@ -370,10 +401,15 @@ def from_fns(images_in, tw=None, th=None):
                 elif th != imh:
                     raise Exception('tile height mismatch')
 
+                if half:
+                    im = open_half(im)
                 images_in[rowi][coli] = im
 
             src_last = src or src_last
 
+    if half:
+        tw //= 2
+        th //= 2
     # Images are now all either PImage or None with uniform width/height
     width = tw * cols
     height = th * rows
@@ -398,6 +434,20 @@ def from_fns(images_in, tw=None, th=None):
     return ret
 
 
+def solid_color(im):
+    '''Pixel value if every pixel in im is the same, else None'''
+    if im.mode == 'P':
+        # Can't recreate it without the palette
+        return None
+    extrema = im.getextrema()
+    if len(im.getbands()) == 1:
+        extrema = (extrema, )
+    for lo, hi in extrema:
+        if lo != hi:
+            return None
+    return tuple(lo for lo, _hi in extrema)
+
+
 # Change canvas, shifting pixels to fill it
 def rescale(im, factor, filt=Image.NEAREST):
     w, h = im.size
@@ -429,5 +479,276 @@ def resize(im, width, height, def_color=None):
 
 
 def im_reload(im):
-    im.save('/tmp/pt_pil_tmp.png')
-    return Image.open('/tmp/pt_pil_tmp.png')
+    # In memory so that concurrent workers don't trample each other
+    buf = io.BytesIO()
+    im.save(buf, 'png')
+    buf.seek(0)
+    return Image.open(buf)
+
+
+'''
+Strip sources
+Give ImageTiler horizontal bands of a large image without caring where the pixels come from
+'''
+
+
+class ImageStrips:
+    '''Strips cropped out of an already opened PIL image (decodes the whole thing on first use)'''
+
+    def __init__(self, image):
+        self.image = image
+
+    def width(self):
+        return self.image.size[0]
+
+    def height(self):
+        return self.image.size[1]
+
+    def get_mode(self):
+        return self.image.mode
+
+    def palette(self):
+        return self.image.palette
+
+    def crop(self, x0, y0, x1, y1):
+        return self.image.crop((x0, y0, x1, y1))
+
+    def strip(self, y0, y1):
+        return self.crop(0, y0, self.width(), y1)
+
+
+def _tile(codec, extents, offset, args):
+    '''Tile list entry, newer PIL wants ImageFile._Tile instead of a plain tuple'''
+    if hasattr(ImageFile, '_Tile'):
+        return ImageFile._Tile(codec, extents, offset, args)
+    return (codec, extents, offset, args)
+
+
+def _raw_linesize(mode, rawmode, width):
+    '''Bytes per scanline of a raw tile or None if PIL doesn't know how to pack it'''
+    try:
+        return len(Image.new(mode, (width, 1)).tobytes('raw', rawmode))
+    except Exception:
+        return None
+
+
+def _raw_args(args):
+    # PPM gives a bare rawmode string
+    if isinstance(args, str):
+        args = (args, )
+    args = tuple(args) + (0, 1)[len(args) - 1:]
+    return args[0:3]
+
+
+def can_stream(image):
+    '''
+    Return True if image rows can be decoded independently
+    Only true for uncompressed layouts (uncompressed TIFF, BMP, PPM, etc)
+    PIL can't stop a JPEG / PNG decode part way through and pick it back up later
+    '''
+    if not image.tile:
+        return False
+    for codec, _extents, _offset, args in image.tile:
+        if codec != 'raw':
+            return False
+        rawmode, _stride, _orientation = _raw_args(args)
+        # Need whole bytes per pixel to clip columns
+        bits8 = _raw_linesize(image.mode, rawmode, 8)
+        if bits8 is None or bits8 % 8:
+            return False
+    return True
+
+
+class FileStrips(ImageStrips):
+    '''
+    Decode only the requested region of an uncompressed image file
+    Peak memory is the size of the region, not the size of the image
+    '''
+
+    def __init__(self, fn):
+        self.fn = fn
+        # Header only, does not decode
+        ImageStrips.__init__(self, Image.open(fn))
+        assert can_stream(self.image), fn
+
+    # Workers reopen the file themselves
+    def __getstate__(self):
+        return {'fn': self.fn}
+
+    def __setstate__(self, state):
+        self.__init__(state['fn'])
+
+    def crop(self, x0, y0, x1, y1):
+        im = Image.open(self.fn)
+        tiles = []
+        for codec, (tx0, ty0, tx1, ty1), offset, args in im.tile:
+            cx0 = max(tx0, x0)
+            cx1 = min(tx1, x1)
+            cy0 = max(ty0, y0)
+            cy1 = min(ty1, y1)
+            if cx0 >= cx1 or cy0 >= cy1:
+                continue
+            rawmode, stride, orientation = _raw_args(args)
+            if not stride:
+                stride = _raw_linesize(im.mode, rawmode, tx1 - tx0)
+            offset += _raw_linesize(im.mode, rawmode, cx0 - tx0)
+            # BMP and friends are stored bottom up
+            if orientation < 0:
+                offset += (ty1 - cy1) * stride
+            else:
+                offset += (cy0 - ty0) * stride
+            tiles.append(
+                _tile(codec, (cx0 - x0, cy0 - y0, cx1 - x0, cy1 - y0), offset,
+                      (rawmode, stride, orientation)))
+        # Pretend the file is just the region we want
+        im._size = (x1 - x0, y1 - y0)
+        # TIFF sizes the decode buffer off this instead, don't allocate the whole image
+        if hasattr(im, '_tile_size'):
+            im._tile_size = im._size
+        im.tile = tiles
+        im.load()
+        return im
+
+
+class SharedImage(ImageStrips):
+    '''
+    Raw pixels in shared memory so worker processes can crop out of a single decode
+    Pickles as just the shared memory name, workers attach on first use
+    '''
+
+    def __init__(self, name, mode, size, palette=None, create=False):
+        self.name = name
+        self.mode = mode
+        self.size = size
+        self._palette = palette
+        self.bpp = len(Image.new(mode, (1, 1)).tobytes())
+        self.stride = self.bpp * size[0]
+        self.shm = None
+        if create:
+            self.shm = shared_memory.SharedMemory(name=name,
+                                                  create=True,
+                                                  size=max(
+                                                      1,
+                                                      self.stride * size[1]))
+
+    @staticmethod
+    def from_image(image, name=None, rows=256):
+        '''Copy image into a new shared memory block a few rows at a time'''
+        if name is None:
+            name = 'pr0nmap_%u_%u' % (os.getpid(), id(image))
+        palette = image.getpalette() if image.mode == 'P' else None
+        ret = SharedImage(name, image.mode, image.size, palette, create=True)
+        for y in range(0, image.size[1], rows):
+            ret.paste(
+                image.crop((0, y, image.size[0], min(y + rows,
+                                                     image.size[1]))), 0, y)
+        return ret
+
+    @staticmethod
+    def from_file(fn, name=None, rows=256):
+        '''
+        Decode fn into a new shared memory block
+        Uncompressed layouts are read a few rows at a time straight into it
+        Anything else is decoded whole, copied, and the decode dropped before returning
+        '''
+        image = Image.open(fn)
+        if name is None:
+            name = 'pr0nmap_%u_%u' % (os.getpid(), id(image))
+        if not can_stream(image):
+            try:
+                return SharedImage.from_image(image, name, rows)
+            finally:
+                image.close()
+        strips = FileStrips(fn)
+        width, height = image.size
+        ret = None
+        for y in range(0, height, rows):
+            band = strips.crop(0, y, width, min(y + rows, height))
+            if ret is None:
+                palette = band.getpalette() if band.mode == 'P' else None
+                ret = SharedImage(name,
+                                  band.mode,
+                                  image.size,
+                                  palette,
+                                  create=True)
+            ret.paste(band, 0, y)
+        return ret
+
+    def __getstate__(self):
+        return {
+            'name': self.name,
+            'mode': self.mode,
+            'size': self.size,
+            'palette': self._palette
+        }
+
+    def __setstate__(self, state):
+        self.__init__(state['name'], state['mode'], state['size'],
+                      state['palette'])
+
+    def buf(self):
+        if self.shm is None:
+            self.shm = shared_memory.SharedMemory(name=self.name)
+        return self.shm.buf
+
+    def width(self):
+        return self.size[0]
+
+    def height(self):
+        return self.size[1]
+
+    def get_mode(self):
+        return self.mode
+
+    def palette(self):
+        return self._palette
+
+    def crop(self, x0, y0, x1, y1):
+        start = y0 * self.stride + x0 * self.bpp
+        end = (y1 - 1) * self.stride + x1 * self.bpp
+        ret = Image.frombytes(self.mode, (x1 - x0, y1 - y0),
+                              self.buf()[start:end], 'raw', self.mode,
+                              self.stride, 1)
+        if self._palette:
+            ret.putpalette(self._palette)
+        return ret
+
+    def paste(self, image, x, y):
+        '''Write image into the shared buffer with its upper left at x, y'''
+        data = image.tobytes()
+        buf = self.buf()
+        n = image.size[0] * self.bpp
+        for row in range(image.size[1]):
+            start = (y + row) * self.stride + x * self.bpp
+            buf[start:start + n] = data[row * n:(row + 1) * n]
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+
+    def unlink(self):
+        self.buf()
+        self.shm.unlink()
+        self.close()
+
+
+def spool_strips(fn, spool_fn):
+    '''
+    Decode fn once into an uncompressed TIFF at spool_fn and stream strips from that
+    The whole image is only held while writing it out, not while tiling
+    '''
+    image = Image.open(fn)
+    image.save(spool_fn, format='TIFF', compression='raw')
+    image.close()
+    return FileStrips(spool_fn)
+
+
+def open_strips(fn):
+    '''Stream fn if its layout allows it, otherwise fall back to decoding the whole image'''
+    image = Image.open(fn)
+    if can_stream(image):
+        return FileStrips(fn)
+    print('WARNING: %s (%s) cannot be streamed, decoding whole image' %
+          (fn, image.format))
+    return ImageStrips(image)
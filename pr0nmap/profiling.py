@@ -0,0 +1,324 @@
+'''
+Profile the tiler across its worker processes
+
+Running main.py under cProfile only sees the parent waiting on queues
+With a Profiler every worker task runs under its own cProfile (and optionally tracemalloc)
+and sends the raw stats back to the parent, which merges them per stage (worker task) and level
+The parent's own dispatch loop is recorded as the parent stage
+
+Written to the output directory:
+<stage>[-l<level>].pstats, all.pstats: for pstats / snakeviz
+<stage>[-l<level>].collapsed, all.collapsed: folded stacks for flamegraph.pl / speedscope
+summary.txt: CPU seconds per stage split into decode / resample / encode / filesystem / wait / python
+and with memory on, peak traced bytes per task and the lines that allocated the most
+
+cProfile only records callers, not whole stacks, so folded stacks deeper than one call
+split a function's time between its callers in proportion to what each caller saw
+'''
+
+import collections
+import contextlib
+import cProfile
+import os
+import pstats
+import re
+import threading
+import tracemalloc
+
+# Where self time goes, first match of the function's label wins
+# Most of the pixel work is C code called from PIL / NumPy, which cProfile sees as builtins
+CATEGORIES = (
+    ('decode', re.compile(r"ImagingDecoder")),
+    ('encode', re.compile(r"ImagingEncoder")),
+    ('resample',
+     re.compile(r"of 'ImagingCore' objects>|numpy|pr0nmap/reduce\.py")),
+    ('wait',
+     re.compile(r"_thread\.lock|select\.|poll|time\.sleep|multiprocessing/")),
+    ('filesystem',
+     re.compile(r"posix\.|io\.open|_io\.|sqlite3|shutil|mmap|os\.py")),
+)
+# Reported when nothing above matches
+OTHER = 'python'
+# Folded stacks stop here, deep recursion isn't worth the output
+MAX_DEPTH = 64
+# Top functions / allocation sites per stage in summary.txt
+TOP = 15
+
+
+def func_label(func):
+    '''pstats (file, line, name) key => one line label'''
+    fn, line, name = func
+    if fn == '~':
+        # Builtin, name is already descriptive: <method 'decode' of 'ImagingDecoder' objects>
+        return name
+    return '%s:%d(%s)' % (fn, line, name)
+
+
+def func_category(func):
+    label = func_label(func)
+    for category, regex in CATEGORIES:
+        if regex.search(label):
+            return category
+    return OTHER
+
+
+class RawStats(object):
+    '''Lets pstats.Stats load a stats dict that came from another process'''
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Capture(object):
+    '''cProfile (and tracemalloc) over one piece of work in this process'''
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.profile = cProfile.Profile()
+        self.snapshot = None
+        # Started tracemalloc ourselves, so stop it afterwards
+        self.own_trace = False
+
+    def start(self):
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.own_trace = True
+            self.snapshot = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+        self.profile.enable()
+
+    def pause(self):
+        self.profile.disable()
+
+    def resume(self):
+        self.profile.enable()
+
+    def stop(self):
+        '''Returns picklable results for Profiler.add()'''
+        self.profile.disable()
+        ret = {}
+        if self.memory:
+            _current, peak = tracemalloc.get_traced_memory()
+            # Leave out the profilers' own bookkeeping
+            filters = [
+                tracemalloc.Filter(False, fn)
+                for fn in (tracemalloc.__file__, cProfile.__file__,
+                           pstats.__file__, __file__)
+            ]
+            diff = tracemalloc.take_snapshot().filter_traces(
+                filters).compare_to(self.snapshot.filter_traces(filters),
+                                    'lineno')
+            if self.own_trace:
+                tracemalloc.stop()
+            self.snapshot = None
+            ret['peak'] = peak
+            # Lines that allocated the most still alive at the end of the task
+            ret['allocs'] = [(str(stat.traceback), stat.size_diff)
+                             for stat in diff[:TOP] if stat.size_diff > 0]
+        self.profile.create_stats()
+        ret['stats'] = self.profile.stats
+        return ret
+
+
+class Profiler(object):
+
+    def __init__(self, out_dir, memory=False):
+        self.out_dir = out_dir
+        # Also trace Python allocations
+        self.memory = memory
+        # (stage, level) => pstats.Stats
+        self.stats = {}
+        # (stage, level) => tasks recorded
+        self.tasks = collections.Counter()
+        # (stage, level) => largest peak traced bytes of any task
+        self.peak = {}
+        # (stage, level) => Counter of allocation site => bytes
+        self.allocs = {}
+        # .active: Capture running in this thread, paused while merging so the merges don't count
+        self.local = threading.local()
+        # Maps may be built from several threads at once
+        self.lock = threading.Lock()
+
+    def worker_mode(self):
+        '''TWorker profile setting'''
+        return 'memory' if self.memory else 'cpu'
+
+    def capture(self):
+        return Capture(memory=self.memory)
+
+    @contextlib.contextmanager
+    def measure(self, stage, level=None):
+        '''Profile the with block in this process as stage'''
+        capture = self.capture()
+        outer = getattr(self.local, 'active', None)
+        if outer:
+            outer.pause()
+        self.local.active = capture
+        capture.start()
+        try:
+            yield
+        finally:
+            self.local.active = outer
+            self.add(stage, level, capture.stop())
+            if outer:
+                outer.resume()
+
+    def add(self, stage, level, data):
+        '''Merge a Capture.stop() result, possibly from another process'''
+        active = getattr(self.local, 'active', None)
+        if active:
+            active.pause()
+        with self.lock:
+            self.merge((stage, level), data)
+        if active:
+            active.resume()
+
+    def merge(self, key, data):
+        stats = self.stats.get(key)
+        if stats is None:
+            self.stats[key] = pstats.Stats(RawStats(data['stats']))
+        else:
+            stats.add(RawStats(data['stats']))
+        self.tasks[key] += 1
+        if 'peak' in data:
+            self.peak[key] = max(self.peak.get(key, 0), data['peak'])
+            allocs = self.allocs.setdefault(key, collections.Counter())
+            for site, size in data['allocs']:
+                allocs[site] += size
+
+    def name(self, key):
+        stage, level = key
+        if level is None:
+            return stage
+        return '%s-l%d' % (stage, level)
+
+    def keys(self):
+        '''Stages in the order they ran, parent last'''
+        return sorted(self.stats.keys(),
+                      key=lambda key: (key[0] == 'parent', -1
+                                       if key[1] is None else -key[1], key[0]))
+
+    def merged(self):
+        '''Every worker stage in one pstats.Stats'''
+        ret = None
+        for key in self.keys():
+            if key[0] == 'parent':
+                continue
+            if ret is None:
+                ret = pstats.Stats(RawStats(dict(self.stats[key].stats)))
+            else:
+                ret.add(self.stats[key])
+        return ret
+
+    def categories(self, stats):
+        '''{category: self seconds}'''
+        ret = collections.Counter()
+        for func, (_cc, _nc, tt, _ct, _callers) in stats.stats.items():
+            ret[func_category(func)] += tt
+        return ret
+
+    def write(self):
+        '''Write every stage's pstats / folded stacks and the summary, returns the summary'''
+        with self.lock:
+            if not os.path.exists(self.out_dir):
+                os.makedirs(self.out_dir)
+            outputs = [(self.name(key), self.stats[key])
+                       for key in self.keys()]
+            merged = self.merged()
+            if merged:
+                outputs.append(('all', merged))
+            for name, stats in outputs:
+                stats.dump_stats(os.path.join(self.out_dir, name + '.pstats'))
+                write_collapsed(
+                    stats, os.path.join(self.out_dir, name + '.collapsed'))
+            summary = self.summary()
+            with open(os.path.join(self.out_dir, 'summary.txt'), 'w') as f:
+                f.write(summary)
+            return summary
+
+    def summary(self):
+        names = [category for category, _regex in CATEGORIES] + [OTHER]
+        lines = []
+        header = '%-16s %6s %9s' % ('stage', 'tasks', 'cpu s') + ''.join(
+            ' %10s' % name for name in names)
+        if self.peak:
+            header += ' %12s' % 'peak bytes'
+        lines.append(header)
+        for key in self.keys():
+            stats = self.stats[key]
+            categories = self.categories(stats)
+            total = sum(categories.values()) or 1
+            line = '%-16s %6u %9.2f' % (self.name(key), self.tasks[key],
+                                        stats.total_tt) + ''.join(
+                                            ' %9.1f%%' %
+                                            (100.0 * categories[name] / total)
+                                            for name in names)
+            if self.peak:
+                line += ' %12s' % self.peak.get(key, '')
+            lines.append(line)
+        for key in self.keys():
+            stats = self.stats[key]
+            lines.append('')
+            lines.append('%s: top functions by self time' % self.name(key))
+            top = sorted(stats.stats.items(), key=lambda kv: -kv[1][2])[:TOP]
+            for func, (_cc, nc, tt, ct, _callers) in top:
+                lines.append(
+                    '  %9.3f s self %9.3f s cum %9u calls  %-10s %s' %
+                    (tt, ct, nc, func_category(func), func_label(func)))
+            allocs = self.allocs.get(key)
+            if allocs:
+                lines.append('%s: top live allocations after each task' %
+                             self.name(key))
+                for site, size in allocs.most_common(TOP):
+                    lines.append('  %12u bytes  %s' % (size, site))
+        return '\n'.join(lines) + '\n'
+
+
+def collapsed(stats):
+    '''
+    pstats.Stats => {folded stack: self microseconds}
+    Each function's time is split between its callers by the cumulative time each one saw
+    '''
+    stats = stats.stats
+    callees = {}
+    for func, (_cc, _nc, _tt, _ct, callers) in stats.items():
+        for caller in callers:
+            callees.setdefault(caller, []).append(func)
+    ret = collections.Counter()
+
+    def walk(func, path, on_path, scale):
+        _cc, _nc, tt, ct, _callers = stats[func]
+        path = path + (func_label(func).replace(';', ','), )
+        us = tt * scale * 1e6
+        if us >= 1:
+            ret[';'.join(path)] += us
+        if len(path) >= MAX_DEPTH:
+            return
+        on_path = on_path | {func}
+        for callee in callees.get(func, ()):
+            callee_ct = stats[callee][3]
+            if callee in on_path or not callee_ct:
+                continue
+            # Cumulative time callee spent when called from func
+            edge_ct = stats[callee][4][func][3]
+            callee_scale = scale * edge_ct / callee_ct
+            if callee_ct * callee_scale * 1e6 < 1:
+                continue
+            walk(callee, path, on_path, callee_scale)
+
+    for func, (_cc, _nc, _tt, _ct, callers) in stats.items():
+        # Called from where profiling was turned on, less the profiler turning itself off
+        if not callers and func[0] != __file__ and 'disable' not in func[2]:
+            walk(func, (), frozenset(), 1.0)
+    return ret
+
+
+def write_collapsed(stats, fn):
+    with open(fn, 'w') as f:
+        for stack, us in sorted(collapsed(stats).items()):
+            if int(us):
+                f.write('%s %d\n' % (stack, us))
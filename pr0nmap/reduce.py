@@ -0,0 +1,158 @@
+'''
+Fixed 2:1 reduction of 2x2 tile quads into parent tiles
+
+The pil kernel is the original path: paste the quad into a 2x canvas and
+run PIL's general purpose LANCZOS resize on it
+The box kernel averages each 2x2 block of a batch of quads as one NumPy array, for previews
+The draft kernel decodes JPEG children at half scale (libjpeg DCT scaling)
+and pastes them straight into the parent, skipping the 2x canvas and the resample
+Non-JPEG children are box filtered instead
+
+NumPy is optional, without it only the pil and draft kernels are available
+
+Benchmark against the original path with python3 -m pr0nmap.reduce
+'''
+
+from pr0nmap import pimage
+
+import io
+import time
+from PIL import Image
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+KERNELS = ('pil', 'draft', 'box')
+# Modes that can be averaged channel by channel
+MODES = ('L', 'LA', 'RGB', 'RGBA')
+# Quads filtered at once, bounds the working set
+CHUNK = 16
+
+
+def check_kernel(kernel):
+    if kernel not in KERNELS:
+        raise ValueError('Unknown reduce kernel %s' % kernel)
+    if kernel not in ('pil', 'draft') and np is None:
+        raise ValueError('reduce kernel %s requires numpy' % kernel)
+
+
+def reduce_array(a, kernel):
+    '''(quads, 2 * th, 2 * tw, bands) uint8 => (quads, th, tw, bands) uint8'''
+    if kernel != 'box':
+        raise ValueError('Unknown reduce kernel %s' % kernel)
+    a = a.astype(np.uint16)
+    s = a[:, 0::2, 0::2] + a[:, 1::2, 0::2] + a[:, 0::2, 1::2] + a[:, 1::2,
+                                                                   1::2]
+    return ((s + 2) >> 2).astype(np.uint8)
+
+
+def load_quad(srcs, tw, th):
+    '''
+    2x2 file names / images / None => (mode, 2 * th x 2 * tw x bands array)
+    Missing tiles are filled in the same way as pimage.from_fns
+    '''
+    mode = None
+    ret = None
+    last = None
+    for r in range(2):
+        for c in range(2):
+            src = srcs[r][c]
+            if src is None:
+                # Before any real tile, stays black
+                if last is not None:
+                    ret[r * th:(r + 1) * th,
+                        c * tw:(c + 1) * tw] = last[th - 1, tw - 1]
+                continue
+            im = pimage.open_image(src)
+            if mode is None:
+                mode = im.mode
+                if mode not in MODES:
+                    return mode, None
+            elif im.mode != mode:
+                raise Exception('mode mismatch')
+            if im.size != (tw, th):
+                raise Exception('tile size mismatch: %s vs %s' % (im.size,
+                                                                  (tw, th)))
+            last = np.asarray(im).reshape(th, tw, -1)
+            if ret is None:
+                ret = np.zeros((2 * th, 2 * tw, last.shape[2]), dtype=np.uint8)
+            ret[r * th:(r + 1) * th, c * tw:(c + 1) * tw] = last
+    return mode, ret
+
+
+def shrink_pil(srcs, tw, th):
+    img_full = pimage.from_fns(srcs, tw=tw, th=th)
+    #img_full = pimage.im_reload(img_full)
+    return pimage.rescale(img_full, 0.5, filt=Image.LANCZOS)
+
+
+def shrink_draft(srcs, tw, th):
+    if tw % 2 or th % 2:
+        # Half size children wouldn't tile the parent exactly
+        return shrink_pil(srcs, tw, th)
+    return pimage.from_fns(srcs, tw=tw, th=th, half=True)
+
+
+def reduce_quads(quads, kernel, tw, th):
+    '''
+    Yield a tw x th parent tile for each 2x2 array of children in quads
+    quads may be a generator, only CHUNK quads are loaded at a time
+    '''
+    if kernel == 'pil':
+        for srcs in quads:
+            yield shrink_pil(srcs, tw, th)
+        return
+    elif kernel == 'draft':
+        for srcs in quads:
+            yield shrink_draft(srcs, tw, th)
+        return
+
+    def flush(arrays):
+        for a in reduce_array(np.stack(arrays), kernel):
+            yield Image.fromarray(a[:, :, 0] if a.shape[2] == 1 else a)
+
+    arrays = []
+    for srcs in quads:
+        mode, a = load_quad(srcs, tw, th)
+        if a is None:
+            # Palette and such, can't filter the raw values
+            yield from flush(arrays) if arrays else ()
+            arrays = []
+            yield shrink_pil(srcs, tw, th)
+            continue
+        arrays.append(a)
+        if len(arrays) >= CHUNK:
+            yield from flush(arrays)
+            arrays = []
+    if arrays:
+        yield from flush(arrays)
+
+
+def benchmark(n=256, tw=250, th=250):
+    '''Parent tiles / second for each kernel on noisy RGB JPEG children, decode included'''
+    rand = np.random.default_rng(0)
+    children = []
+    for _i in range(4):
+        f = io.BytesIO()
+        Image.fromarray(rand.integers(0, 256, (th, tw, 3),
+                                      dtype=np.uint8)).save(f,
+                                                            format='JPEG',
+                                                            quality=90)
+        children.append(f.getvalue())
+
+    def quads():
+        for _i in range(n):
+            ims = [Image.open(io.BytesIO(data)) for data in children]
+            yield [ims[0:2], ims[2:4]]
+
+    for kernel in KERNELS:
+        tstart = time.time()
+        for _im in reduce_quads(quads(), kernel, tw, th):
+            pass
+        dt = time.time() - tstart
+        print('%-8s %8.1f tiles / sec' % (kernel, n / dt))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,563 @@
+'''
+Where tiles end up
+DirStore is the classic one file per tile layout (gmap / groupxiv naming)
+SqliteStore puts the whole pyramid in one MBTiles style database so a map is a single file
+PackStore builds a pack.py archive for serving
+
+Stores are pickled into worker tasks
+They only carry their location, each process opens its own handles on first use
+Workers close theirs after every task, see close_connections()
+
+With dedupe set, identical tiles (ex: blank margins) are only stored once
+and identical images are only encoded once per process
+
+Format and quality settings come from the store's encoder.Encoder
+Source tiles in another format are re-encoded instead of copied
+
+DirStore can place already encoded source tiles with hardlinks, reflinks or
+copy_file_range instead of copying them through userspace, see link_file()
+'''
+
+from pr0nmap import tile_name
+from pr0nmap import pack
+from pr0nmap import encoder as tile_encoder
+
+import collections
+import errno
+import fcntl
+import hashlib
+import io
+import os
+import shutil
+import sqlite3
+import threading
+import uuid
+from PIL import Image
+
+# What stores unpickled in this process wrote (tiles, bytes, ...)
+# workers report theirs to the tiler after each task and when they exit
+stats = collections.Counter()
+
+# Ways to place a source tile file, fastest first
+# Each falls back to the next one if the filesystem can't do it
+LINK_MODES = ('hardlink', 'reflink', 'copy_file_range', 'copy')
+# linux/fs.h
+FICLONE = 0x40049409
+# Errors meaning "this filesystem / kernel can't do that here", not a bad source
+LINK_FALLBACK_ERRNOS = set(
+    getattr(errno, name)
+    for name in ('EXDEV', 'EPERM', 'EOPNOTSUPP', 'ENOTSUP', 'ENOTTY', 'EINVAL',
+                 'ENOSYS', 'EMLINK', 'ETXTBSY') if hasattr(errno, name))
+
+
+def data_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def reflink(src_fn, dst_fn):
+    '''Copy on write clone (btrfs, XFS, ...), no data is copied'''
+    with open(src_fn, 'rb') as fsrc:
+        try:
+            with open(dst_fn, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except BaseException:
+            # Don't leave a partial file for the next mode to trip on
+            os.unlink(dst_fn)
+            raise
+
+
+def copy_file_range(src_fn, dst_fn):
+    '''Copy in the kernel (or server side on NFS / CIFS), never through userspace'''
+    with open(src_fn, 'rb') as fsrc:
+        try:
+            with open(dst_fn, 'wb') as fdst:
+                size = os.fstat(fsrc.fileno()).st_size
+                while size > 0:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size)
+                    if n == 0:
+                        break
+                    size -= n
+        except BaseException:
+            os.unlink(dst_fn)
+            raise
+
+
+def link_file(src_fn, dst_fn, mode='copy'):
+    '''
+    Place src_fn at dst_fn (which must not exist) using mode or whatever comes after it in LINK_MODES
+    Returns the mode that worked
+    '''
+    funcs = {
+        'hardlink': os.link,
+        'reflink': reflink,
+        'copy_file_range': copy_file_range,
+        'copy': shutil.copyfile,
+    }
+    for mode in LINK_MODES[LINK_MODES.index(mode):]:
+        if mode == 'copy_file_range' and not hasattr(os, 'copy_file_range'):
+            continue
+        try:
+            funcs[mode](src_fn, dst_fn)
+            return mode
+        except OSError as e:
+            if mode == 'copy' or e.errno not in LINK_FALLBACK_ERRNOS:
+                raise
+
+
+# Store id => (pixel hash => encoded tile, content hash => file) dedupe caches
+# Module level so they last for the whole build, not just the store copy unpickled with each task
+_dedupe_caches = collections.OrderedDict()
+# Builds to keep dedupe caches for, the daemon runs several through the same workers
+DEDUPE_CACHE_STORES = 4
+
+
+def dedupe_caches(store_id):
+    caches = _dedupe_caches.get(store_id)
+    if caches is None:
+        caches = (collections.OrderedDict(), collections.OrderedDict())
+        _dedupe_caches[store_id] = caches
+        while len(_dedupe_caches) > DEDUPE_CACHE_STORES:
+            _dedupe_caches.popitem(last=False)
+    else:
+        _dedupe_caches.move_to_end(store_id)
+    return caches
+
+
+def print_link_stats(counts):
+    print('Link: ' + ', '.join('%u %s' % (counts['link_' + mode], mode)
+                               for mode in LINK_MODES))
+
+
+def print_stats(counts):
+    '''counts: stats summed over every process'''
+    print(
+        'Dedupe: %u / %u tiles were duplicates, saved %0.1f MB and %u encodes'
+        % (counts['dedupe_tiles'], counts['tiles'],
+           counts['dedupe_bytes'] / 1e6, counts['dedupe_encodes']))
+
+
+class TileStore(object):
+
+    def __init__(self, im_ext, dedupe=False, encoder=None):
+        assert im_ext
+        self.im_ext = im_ext
+        if encoder is None:
+            encoder = tile_encoder.Encoder(im_ext)
+        assert encoder.im_ext == im_ext
+        self.encoder = encoder
+        self.dedupe = dedupe
+        # Tells this build's dedupe caches and connections apart from other builds'
+        # Pickled along with the store so every worker's copy shares them
+        self.id = uuid.uuid4().hex
+        # What this copy wrote (tiles, bytes, ...)
+        # Own counters in the tiler so concurrent builds don't mix, the module's in workers
+        self.stats = collections.Counter()
+        self.encoded_max = 64
+
+    def create(self):
+        '''Called by the tiler before writing anything'''
+        pass
+
+    def encode(self, im, level=None):
+        '''im => tile bytes, level selects per level settings'''
+        if self.dedupe:
+            h = hashlib.sha1(
+                ('%s %u %u %r ' % (im.mode, im.size[0], im.size[1],
+                                   self.encoder.key(level))).encode())
+            h.update(im.tobytes())
+            key = h.digest()
+            # Most recently used pixel hash => encoded tile
+            encoded = dedupe_caches(self.id)[0]
+            data = encoded.get(key)
+            if data is not None:
+                encoded.move_to_end(key)
+                self.stats['dedupe_encodes'] += 1
+                return data
+        data = self.encoder.encode(im, level)
+        if self.dedupe:
+            encoded[key] = data
+            if len(encoded) > self.encoded_max:
+                encoded.popitem(last=False)
+        return data
+
+    def save(self, level, row, col, im):
+        '''Encode im as the tile at level, row, col'''
+        self.put(level, row, col, self.encode(im, level))
+
+    def put(self, level, row, col, data):
+        '''Store already encoded tile bytes'''
+        raise Exception("Implement")
+
+    def get(self, level, row, col):
+        '''Encoded tile bytes, None if missing'''
+        raise Exception("Implement")
+
+    def open(self, level, row, col):
+        '''Tile as a (lazily loaded) image'''
+        return Image.open(io.BytesIO(self.get(level, row, col)))
+
+    def copy_file(self, level, row, col, src_fn):
+        '''Store the already encoded tile file src_fn'''
+        if not self.encoder.can_copy(src_fn):
+            self.save(level, row, col, Image.open(src_fn))
+            return
+        with open(src_fn, 'rb') as f:
+            self.put(level, row, col, f.read())
+
+    def flush(self):
+        '''Make everything written so far visible to other processes'''
+        pass
+
+    def finish(self):
+        '''Called by the tiler once every level is written'''
+        pass
+
+    def manifest_fn(self):
+        raise Exception("Implement")
+
+
+class DirStore(TileStore):
+    '''Duplicates are hardlinked to the first copy this process wrote during the build'''
+
+    def __init__(self,
+                 basedir,
+                 get_tile_name,
+                 im_ext,
+                 dedupe=False,
+                 encoder=None,
+                 link_mode='copy'):
+        TileStore.__init__(self, im_ext, dedupe, encoder)
+        self.basedir = basedir
+        # How copy_file() places source tiles, see LINK_MODES
+        assert link_mode in LINK_MODES
+        self.link_mode = link_mode
+        self.get_tile_name = get_tile_name
+        # Unlink old tiles instead of writing through them
+        # They may be hardlinked to other tiles by an earlier deduped run
+        self.replace = dedupe
+        self.links_max = 1024
+
+    def __getstate__(self):
+        return (self.basedir, tile_name.str_get_tile_name(self.get_tile_name),
+                self.im_ext, self.dedupe, self.encoder, self.link_mode,
+                self.replace, self.id)
+
+    def __setstate__(self, state):
+        basedir, name, im_ext, dedupe, encoder, link_mode, replace, id_ = state
+        self.__init__(basedir, tile_name.mk_get_tile_name(name), im_ext,
+                      dedupe, encoder, link_mode)
+        self.replace = replace
+        self.id = id_
+        self.stats = stats
+
+    def fn(self, level, row, col):
+        return self.get_tile_name(self.basedir, level, row, col, self.im_ext)
+
+    def create(self):
+        if not os.path.exists(self.basedir):
+            os.mkdir(self.basedir)
+
+    def remove(self, fn):
+        try:
+            os.unlink(fn)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def link(self, fn, data):
+        '''Hardlink fn to an earlier tile with the same data, False if there isn't one'''
+        h = data_hash(data)
+        # Most recently used content hash => file with that content
+        links = dedupe_caches(self.id)[1]
+        src = links.get(h)
+        if src:
+            try:
+                os.link(src, fn)
+                links.move_to_end(h)
+                self.stats['dedupe_tiles'] += 1
+                self.stats['dedupe_bytes'] += len(data)
+                return True
+            except OSError:
+                # Ex: src got replaced, or different filesystems
+                pass
+        links[h] = fn
+        if len(links) > self.links_max:
+            links.popitem(last=False)
+        return False
+
+    def save(self, level, row, col, im):
+        if self.dedupe:
+            self.put(level, row, col, self.encode(im, level))
+            return
+        fn = self.fn(level, row, col)
+        if self.replace:
+            self.remove(fn)
+        with open(fn, 'wb') as f:
+            self.encoder.save(im, f, level)
+            self.stats['bytes'] += f.tell()
+        self.stats['tiles'] += 1
+
+    def put(self, level, row, col, data):
+        fn = self.fn(level, row, col)
+        self.stats['tiles'] += 1
+        self.stats['bytes'] += len(data)
+        if self.replace:
+            self.remove(fn)
+        if self.dedupe and self.link(fn, data):
+            return
+        with open(fn, 'wb') as f:
+            f.write(data)
+
+    def get(self, level, row, col):
+        try:
+            with open(self.fn(level, row, col), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def open(self, level, row, col):
+        return Image.open(self.fn(level, row, col))
+
+    def copy_file(self, level, row, col, src_fn):
+        dst_fn = self.fn(level, row, col)
+        os.makedirs(os.path.dirname(dst_fn), exist_ok=True)
+        if self.dedupe or not self.encoder.can_copy(src_fn):
+            TileStore.copy_file(self, level, row, col, src_fn)
+            return
+        if self.replace or self.link_mode != 'copy':
+            # Don't write through an old link into some other file
+            self.remove(dst_fn)
+        self.stats['link_' + link_file(src_fn, dst_fn, self.link_mode)] += 1
+        self.stats['tiles'] += 1
+        self.stats['bytes'] += os.path.getsize(dst_fn)
+
+    def manifest_fn(self):
+        return os.path.join(self.basedir, 'manifest.json')
+
+
+# (pid, thread, store id) => connection so each worker opens a database once, not once per task
+# sqlite connections can't move between threads and each store (map build) gets its own
+_connections = {}
+
+
+def close_connections():
+    '''
+    Close every connection this thread has open
+    Workers call this after each task so that a finished build's database
+    has no other connections left when the tiler checkpoints it
+    '''
+    here = (os.getpid(), threading.get_ident())
+    for key, (_fn, conn) in list(_connections.items()):
+        if key[:2] == here:
+            conn.close()
+            del _connections[key]
+
+
+class SqliteStore(TileStore):
+    '''
+    MBTiles style schema: map + images tables behind a tiles view
+    Unlike MBTiles, zoom_level is our level and tile_row counts down from the top
+    With dedupe, tile_id is a content hash so identical tiles share one images row
+    '''
+
+    def __init__(self, fn, im_ext, dedupe=False, batch=256, encoder=None):
+        TileStore.__init__(self, im_ext, dedupe, encoder)
+        self.fn = fn
+        # Tiles to insert per transaction
+        self.batch = batch
+        # (level, row, col) => data waiting on the next transaction
+        self.pending = {}
+
+    def __getstate__(self):
+        return (self.fn, self.im_ext, self.dedupe, self.batch, self.encoder,
+                self.id)
+
+    def __setstate__(self, state):
+        self.__init__(*state[:-1])
+        self.id = state[-1]
+        self.stats = stats
+
+    def db_key(self):
+        return (os.getpid(), threading.get_ident(), self.id)
+
+    def db(self):
+        key = self.db_key()
+        conn = _connections.get(key)
+        if conn is None:
+            # Drop handles this thread still has on an earlier build's (maybe deleted) database
+            for old_key, (old_fn, old_conn) in list(_connections.items()):
+                if old_key[:2] == key[:2] and old_fn == self.fn:
+                    old_conn.close()
+                    del _connections[old_key]
+            # Workers insert in parallel, wait on each other's transactions
+            conn = sqlite3.connect(self.fn, timeout=600)
+            _connections[key] = (self.fn, conn)
+            return conn
+        return conn[1]
+
+    def close(self):
+        '''Close this thread's connection, the next db() opens a new one'''
+        conn = _connections.pop(self.db_key(), None)
+        if conn is not None:
+            conn[1].close()
+
+    def create(self):
+        conn = self.db()
+        # Readers don't block the writer and vice versa
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT)'
+        )
+        conn.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row)'
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB)'
+        )
+        conn.execute(
+            'CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row, images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id'
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)'
+        )
+        conn.execute(
+            'INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)',
+            ('format', self.im_ext.replace('.', '')))
+        conn.commit()
+
+    def put(self, level, row, col, data):
+        self.pending[(level, row, col)] = data
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def get(self, level, row, col):
+        data = self.pending.get((level, row, col))
+        if data is not None:
+            return data
+        row = self.db().execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+            (level, col, row)).fetchone()
+        if row is None:
+            return None
+        return bytes(row[0])
+
+    def flush(self):
+        if not self.pending:
+            return
+        conn = self.db()
+        with conn:
+            for (level, row, col), data in self.pending.items():
+                self.stats['tiles'] += 1
+                self.stats['bytes'] += len(data)
+                if self.dedupe:
+                    tile_id = data_hash(data)
+                else:
+                    tile_id = '%u/%u/%u' % (level, col, row)
+                conn.execute(
+                    'INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)',
+                    (level, col, row, tile_id))
+                if not self.dedupe:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO images (tile_id, tile_data) VALUES (?, ?)',
+                        (tile_id, sqlite3.Binary(data)))
+                # Same content as a tile already stored
+                elif not conn.execute(
+                        'INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)',
+                    (tile_id, sqlite3.Binary(data))).rowcount:
+                    self.stats['dedupe_tiles'] += 1
+                    self.stats['dedupe_bytes'] += len(data)
+        self.pending = {}
+
+    def finish(self):
+        self.flush()
+        # Tiles replaced by an incremental run may have left images nothing refers to
+        with self.db() as conn:
+            conn.execute(
+                'DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)'
+            )
+        # Fold the WAL back in so the map is the .mbtiles file alone, no -wal / -shm
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.execute('PRAGMA journal_mode=DELETE')
+        self.close()
+
+    def manifest_fn(self):
+        return self.fn + '.manifest.json'
+
+
+class PackStore(SqliteStore):
+    '''
+    Tiles are spooled into a SqliteStore while the pyramid is built
+    and then packed in Z-order once everything is written
+    With dedupe, identical tiles share one copy in the archive
+    '''
+
+    def __init__(self, fn, im_ext, dedupe=False, batch=256, encoder=None):
+        SqliteStore.__init__(self, fn + '.spool', im_ext, dedupe, batch,
+                             encoder)
+        self.pack_fn = fn
+
+    def __getstate__(self):
+        return (self.pack_fn, self.im_ext, self.dedupe, self.batch,
+                self.encoder, self.id)
+
+    def create(self):
+        existed = os.path.exists(self.fn)
+        SqliteStore.create(self)
+        # Incremental runs rebuild on top of the last archive
+        if not existed and os.path.exists(self.pack_fn):
+            print('Unpacking %s' % self.pack_fn)
+            reader = pack.PackReader(self.pack_fn)
+            for level, row, col in reader.keys():
+                self.put(level, row, col, bytes(reader.get(level, row, col)))
+            self.flush()
+            reader.close()
+
+    def finish(self):
+        self.flush()
+        keys = [(level, row, col) for level, col, row in self.db().execute(
+            'SELECT zoom_level, tile_column, tile_row FROM map')]
+        tiles, size = pack.write_pack(self.pack_fn,
+                                      keys,
+                                      self.get,
+                                      dedupe=self.dedupe)
+        print('Packed %u tiles (%0.1f MB) into %s' %
+              (tiles, size / 1e6, self.pack_fn))
+        self.close()
+        for fn in (self.fn, self.fn + '-wal', self.fn + '-shm'):
+            if os.path.exists(fn):
+                os.unlink(fn)
+
+    def manifest_fn(self):
+        return self.pack_fn + '.manifest.json'
+
+
+def open_store(kind,
+               dst_basedir,
+               get_tile_name,
+               im_ext,
+               dedupe=False,
+               encoder=None,
+               link_mode='copy'):
+    '''
+    Store for the map's tiles, dst_basedir being where the directory layout would go
+    link_mode only applies to the dir store, the others always read source tiles in
+    '''
+    if kind == 'dir':
+        return DirStore(dst_basedir,
+                        get_tile_name,
+                        im_ext,
+                        dedupe,
+                        encoder=encoder,
+                        link_mode=link_mode)
+    elif kind == 'sqlite':
+        return SqliteStore(dst_basedir + '.mbtiles',
+                           im_ext,
+                           dedupe,
+                           encoder=encoder)
+    elif kind == 'pack':
+        return PackStore(dst_basedir + '.pack',
+                         im_ext,
+                         dedupe,
+                         encoder=encoder)
+    else:
+        raise ValueError('Unknown tile store %s' % kind)
@@ -7,8 +7,13 @@ Licensed under a 2 clause BSD license, see COPYING for details
 
 from pr0nmap import pimage
 from pr0nmap import tile_name
+from pr0nmap import manifest
+from pr0nmap import bitmap
+from pr0nmap import store as tile_store
+from pr0nmap import reduce as tile_reduce
+from pr0nmap import profiling
+from pr0nmap import budget
 
-import sys
 import os.path
 from PIL import Image
 
@@ -18,13 +23,17 @@ Image.MAX_IMAGE_PIXELS = None
 from PIL import ImageFile
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
-import shutil
 import math
 import queue
 import multiprocessing
+from multiprocessing import resource_tracker
 import traceback
 import time
+import collections
+import contextlib
 import errno
+import tempfile
+import threading
 
 
 def mkdir_p(path):
@@ -78,54 +87,122 @@ def calc_max_level(height, width, zoom_factor=None):
     return max_level
 
 
+def parse_region(s):
+    '''"x0,y0,x1,y1" => (x0, y0, x1, y1) pixel rectangle, x1 / y1 exclusive'''
+    try:
+        x0, y0, x1, y1 = [int(x) for x in s.split(',')]
+    except ValueError:
+        raise ValueError('Bad region %s, expected x0,y0,x1,y1' % s)
+    if x1 <= x0 or y1 <= y0 or x0 < 0 or y0 < 0:
+        raise ValueError('Empty region %s' % s)
+    return (x0, y0, x1, y1)
+
+
+def region_tiles(regions, tw, th, rows, cols):
+    '''Set of (row, col) of the tiles any of the pixel rectangles overlap'''
+    ret = set()
+    for x0, y0, x1, y1 in regions:
+        for row in range(y0 // th, min(rows, (y1 + th - 1) // th)):
+            for col in range(x0 // tw, min(cols, (x1 + tw - 1) // tw)):
+                ret.add((row, col))
+    return ret
+
+
+def get_tile_name_pr0nts(root_dir, row, col, im_ext):
+    return os.path.join(root_dir, "y%03u_x%03u%s" % (row, col, im_ext))
+
+
+def shrink_into(canvas, im, row, col):
+    '''Paste im at half size into canvas, the SharedImage of the next level down'''
+    tw, th = im.size
+    canvas.paste(pimage.rescale(im, 0.5, filt=Image.LANCZOS), col * tw // 2,
+                 row * th // 2)
+
+
+def record_solid(solid, im, row, col):
+    '''Note im in solid if it is a single color'''
+    color = pimage.solid_color(im)
+    if color:
+        solid[(row, col)] = (im.mode, color)
+
+
+def quad_solid(solid, tiles, rowb, colb):
+    '''
+    (mode, color) if the 2x2 children at rowb, colb shrink to a single color, else None
+    solid: {(row, col): (mode, color)} of single color children
+    tiles: TileBitmap of the children that exist
+    '''
+    # from_fns fills missing children with the color of an earlier one
+    ret = solid.get((rowb, colb))
+    if not ret:
+        return None
+    for r, c in ((0, 1), (1, 0), (1, 1)):
+        if tiles.has(rowb + r, colb + c) and solid.get(
+            (rowb + r, colb + c)) != ret:
+            return None
+    return ret
+
+
 '''
 Take a single large image and break it into tiles
+Works row major one strip at a time so that a streaming strip source
+only ever needs image width x tile height pixels in memory
 '''
 
 
 class ImageTiler(object):
 
-    def __init__(self,
-                 pim,
-                 level,
-                 dst_dir,
-                 tw=250,
-                 th=250,
-                 im_ext=None,
-                 get_tile_name=None):
-        assert im_ext
+    def __init__(self, strips, level, store, tw=250, th=250, canvas=None):
         self.verbose = False
-        self.pim = pim
+        # A pimage strip source (ImageStrips, FileStrips, etc)
+        self.strips = strips
+        # If set, SharedImage of the next level to shrink tiles into
+        self.canvas = canvas
         self.level = level
-        self.get_tile_name = get_tile_name
-        self.progress_inc = 0.10
+        # TileStore to write to
+        self.store = store
 
         self.x0 = 0
-        self.x1 = pim.width()
+        self.x1 = strips.width()
         self.y0 = 0
-        self.y1 = pim.height()
+        self.y1 = strips.height()
 
         self.tw = tw
         self.th = th
-        self.dst_dir = dst_dir
 
-        self.im_ext = im_ext
+        # Currently loaded strip and its (x0, y0, x1, y1) position in the source image
+        self.strip = None
+        self.strip_box = None
+        # If a dict, record {(row, col): fingerprint} of tiles made for the manifest
+        self.fps = None
+        # If a dict, record {(row, col): (mode, color)} of single color tiles made
+        self.solid = None
 
-    def make_tile(self, x, y, row, col):
+    def load_strip(self, y):
+        self.load_region(self.x0, y, self.x1, min(y + self.th, self.y1))
+
+    def load_region(self, x0, y0, x1, y1):
+        self.strip_box = (x0, y0, x1, y1)
+        self.strip = self.strips.crop(x0, y0, x1, y1)
+
+    def crop_tile(self, x, y):
         xmin = x
         ymin = y
         xmax = min(xmin + self.tw, self.x1)
         ymax = min(ymin + self.th, self.y1)
-        nfn = self.get_tile_name(self.dst_dir, self.level, row, col,
-                                 self.im_ext)
 
         #if self.verbose:
-        #print '%s: (x %d:%d, y %d:%d)' % (nfn, xmin, xmax, ymin, ymax)
+        #print '(x %d:%d, y %d:%d)' % (xmin, xmax, ymin, ymax)
 
-        im = self.pim.image.crop((xmin, ymin, xmax, ymax))
+        sx0, sy0, sx1, sy1 = self.strip_box or (0, 0, 0, 0)
+        if not (sx0 <= xmin and xmax <= sx1 and sy0 <= ymin and ymax <= sy1):
+            self.load_strip(y)
+            sx0, sy0, sx1, sy1 = self.strip_box
+        im = self.strip.crop((xmin - sx0, ymin - sy0, xmax - sx0, ymax - sy0))
 
-        if PALETTES and self.pim.image.palette:
-            im.putpalette(self.pim.image.palette)
+        palette = self.strips.palette()
+        if PALETTES and palette:
+            im.putpalette(palette)
             # XXX: workaround for PIL bug
             im = pimage.im_reload(im)
 
@@ -134,42 +211,74 @@ class ImageTiler(object):
             #print 'resizing', x, y
             #print im.size, self.tw, self.th
             im = pimage.resize(im, self.tw, self.th)
-        im.save(nfn)
+        return im
 
-    def run(self):
-        '''
-        Namer is a function that accepts the following arguments and returns a string:
-        namer(row, col)
-    
-        python can bind objects to functions so a user parameter isn't necessary?
-        '''
-        '''
-        if namer is None:
-            namer = google_namer
-        '''
+    def make_tile(self, x, y, row, col):
+        im = self.crop_tile(x, y)
+        self.store.save(self.level, row, col, im)
+        if self.canvas:
+            shrink_into(self.canvas, im, row, col)
+        if self.fps is not None:
+            self.fps[(row, col)] = manifest.pixel_fingerprint(im)
+        if self.solid is not None:
+            record_solid(self.solid, im, row, col)
+        return im
+
+    def run_row(self, row, cols=None):
+        '''Make all tiles in row or just the given cols'''
+        # Row major: each strip is decoded once, sliced up, and then dropped
+        y = self.y0 + row * self.th
+        if cols is None:
+            cols = range(len(range(self.x0, self.x1, self.tw)))
+            self.load_strip(y)
+        else:
+            self.load_region(self.x0 + min(cols) * self.tw, y,
+                             min(self.x0 + (max(cols) + 1) * self.tw, self.x1),
+                             min(y + self.th, self.y1))
+        for col in cols:
+            self.make_tile(self.x0 + col * self.tw, y, row, col)
+        self.strip = None
+        self.strip_box = None
 
-        col = 0
-        next_progress = self.progress_inc
-        processed = 0
-        n_images = len(list(range(self.x0, self.x1, self.tw))) * len(
-            list(range(self.y0, self.y1, self.th)))
-        for x in range(self.x0, self.x1, self.tw):
-            row = 0
-            for y in range(self.y0, self.y1, self.th):
-                self.make_tile(x, y, row, col)
-                row += 1
-                processed += 1
-                if self.progress_inc:
-                    cur_progress = 1.0 * processed / n_images
-                    if cur_progress >= next_progress:
-                        print('Progress: %02.2f%% %d / %d' %
-                              (cur_progress * 100, processed, n_images))
-                        next_progress += self.progress_inc
-            col += 1
+
+class DirBase(object):
+    '''
+    Base level that is already tiled (pr0nts y000_x000 naming)
+    Tiles are copied as is and only decoded if a worker needs their pixels
+    '''
+
+    def __init__(self, src_dir, im_ext, mode, tw, th):
+        self.src_dir = src_dir
+        self.im_ext = im_ext
+        # For filling in missing tiles
+        self.mode = mode
+        self.tw = tw
+        self.th = th
+
+    def src_fn(self, row, col):
+        return get_tile_name_pr0nts(self.src_dir, row, col, self.im_ext)
+
+    def copy_file(self, row, col, store, level):
+        '''Copy tile into store without decoding it, False if the source tile is missing'''
+        try:
+            store.copy_file(level, row, col, self.src_fn(row, col))
+        except IOError:
+            return False
+        return True
+
+    def copy_tile(self, row, col, store, level):
+        '''Copy tile into store and return its (lazily loaded) image'''
+        if not self.copy_file(row, col, store, level):
+            imblank = Image.new(self.mode, (self.tw, self.th))
+            store.save(level, row, col, imblank)
+            return imblank
+        return Image.open(self.src_fn(row, col))
 
 
 '''
-Only support tiled workers since unclear if full image can/should be parallelized
+Workers slice up the base level and shrink tiles into the next level
+The full image is parallelized by handing out rows of a strip source
+that each worker can read on its own (shared memory or a streamable file)
 '''
 
 
@@ -178,93 +287,495 @@ class TWorker(object):
     def __init__(
             self,
             ti,
+            qi,
             qo,
             im_ext,
             # tile width/height
             tw,
-            th):
+            th,
+            reduce='pil',
+            profile=None):
         self.process = multiprocessing.Process(target=self.run)
         self.ti = ti
 
-        self.qi = multiprocessing.Queue()
+        # (job, task batch)s shared by all workers, None to exit
+        self.qi = qi
         self.qo = qo
-        self.running = multiprocessing.Event()
+        # Job of the batch being worked on, results are tagged with it
+        self.job = None
 
         assert im_ext
         self.im_ext = im_ext
         self.tw = tw
         self.th = th
         self.zoom = 2.0
-
-    def submit(self, event, args):
-        self.qi.put((event, args))
+        # ((mode, color), encoder settings) => encoded single color tile
+        self.solid_tiles = {}
+        # Kernel for shrinking 2x2 children into a parent, see tile_reduce.KERNELS
+        self.reduce = reduce
+        # None, 'cpu' or 'memory' (cpu + tracemalloc): profile each task and send the stats back
+        self.profile = profile
 
     def complete(self, event, args):
-        self.qo.put((self.ti, event, args))
+        self.qo.put((self.ti, self.job, event, args))
 
     def task_subtile(self, val):
-        dst_basedir, dst_get_tile_name, dst_row, dst_cols, src_basedir, src_get_tile_name, src_level = val
+        store, dst_row, dst_cols, src_level, src_tiles, src_solid, src_canvas, dst_canvas = val
         src_rowb = 2 * dst_row
-        src_get_tile_name = tile_name.mk_get_tile_name(src_get_tile_name)
-        dst_get_tile_name = tile_name.mk_get_tile_name(dst_get_tile_name)
+        solid = {}
+        # Columns whose children need decoding
+        todo = []
+
+        def save(dst_col, img_scaled):
+            store.save(src_level - 1, dst_row, dst_col, img_scaled)
+            record_solid(solid, img_scaled, dst_row, dst_col)
+            if dst_canvas:
+                shrink_into(dst_canvas, img_scaled, dst_row, dst_col)
 
         # Workers are given 1 output row (2 input rows) at a time
-        for dst_col in range(dst_cols):
-            src_colb = 2 * dst_col
-
-            # Collapse 2x2
-            # XXX: how much faster would it be to actually know?
-            # Would we save anything given that occasionally I process broken sets?
-            # Just guess based on fn existing since its most foolproof anyway
-            # adjust to be more accurate if we have a reason to care
-            src_img_fns = [
-                [None, None],
-                [None, None],
-            ]
-            for src_col in range(src_colb, src_colb + 2):
-                for src_row in range(src_rowb, src_rowb + 2):
-                    fn = src_get_tile_name(src_basedir, src_level, src_row,
-                                           src_col, self.im_ext)
-                    src_img_fns[src_row - src_rowb][
-                        src_col -
-                        src_colb] = fn if os.path.exists(fn) else None
-
-            img_full = pimage.from_fns(src_img_fns, tw=self.tw, th=self.th)
-            #img_full = pimage.im_reload(img_full)
-            img_scaled = pimage.rescale(img_full, 0.5, filt=Image.LANCZOS)
-            dst_fn = dst_get_tile_name(dst_basedir, src_level - 1, dst_row,
-                                       dst_col, self.im_ext)
-            img_scaled.save(dst_fn)
+        for dst_col in dst_cols:
+            color = quad_solid(src_solid, src_tiles, src_rowb, 2 * dst_col)
+            if color:
+                # Shrinking a single color is a no-op, don't even decode
+                self.solid_tile(store, src_level - 1, dst_row, dst_col, color)
+                solid[(dst_row, dst_col)] = color
+                if dst_canvas:
+                    shrink_into(
+                        dst_canvas,
+                        Image.new(color[0], (self.tw, self.th), color[1]),
+                        dst_row, dst_col)
+                continue
+            # Children already shrunk themselves into our level
+            if src_canvas:
+                save(
+                    dst_col,
+                    src_canvas.crop(dst_col * self.tw, dst_row * self.th,
+                                    (dst_col + 1) * self.tw,
+                                    (dst_row + 1) * self.th))
+            else:
+                todo.append(dst_col)
+
+        # Shrink the rest of the row as one batch
+        quads = (self.subtile_fns(store, src_level, src_tiles, src_rowb,
+                                  2 * dst_col) for dst_col in todo)
+        for dst_col, img_scaled in zip(
+                todo,
+                tile_reduce.reduce_quads(quads, self.reduce, self.tw,
+                                         self.th)):
+            save(dst_col, img_scaled)
+
+        store.flush()
+        for canvas in (src_canvas, dst_canvas):
+            if canvas:
+                canvas.close()
+        return solid
+
+    def solid_tile(self, store, level, row, col, color):
+        '''Write a single color tile, only encoding each color once'''
+        key = (color, store.encoder.key(level))
+        data = self.solid_tiles.get(key)
+        if data is None:
+            data = store.encode(
+                Image.new(color[0], (self.tw, self.th), color[1]), level)
+            self.solid_tiles[key] = data
+        store.put(level, row, col, data)
+        store.stats['solid_tiles'] += 1
+
+    def subtile_fns(self, store, src_level, src_tiles, src_rowb, src_colb):
+        # 2x2 array of children to collapse
+        # src_tiles is a TileBitmap of what the tiler wrote, no need to stat
+        src_imgs = [
+            [None, None],
+            [None, None],
+        ]
+        for src_col in range(src_colb, src_colb + 2):
+            for src_row in range(src_rowb, src_rowb + 2):
+                if src_tiles.has(src_row, src_col):
+                    src_imgs[src_row -
+                             src_rowb][src_col - src_colb] = store.open(
+                                 src_level, src_row, src_col)
+
+        return src_imgs
+
+    def shrink_quad(self, srcs):
+        '''2x2 array of file names / images / None => half size tile'''
+        return next(
+            tile_reduce.reduce_quads([srcs], self.reduce, self.tw, self.th))
+
+    def task_block(self, val):
+        base, level, row0, col0, k, rcs, store, dst_canvas = val
+        n = 2**k
+        rows, cols = rcs[level]
+        row1 = min(row0 + n, rows)
+        col1 = min(col0 + n, cols)
+
+        # Base level
+        tiles = {}
+        if isinstance(base, DirBase):
+            for row in range(row0, row1):
+                for col in range(col0, col1):
+                    tiles[(row, col)] = base.copy_tile(row, col, store, level)
+        else:
+            tiler = ImageTiler(base, level, store, tw=self.tw, th=self.th)
+            # Only decode our corner of the image
+            tiler.load_region(col0 * self.tw, row0 * self.th,
+                              min(col1 * self.tw, tiler.x1),
+                              min(row1 * self.th, tiler.y1))
+            for row in range(row0, row1):
+                for col in range(col0, col1):
+                    tiles[(row,
+                           col)] = tiler.make_tile(col * self.tw,
+                                                   row * self.th, row, col)
+            if hasattr(base, 'close'):
+                base.close()
+
+        # Shrink the block down to a single tile
+        for _i in range(k):
+            solid = {}
+            for (row, col), im in tiles.items():
+                record_solid(solid, im, row, col)
+            present = bitmap.TileBitmap(rows, cols)
+            for row, col in tiles.keys():
+                present.set(row, col)
+            level -= 1
+            row0 //= 2
+            col0 //= 2
+            n //= 2
+            rows, cols = rcs[level]
+            parents = {}
+            for row in range(row0, min(row0 + n, rows)):
+                for col in range(col0, min(col0 + n, cols)):
+                    color = quad_solid(solid, present, 2 * row, 2 * col)
+                    if color:
+                        self.solid_tile(store, level, row, col, color)
+                        parents[(row,
+                                 col)] = Image.new(color[0],
+                                                   (self.tw, self.th),
+                                                   color[1])
+                        continue
+                    srcs = [[
+                        tiles.get((2 * row + r, 2 * col + c)) for c in range(2)
+                    ] for r in range(2)]
+                    im = self.shrink_quad(srcs)
+                    store.save(level, row, col, im)
+                    parents[(row, col)] = im
+            tiles = parents
+        store.flush()
+        solid = {}
+        for (row, col), im in tiles.items():
+            record_solid(solid, im, row, col)
+
+        if dst_canvas:
+            for (row, col), im in tiles.items():
+                shrink_into(dst_canvas, im, row, col)
+            dst_canvas.close()
+        return solid
+
+    def task_imtile(self, val):
+        strips, level, rows, store, dst_canvas, fingerprint = val
+        tiler = ImageTiler(strips,
+                           level,
+                           store,
+                           tw=self.tw,
+                           th=self.th,
+                           canvas=dst_canvas)
+        # Pixel fingerprints are only worth their hashing for the manifest
+        if fingerprint:
+            tiler.fps = {}
+        tiler.solid = {}
+        try:
+            for row, cols in rows:
+                tiler.run_row(row, cols)
+            store.flush()
+        finally:
+            for closeme in (strips, dst_canvas):
+                if hasattr(closeme, 'close'):
+                    closeme.close()
+        return tiler.fps, tiler.solid
+
+    def task_copy(self, val):
+        '''Copy a row of an already tiled base level, returns the (col, row)s that are missing'''
+        base, level, row, cols, store = val
+        ret = []
+        for col in cols:
+            if not base.copy_file(row, col, store, level):
+                ret.append((col, row))
+        store.flush()
+        return ret
+
+    def task_fingerprint(self, val):
+        '''Fingerprint a row of base tiles without writing anything'''
+        strips, row = val
+        tiler = ImageTiler(strips, None, None, self.tw, self.th)
+        ret = {}
+        y = row * self.th
+        tiler.load_strip(y)
+        for col, x in enumerate(range(0, tiler.x1, self.tw)):
+            ret[(row, col)] = manifest.pixel_fingerprint(tiler.crop_tile(x, y))
+        if hasattr(strips, 'close'):
+            strips.close()
+        return ret
 
     def start(self):
         self.process.start()
-        # Prevents later join failure
-        self.running.wait(1)
 
     def run(self):
-        self.running.set()
         #print 'Worker starting'
-        while self.running.is_set():
-            try:
-                task, args = self.qi.get(True, 0.1)
-            except queue.Empty:
-                continue
+        taskers = {
+            'subtile': self.task_subtile,
+            'imtile': self.task_imtile,
+            'block': self.task_block,
+            'fingerprint': self.task_fingerprint,
+            'copy': self.task_copy,
+        }
+        # Only count what this worker writes
+        tile_store.stats.clear()
 
-            def task_subtile(args):
-                self.task_subtile(args)
-                self.complete('done', args)
+        while True:
+            # Block until there is work, no polling
+            tidle = time.time()
+            item = self.qi.get()
+            idle = time.time() - tidle
+            if item is None:
+                self.job = None
+                self.complete('rss', budget.peak_rss())
+                break
 
-            taskers = {
-                'subtile': task_subtile,
-            }
+            self.job, batch = item
+            for task, args in batch:
+                tstart = time.time()
+                stats = collections.Counter(tile_store.stats)
+                capture = None
+                if self.profile:
+                    capture = profiling.Capture(
+                        memory=self.profile == 'memory')
+                    capture.start()
+                try:
+                    ret = ('done', taskers[task](args))
+                except Exception as e:
+                    print('WARNING: got exception trying supertile %s' %
+                          str(task))
+                    traceback.print_exc()
+                    estr = traceback.format_exc()
+                    ret = ('exception', (task, str(e), estr))
+                # Before the result so the tiler never finishes a store we still have open
+                tile_store.close_connections()
+                # Ahead of the result so the tiler has them when the stage ends
+                if capture:
+                    self.complete('profile', capture.stop())
+                self.complete(
+                    'metrics',
+                    {
+                        # What the task wrote: tiles, bytes, dedupe hits and such
+                        'stats': dict(tile_store.stats - stats),
+                        'busy': time.time() - tstart,
+                        'idle': idle,
+                    })
+                idle = 0.0
+                self.complete(*ret)
+            # Lets the pool hand out another batch
+            self.complete('batch', len(batch))
+
+
+class Cancelled(Exception):
+    '''The tiler's pool job was cancelled'''
+    pass
+
+
+class WorkerPool(object):
+    '''
+    TWorker processes shared by any number of Tilers (jobs)
+    Jobs queue task batches here instead of straight to the workers so one map's big stage
+    doesn't hold up the others: free workers take the next batch of the highest priority job,
+    round robin between jobs of the same priority
+    Results are routed back to the job that queued them
+    '''
 
+    def __init__(self,
+                 threads,
+                 tw=250,
+                 th=250,
+                 im_ext='.jpg',
+                 reduce='pil',
+                 profile=None):
+        self.verbose = False
+        self.threads = threads
+        self.tw = tw
+        self.th = th
+        self.im_ext = im_ext
+        # Workers can only shrink with one kernel, see tile_reduce.KERNELS
+        self.reduce = reduce
+        # See TWorker.profile
+        self.profile = profile
+        self.workers = None
+        # job => deque of batches not handed to a worker yet
+        self.pending = {}
+        # job => queue.Queue of (wi, event, val) worker messages
+        self.results = {}
+        # job => priority, higher goes first
+        self.priority = {}
+        # Jobs that were cancelled but not closed yet
+        self.cancelled = set()
+        self.next_job = 0
+        # Last job handed a batch, for round robin
+        self.last_job = None
+        # Batches handed to workers and not finished yet
+        self.inflight = 0
+        # Worker index => peak RSS bytes, reported as they exit
+        self.worker_rss = {}
+        self.lock = threading.Lock()
+        self.dispatcher = None
+        self.stopping = False
+
+    def start(self):
+        self.workers = []
+        # Share one resource tracker with the workers
+        # Otherwise each worker's tracker "cleans up" shared memory it only attached to
+        resource_tracker.ensure_running()
+        # (job, task batch)s for any worker to pick up
+        self.qtasks = multiprocessing.Queue()
+        # Worker output queue
+        self.qi = multiprocessing.Queue()
+        for wi in range(self.threads):
+            if self.verbose:
+                print('Bringing up W%02d' % wi)
+            w = TWorker(wi,
+                        self.qtasks,
+                        self.qi,
+                        im_ext=self.im_ext,
+                        tw=self.tw,
+                        th=self.th,
+                        reduce=self.reduce,
+                        profile=self.profile)
+            self.workers.append(w)
+            w.start()
+        # Started after forking so the workers don't get a copy
+        self.stopping = False
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def stop(self):
+        if self.workers is None:
+            return
+
+        if self.verbose:
+            print('Shutting down workers')
+        with self.lock:
+            for batches in self.pending.values():
+                batches.clear()
+        # Drop anything left over from a failed stage
+        while True:
             try:
-                taskers[task](args)
-            except Exception as e:
-                print('WARNING: got exception trying supertile %s' % str(task))
-                traceback.print_exc()
-                estr = traceback.format_exc()
-                self.complete('exception', (task, e, estr))
+                self.qtasks.get(False)
+            except queue.Empty:
+                break
+        for _worker in self.workers:
+            self.qtasks.put(None)
+        if self.verbose:
+            print('Waiting for workers to exit...')
+        for wi, worker in enumerate(self.workers):
+            worker.process.join(1)
+            if worker.process.is_alive():
+                print('  W%d: failed to join' % wi)
+                worker.process.terminate()
+            elif self.verbose:
+                print('  W%d: stopped' % wi)
+        # Each worker reported its peak RSS on the way out
+        self.stopping = True
+        self.dispatcher.join()
+        self.workers = None
+
+    def open_job(self, priority=0):
+        with self.lock:
+            job = self.next_job
+            self.next_job += 1
+            self.pending[job] = collections.deque()
+            self.results[job] = queue.Queue()
+            self.priority[job] = priority
+        return job
+
+    def close_job(self, job):
+        '''Forget job, its batches still queued are dropped and so are results of the ones running'''
+        with self.lock:
+            self.pending.pop(job, None)
+            self.results.pop(job, None)
+            self.priority.pop(job, None)
+            self.cancelled.discard(job)
+
+    def cancel(self, job):
+        '''Drop job's queued batches, the tiler waiting on it raises Cancelled'''
+        with self.lock:
+            if job not in self.pending:
+                return
+            self.pending[job].clear()
+            self.cancelled.add(job)
+            self.results[job].put((None, 'cancelled', None))
+
+    def submit(self, job, batch):
+        '''Queue a list of (task, args) to run in one go on some worker'''
+        with self.lock:
+            if job in self.cancelled:
+                return
+            self.pending[job].append(batch)
+            self.feed()
+
+    def get(self, job, timeout):
+        '''Next (wi, event, val) for job, raises queue.Empty after timeout seconds'''
+        return self.results[job].get(True, timeout)
+
+    def check(self):
+        '''Raise if a worker died, nothing is coming back from it (ex: OOM)'''
+        for wi, worker in enumerate(self.workers):
+            if not worker.process.is_alive():
+                raise Exception('W%d died (exit code %s)' %
+                                (wi, worker.process.exitcode))
+
+    def pick(self):
+        '''Job to hand the next batch from, None if nothing is pending'''
+        jobs = [job for job, batches in self.pending.items() if batches]
+        if not jobs:
+            return None
+        top = max(self.priority[job] for job in jobs)
+        jobs = sorted(job for job in jobs if self.priority[job] == top)
+        # The first job after the one served last
+        ret = jobs[0]
+        for job in jobs:
+            if self.last_job is None or job > self.last_job:
+                ret = job
+                break
+        self.last_job = ret
+        return ret
+
+    def feed(self):
+        '''Hand out pending batches, keeping two per worker queued so none go idle (lock held)'''
+        while self.inflight < 2 * self.threads:
+            job = self.pick()
+            if job is None:
+                return
+            self.qtasks.put((job, self.pending[job].popleft()))
+            self.inflight += 1
+
+    def dispatch(self):
+        '''Route worker messages to their jobs, runs in its own thread'''
+        while True:
+            try:
+                wi, job, event, val = self.qi.get(True, 0.1)
+            except queue.Empty:
+                if self.stopping:
+                    return
+                continue
+            if event == 'batch':
+                with self.lock:
+                    self.inflight -= 1
+                    self.feed()
+            elif event == 'rss':
+                self.worker_rss[wi] = val
+            else:
+                with self.lock:
+                    results = self.results.get(job)
+                # Gone if the job failed or was cancelled
+                if results is not None:
+                    results.put((wi, event, val))
 
 
 '''
@@ -286,10 +797,61 @@ class Tiler(object):
                  tw=250,
                  th=250,
                  im_ext=None,
-                 get_tile_name=None):
+                 get_tile_name=None,
+                 stream=False,
+                 in_memory=False,
+                 block_levels=0,
+                 incremental=False,
+                 store=None,
+                 reduce='pil',
+                 src_im_ext=None,
+                 events=None,
+                 profile=None,
+                 max_memory=None,
+                 pool=None,
+                 regions=None):
         assert im_ext
         self.src_dir = src_dir
         self.pim = pim
+        # Decode pim one strip at a time instead of all at once
+        self.stream = stream
+        # Decode pim once into an uncompressed temp file and stream strips from that
+        self.spool = False
+        # If set, bytes to fit the whole build into, see fit_memory()
+        self.max_memory = max_memory
+        # Worker index => peak RSS bytes, reported as they exit
+        self.worker_rss = {}
+        # Pass shrunk pixels between levels in shared memory instead of decoding the last level
+        self.in_memory = in_memory
+        # level => SharedImage holding that level's pixels
+        self.canvases = {}
+        # (mode, palette) to create canvases with
+        self.canvas_fmt = None
+        # If set, build 2^block_levels x 2^block_levels base tile blocks per task
+        self.block_levels = block_levels
+        # Kernel for shrinking 2x2 children into a parent, see tile_reduce.KERNELS
+        tile_reduce.check_kernel(reduce)
+        self.reduce = reduce
+        # Only rebuild tiles whose inputs changed since the last run
+        self.incremental = incremental
+        # Changed (x0, y0, x1, y1) base pixel rectangles
+        # Only the tiles they overlap and the tiles above those are rebuilt, the rest of the map is left alone
+        self.regions = regions
+        if (incremental or regions) and (in_memory or block_levels):
+            print(
+                'WARNING: incremental / region mode builds one tile at a time, ignoring in memory / block options'
+            )
+            self.in_memory = False
+            self.block_levels = 0
+        self.manifest = None
+        # level => TileBitmap of the tiles on disk
+        self.tiles = {}
+        # level => {(row, col): (mode, color)} of single color tiles
+        self.solid = {}
+        # level => set of (row, col) to build, None to build everything
+        self.dirty = None
+        # level => {(row, col): fingerprint} of the tiles we are building
+        self.fps = None
         self.get_tile_name = get_tile_name
 
         self.verbose = False
@@ -300,15 +862,44 @@ class Tiler(object):
         self.zoom_factor = 2
         self.tw = tw
         self.th = th
-        # JPEG quality level, 1-100 or something
-        self.quality = 90
         # Fraction of 1 to print each progress level at
         # None to disable
         self.progress_inc = 0.10
         self.threads = threads
         self.im_ext = im_ext
-
-        self.workers = None
+        # Extension of the tiles in src_dir, output may be another format
+        self.src_im_ext = src_im_ext or im_ext
+        # Where tiles go, default to files laid out by get_tile_name
+        if store is None:
+            store = tile_store.DirStore(dst_basedir, get_tile_name, im_ext)
+        self.store = store
+        if incremental and isinstance(store, tile_store.DirStore):
+            # Old tiles may be hardlinked to each other by a deduped run
+            store.replace = True
+        # stats summed over every process that wrote tiles
+        self.stats = collections.Counter()
+        # events.EventLog to report structured progress to, if any
+        self.events = events
+        # Level being built, for events
+        self.level = None
+        # What workers reported writing so far this run
+        self.worker_tiles = 0
+        self.worker_bytes = 0
+        # Per worker {'busy': seconds, 'idle': seconds}
+        self.worker_time = []
+        # profiling.Profiler to record worker tasks and our own dispatch in, if any
+        self.profile = profile
+
+        # WorkerPool shared with other maps, otherwise wstart() makes one of our own
+        self.pool = pool
+        self.own_pool = pool is None
+        # Our job in the pool while running
+        self.job = None
+        if pool and pool.reduce != reduce:
+            raise ValueError('Shared pool reduces with %s, not %s' %
+                             (pool.reduce, reduce))
+        # Pool priority, higher goes first
+        self.priority = 0
 
         self.rcs = {}
         for level in range(self.max_level, self.min_level - 1, -1):
@@ -327,52 +918,219 @@ class Tiler(object):
 
             rows = div_rnd(rows)
             cols = div_rnd(cols)
+        if regions:
+            if incremental:
+                raise ValueError(
+                    'Regions and incremental both pick what to rebuild, use one'
+                )
+            self.dirty = self.region_dirty(regions)
 
     def wstart(self):
-        self.workers = []
-        self.wopen = set()
-        # Our input queue / worker output queue
-        self.qi = multiprocessing.Queue()
-        for wi in range(self.threads):
-            if self.verbose:
-                print('Bringing up W%02d' % wi)
-            w = TWorker(wi,
-                        self.qi,
-                        im_ext=self.im_ext,
-                        tw=self.tw,
-                        th=self.th)
-            self.workers.append(w)
-            w.start()
-            self.wopen.add(wi)
+        if self.own_pool:
+            self.pool = WorkerPool(self.threads,
+                                   tw=self.tw,
+                                   th=self.th,
+                                   im_ext=self.im_ext,
+                                   reduce=self.reduce,
+                                   profile=self.worker_profile())
+            self.pool.verbose = self.verbose
+            self.pool.start()
+        self.worker_time = [{
+            'busy': 0.0,
+            'idle': 0.0
+        } for _wi in range(self.pool.threads)]
+        self.job = self.pool.open_job(self.priority)
+
+    def worker_profile(self):
+        if not self.profile:
+            return None
+        return self.profile.worker_mode()
+
+    def fit_memory(self):
+        '''Pick the decode strategy, worker count and in memory levels that fit in max_memory'''
+        rows, cols = self.rcs[self.max_level]
+        if self.pim:
+            image = self.pim.image
+            estimator = budget.Estimator(image.size[0],
+                                         image.size[1],
+                                         image.mode,
+                                         self.tw,
+                                         self.th,
+                                         streamable=pimage.can_stream(image),
+                                         block_k=self.block_k(),
+                                         reduce=self.reduce)
+        else:
+            estimator = budget.Estimator(cols * self.tw,
+                                         rows * self.th,
+                                         Image.open(self.src_ref()).mode,
+                                         self.tw,
+                                         self.th,
+                                         decode=False,
+                                         block_k=self.block_k(),
+                                         reduce=self.reduce)
+        # A shared pool's workers are already running
+        plan = estimator.plan(
+            self.max_memory,
+            self.threads if self.own_pool else self.pool.threads,
+            stream=self.stream,
+            in_memory=self.in_memory)
+        print('Memory budget %s: %s' %
+              (budget.format_size(self.max_memory), plan))
+        if plan.peak > self.max_memory:
+            print('WARNING: nothing fits in the memory budget, trying anyway')
+        if self.in_memory and not plan.in_memory:
+            print('WARNING: no room for in memory levels, using tiles')
+        if self.own_pool:
+            self.threads = plan.threads
+        self.in_memory = plan.in_memory
+        if plan.strategy:
+            self.stream = plan.strategy == 'stream'
+            self.spool = plan.strategy == 'spool'
+
+    def print_rss(self):
+        rss = [('main', budget.peak_rss())
+               ] + [('W%d' % wi, self.worker_rss[wi])
+                    for wi in sorted(self.worker_rss.keys())]
+        print('Peak RSS: %s' % ', '.join('%s %s' %
+                                         (name, budget.format_size(n))
+                                         for name, n in rss))
 
     def wkill(self):
-        if self.workers is None:
+        if self.job is None:
             return
+        self.pool.close_job(self.job)
+        self.job = None
+        if self.own_pool:
+            self.pool.stop()
+            self.worker_rss = self.pool.worker_rss
+            self.pool = None
+
+    def run_tasks(self, task, args_gen, n):
+        '''
+        Queue task with each args from args_gen for any free worker and wait until all n are done
+        Returns the list of task return values (in completion order)
+        '''
+        # Batch tiny tasks to cut queue round trips but keep enough batches to balance the tail
+        batch_size = max(1, min(16, n // (self.pool.threads * 8)))
+        batch = []
+        for args in args_gen:
+            batch.append((task, args))
+            if len(batch) >= batch_size:
+                self.pool.submit(self.job, batch)
+                batch = []
+        if batch:
+            self.pool.submit(self.job, batch)
 
-        if self.verbose:
-            print('Shutting down workers')
-        for worker in self.workers:
-            worker.running.clear()
-        if self.verbose:
-            print('Waiting for workers to exit...')
-        allw = True
-        for wi, worker in enumerate(self.workers):
-            if worker is None:
+        next_progress = self.progress_inc
+        done = 0
+        ret = []
+        tstart = time.time()
+        stage_tiles = self.worker_tiles
+        stage_bytes = self.worker_bytes
+        next_event = tstart
+        self.emit('stage_start', stage=task, level=self.level, tasks=n)
+        while done < n:
+            try:
+                wi, event, val = self.pool.get(self.job, 1.0)
+            except queue.Empty:
+                self.pool.check()
                 continue
-            worker.process.join(1)
-            if worker.process.is_alive():
-                print('  W%d: failed to join' % wi)
-                allw = False
-            else:
-                if self.verbose:
-                    print('  W%d: stopped' % wi)
-                self.workers[wi] = None
-                self.wopen.remove(wi)
-        if allw:
-            self.workers = None
-
-    def subtile(self, dst_level, src_basedir, src_get_tile_name, dst_basedir,
-                dst_get_tile_name):
+            if event == 'cancelled':
+                raise Cancelled('%s cancelled' % self.dst_basedir)
+            if event == 'profile':
+                self.profile.add(task, self.level, val)
+                continue
+            if event == 'metrics':
+                self.stats.update(val['stats'])
+                self.worker_tiles += val['stats'].get('tiles', 0)
+                self.worker_bytes += val['stats'].get('bytes', 0)
+                self.worker_time[wi]['busy'] += val['busy']
+                self.worker_time[wi]['idle'] += val['idle']
+                continue
+            if event != 'done':
+                print(event, val)
+                raise Exception()
+
+            ret.append(val)
+            done += 1
+            progress = 1.0 * done / n
+            if self.progress_inc and progress >= next_progress:
+                print('Progress: %02.2f%% %d / %d' % (progress * 100, done, n))
+                next_progress += self.progress_inc
+            if self.events and (time.time() >= next_event or done == n):
+                next_event = time.time() + self.events.interval
+                dt = time.time() - tstart
+                self.emit_progress(task, done, n,
+                                   (self.worker_tiles - stage_tiles) / dt,
+                                   dt * (n - done) / done)
+        dt = time.time() - tstart
+        self.emit('stage_end',
+                  stage=task,
+                  level=self.level,
+                  tasks=n,
+                  tiles=self.worker_tiles - stage_tiles,
+                  bytes=self.worker_bytes - stage_bytes,
+                  wall=dt,
+                  tiles_per_sec=(self.worker_tiles - stage_tiles) / dt)
+        return ret
+
+    def emit(self, event, **fields):
+        if self.events:
+            # Several maps may report to the same log
+            self.events.emit(event, map=self.dst_basedir, **fields)
+
+    def emit_progress(self, task, done, n, tiles_per_sec, eta):
+        # Plus fills and such written by this process
+        self.emit('progress',
+                  stage=task,
+                  level=self.level,
+                  tasks_done=done,
+                  tasks=n,
+                  tiles=self.worker_tiles + self.store.stats['tiles'],
+                  bytes=self.worker_bytes + self.store.stats['bytes'],
+                  tiles_per_sec=tiles_per_sec,
+                  eta=eta,
+                  workers=self.worker_time)
+
+    def imtile(self, dst_level, strips):
+        '''Slice the base level out of strips, one row per task'''
+        rows, cols = self.rcs[dst_level]
+        print('Slicing %u cols x %u rows across %u workers' %
+              (cols, rows, self.threads))
+
+        dst_canvas = self.canvases.get(dst_level - 1)
+        todo = self.dirty_cols(dst_level)
+        if self.dirty is not None:
+            print('Changed: %u / %u tiles' %
+                  (len(self.dirty[dst_level]), rows * cols))
+
+        def args_gen():
+            for row in sorted(todo.keys()):
+                yield (strips, dst_level, [(row, todo[row])], self.store,
+                       dst_canvas, self.manifest is not None)
+
+        ret = {}
+        solid = self.solid.setdefault(dst_level, {})
+        for fps, tiles_solid in self.run_tasks('imtile', args_gen(),
+                                               len(todo)):
+            if fps:
+                ret.update(fps)
+            solid.update(tiles_solid)
+        self.mark_tiles(dst_level, todo)
+        return ret
+
+    def fingerprint(self, strips):
+        '''Fingerprint the base level tiles that would be cut from strips'''
+        rows, _cols = self.rcs[self.max_level]
+        print('Fingerprinting %u rows' % rows)
+        ret = {}
+        for fps in self.run_tasks('fingerprint',
+                                  ((strips, row) for row in range(rows)),
+                                  rows):
+            ret.update(fps)
+        return ret
+
+    def subtile(self, dst_level):
         '''Subtile from previous level'''
         src_level = dst_level + 1
 
@@ -382,72 +1140,204 @@ class Tiler(object):
 
         print('Shrink by %0.1f: cols %s => %s, rows %s => %s' %
               (self.zoom_factor, src_cols, dst_cols, src_rows, dst_rows))
-
-        next_progress = self.progress_inc
-        done = 0
-
-        # AttributeError: 'xrange' object has no attribute 'next'
-        def dst_row_genf():
-            for x in range(dst_rows):
-                yield x
-
-        dst_row_gen = dst_row_genf()
-
-        while True:
-            idle = True
-
-            # No more jobs to give and all workers are idle?
-            if dst_row_gen is None and len(self.wopen) == len(self.workers):
-                break
-
-            # Scrub completed tasks
-            while True:
-                try:
-                    wi, event, val = self.qi.get(False)
-                except queue.Empty:
-                    break
-                if event != 'done':
-                    print(event, val)
-                    raise Exception()
-                idle = False
-                self.wopen.add(wi)
-
-                done += 1
-                progress = 1.0 * done / dst_rows
-                if self.progress_inc and progress >= next_progress:
-                    print('Progress: %02.2f%% %d / %d' %
-                          (progress * 100, done, dst_rows))
-                    next_progress += self.progress_inc
-
-            # More tasks to give?
-            if dst_row_gen and len(self.wopen):
-                # Assign next task
-                try:
-                    dst_row = next(dst_row_gen)
-                # Out of tasks?
-                except StopIteration:
-                    dst_row_gen = None
-                    continue
-
-                idle = False
-                worker = self.workers[self.wopen.pop()]
-                worker.submit('subtile',
-                              (dst_basedir,
-                               tile_name.str_get_tile_name(dst_get_tile_name),
-                               dst_row, dst_cols, src_basedir,
-                               tile_name.str_get_tile_name(src_get_tile_name),
-                               src_level))
-
-            if idle:
-                # Couldn't find something to do
-                time.sleep(0.05)
+        src_canvas = self.canvases.get(dst_level)
+        dst_canvas = self.canvases.get(dst_level - 1)
+        if src_canvas:
+            print('Source: in memory')
+
+        todo = self.dirty_cols(dst_level)
+        if self.dirty is not None:
+            print('Changed: %u / %u tiles' %
+                  (len(self.dirty[dst_level]), dst_rows * dst_cols))
+
+        def args_gen():
+            for dst_row in sorted(todo.keys()):
+                src_row_solid = {}
+                for src_row in (2 * dst_row, 2 * dst_row + 1):
+                    src_row_solid.update(src_solid.get(src_row, {}))
+                yield (self.store, dst_row, todo[dst_row], src_level,
+                       src_tiles.slice(2 * dst_row, 2 * dst_row + 2),
+                       src_row_solid, src_canvas, dst_canvas)
+
+        src_tiles = self.tiles[src_level]
+        # Group by row so each task only gets the two rows it needs
+        src_solid = {}
+        for (row, col), color in self.solid.pop(src_level, {}).items():
+            src_solid.setdefault(row, {})[(row, col)] = color
+        solid = self.solid.setdefault(dst_level, {})
+        for tiles_solid in self.run_tasks('subtile', args_gen(), len(todo)):
+            solid.update(tiles_solid)
+        self.mark_tiles(dst_level, todo)
 
         # Next shrink will be on the previous tile set, not the original
         if self.verbose:
             print('Shrinking the world for future rounds')
 
+    def block_k(self):
+        '''Levels each block task covers, 0 to schedule by rows instead'''
+        return max(0, min(self.block_levels, self.max_level - self.min_level))
+
+    def blocks(self, base):
+        '''
+        Each task takes a 2^k x 2^k block of base tiles and builds its whole sub-pyramid
+        down to the level where the block is a single tile
+        Children stay in the worker's memory instead of round tripping through disk
+        Returns the lowest level written
+        '''
+        k = self.block_k()
+        n = 2**k
+        rows, cols = self.rcs[self.max_level]
+        brows = (rows + n - 1) // n
+        bcols = (cols + n - 1) // n
+        print('Zoom levels %d to %d: %u blocks of %u x %u tiles' %
+              (self.max_level, self.max_level - k, brows * bcols, n, n))
+        self.mk_canvas(self.max_level - k - 1)
+        dst_canvas = self.canvases.get(self.max_level - k - 1)
+
+        def args_gen():
+            for brow in range(brows):
+                for bcol in range(bcols):
+                    yield (base, self.max_level, brow * n, bcol * n, k,
+                           self.rcs, self.store, dst_canvas)
+
+        solid = self.solid.setdefault(self.max_level - k, {})
+        for tiles_solid in self.run_tasks('block', args_gen(), brows * bcols):
+            solid.update(tiles_solid)
+        for level in range(self.max_level, self.max_level - k - 1, -1):
+            self.mark_tiles(level, self.dirty_cols(level))
+        return self.max_level - k
+
+    def src_ref(self):
+        '''Any source tile to take the mode and such from'''
+        for fn in sorted(os.listdir(self.src_dir)):
+            if fn.endswith(self.src_im_ext):
+                return os.path.join(self.src_dir, fn)
+        raise Exception('No %s tiles in %s' % (self.src_im_ext, self.src_dir))
+
+    def mk_canvas(self, level):
+        '''Allocate shared memory for level so the level above can shrink straight into it'''
+        if not self.in_memory or level < self.min_level or not self.canvas_fmt:
+            return
+        rows, cols = self.rcs[level]
+        mode, palette = self.canvas_fmt
+        name = 'pr0nmap_%u_%u_l%u' % (os.getpid(), id(self), level)
+        canvas = pimage.SharedImage(name,
+                                    mode, (cols * self.tw, rows * self.th),
+                                    palette,
+                                    create=True)
+        print('In memory level %u: %u x %u (%0.1f MB)' %
+              (level, cols * self.tw, rows * self.th,
+               canvas.stride * canvas.height() / 1e6))
+        self.canvases[level] = canvas
+
+    def drop_canvas(self, level):
+        canvas = self.canvases.pop(level, None)
+        if canvas:
+            canvas.unlink()
+
+    def region_dirty(self, regions):
+        '''Changed base pixel rectangles => {level: set of (row, col) to rebuild}'''
+        rows, cols = self.rcs[self.max_level]
+        ret = {
+            self.max_level: region_tiles(regions, self.tw, self.th, rows, cols)
+        }
+        for level in range(self.max_level - 1, self.min_level - 1, -1):
+            # A parent is stale if any of its 2x2 children are
+            ret[level] = set(
+                (row // 2, col // 2) for row, col in ret[level + 1])
+        print('Regions: %u changed base tiles' % len(ret[self.max_level]))
+        return ret
+
+    def check_region_map(self):
+        '''Region runs touch up a finished map with the same tile grid, raise ValueError if there isn't one'''
+        rows, cols = self.rcs[self.max_level]
+
+        def has(level, row, col):
+            return self.store.get(level, row, col) is not None
+
+        if not has(self.min_level, 0, 0):
+            raise ValueError(
+                'Regions: no finished map at %s to touch up, build it without --region first'
+                % self.dst_basedir)
+        # Last base tile there and nothing past it, no level below the base
+        if not has(self.max_level, rows - 1, cols - 1) or has(
+                self.max_level, rows, 0) or has(
+                    self.max_level, 0, cols) or has(self.max_level + 1, 0, 0):
+            raise ValueError(
+                'Regions: %s is not a %u x %u tile map with base level %u, the source must be the same size as before'
+                % (self.dst_basedir, cols, rows, self.max_level))
+
+    def dirty_cols(self, level):
+        '''{row: [cols]} of the tiles to build at level'''
+        rows, cols = self.rcs[level]
+        if self.dirty is None:
+            return dict((row, list(range(cols))) for row in range(rows))
+        ret = {}
+        for row, col in sorted(self.dirty[level]):
+            ret.setdefault(row, []).append(col)
+        return ret
+
+    def mark_tiles(self, level, todo):
+        '''Record the {row: [cols]} just written at level'''
+        bits = self.tiles.get(level)
+        if bits is None:
+            rows, cols = self.rcs[level]
+            bits = bitmap.TileBitmap(rows, cols)
+            # Incremental runs only write what changed, the rest is from before
+            if self.manifest:
+                for row, col in self.manifest.get(level):
+                    bits.set(row, col)
+            elif self.regions:
+                # Region runs only write the regions, the rest is from the build being touched up
+                bits.bits[:] = b'\xff' * len(bits.bits)
+            self.tiles[level] = bits
+        for row, cols in todo.items():
+            for col in cols:
+                bits.set(row, col)
+
+    def load_manifest(self):
+        rows, cols = self.rcs[self.max_level]
+        config = {
+            'tw': self.tw,
+            'th': self.th,
+            'im_ext': self.im_ext,
+            'encoder': self.store.encoder.describe(),
+            'max_level': self.max_level,
+            'min_level': self.min_level,
+            'rows': rows,
+            'cols': cols,
+            'layout': tile_name.str_get_tile_name(self.get_tile_name),
+        }
+        self.manifest = manifest.Manifest.load(self.store.manifest_fn(),
+                                               config)
+
+    def plan(self, base_fps):
+        '''Fingerprint every level from the base tiles and mark the ones that changed as dirty'''
+        self.fps = {self.max_level: base_fps}
+        for level in range(self.max_level - 1, self.min_level - 1, -1):
+            rows, cols = self.rcs[level]
+            children = self.fps[level + 1]
+            self.fps[level] = dict(
+                ((row, col),
+                 manifest.parent_fingerprint([
+                     children.get((2 * row + r, 2 * col + c)) for r in (0, 1)
+                     for c in (0, 1)
+                 ])) for row in range(rows) for col in range(cols))
+        self.dirty = {}
+        for level, fps in self.fps.items():
+            old = self.manifest.get(level)
+            self.dirty[level] = set(rc for rc, fp in fps.items()
+                                    if old.get(rc) != fp)
+
+    def level_done(self, level):
+        '''Record level in the manifest so an interrupted run can pick up from here'''
+        if not self.manifest:
+            return
+        self.manifest.set_level(level, self.fps[level])
+        self.manifest.save()
+
     def get_tle_name_pr0nts(self, root_dir, row, col, im_ext):
-        return os.path.join(root_dir, "y%03u_x%03u%s" % (row, col, im_ext))
+        return get_tile_name_pr0nts(root_dir, row, col, im_ext)
 
     def copy_max_dir(self, dst_level):
         #assert 0, 'fixme: file name mismatch'
@@ -458,26 +1348,27 @@ class Tiler(object):
             print('Source: direct copy rejigger %s => %s' %
                   (self.src_dir, self.dst_basedir))
             # shutil.copytree(self.src_dir, self.dst_basedir)
-            fnref = None
-            for x in range(cols):
-                for y in range(rows):
-                    src_fn = self.get_tle_name_pr0nts(self.src_dir, y, x,
-                                                      self.im_ext)
-                    dst_fn = self.get_tile_name(self.dst_basedir, dst_level, y,
-                                                x, self.im_ext)
-                    mkdir_p(os.path.dirname(dst_fn))
-                    try:
-                        shutil.copyfile(src_fn, dst_fn)
-                        if not fnref:
-                            print(("Ex: %s => %s" % (src_fn, dst_fn)))
-                        fnref = src_fn
-                    except IOError as e:
-                        skips.add((x, y, dst_fn))
+            todo = self.dirty_cols(dst_level)
+            # Missing tiles are filled below, so everything gets written
+            self.mark_tiles(dst_level, todo)
+            base = DirBase(self.src_dir, self.src_im_ext, None, self.tw,
+                           self.th)
+            if todo:
+                y = min(todo.keys())
+                x = min(todo[y])
+                print(("Ex: %s => level %u (%u, %u)" %
+                       (base.src_fn(y, x), dst_level, y, x)))
+            # Workers copy a row at a time, mostly waiting on the filesystem
+            for missing in self.run_tasks('copy',
+                                          ((base, dst_level, y, xs, self.store)
+                                           for y, xs in sorted(todo.items())),
+                                          len(todo)):
+                skips.update(missing)
             print(("Skip %s" % len(skips)))
             # must be done after as it may be hard to get a reference image
             if len(skips):
                 print("Creating fill image...")
-                imref = Image.open(fnref)
+                imref = Image.open(self.src_ref())
                 width, height = imref.size
                 imblank = Image.new(imref.mode, (imref.size))
                 """
@@ -488,71 +1379,195 @@ class Tiler(object):
                         imblank.putpixel((x, y), c)
                 """
                 print("Applying fill...")
-                for (x, y, dst_fn) in skips:
-                    imblank.save(dst_fn)
+                solid = self.solid.setdefault(dst_level, {})
+                for (x, y) in skips:
+                    self.store.save(dst_level, y, x, imblank)
+                    record_solid(solid, imblank, y, x)
                 print("Filled missing images")
+            self.store.flush()
         else:
             # explicitly load and save images to clean dir, same jpg format
             # a bit more paranoid but questionable utility still
             raise Exception()
 
-    def run_src_dir(self):
-        for dst_level in range(self.max_level, self.min_level - 1, -1):
-            print()
-            print('************')
-            print('Zoom level %d' % dst_level)
+    def print_level(self, dst_level):
+        self.level = dst_level
+        print()
+        print('************')
+        print('Zoom level %d' % dst_level)
+
+    def image_fmt(self, im):
+        return (im.mode, im.getpalette() if im.mode == 'P' else None)
+
+    def run_subtiles(self, src_level):
+        '''Shrink everything below src_level one level at a time'''
+        for dst_level in range(src_level - 1, self.min_level - 1, -1):
+            self.print_level(dst_level)
+            print('Source: tiles')
+            self.mk_canvas(dst_level - 1)
+            self.subtile(dst_level)
+            self.drop_canvas(dst_level)
+            self.level_done(dst_level)
 
+    def run_src_dir(self):
+        if self.incremental:
+            rows, cols = self.rcs[self.max_level]
+            # Missing source tiles get filled, which is a fingerprint of its own
+            self.plan(
+                dict(((row, col),
+                      manifest.file_fingerprint(
+                          self.get_tle_name_pr0nts(self.src_dir, row, col,
+                                                   self.src_im_ext)) or 'fill')
+                     for row in range(rows) for col in range(cols)))
+        if self.block_k():
+            print('Source: direct copy rejigger %s => %s' %
+                  (self.src_dir, self.dst_basedir))
+            self.canvas_fmt = self.image_fmt(Image.open(self.src_ref()))
+            base = DirBase(self.src_dir, self.src_im_ext, self.canvas_fmt[0],
+                           self.tw, self.th)
+            top_level = self.blocks(base)
+        else:
+            self.print_level(self.max_level)
             # For the first level we may just copy things over
-            if dst_level == self.max_level:
-                self.copy_max_dir(dst_level)
-            # Additional levels we take the image coordinate map and shrink
-            else:
-                print('Source: tiles')
-                self.subtile(dst_level, self.dst_basedir, self.get_tile_name,
-                             self.dst_basedir, self.get_tile_name)
+            self.copy_max_dir(self.max_level)
+            self.level_done(self.max_level)
+            # Copies aren't decoded so the first shrink has to come from disk
+            if self.in_memory:
+                self.canvas_fmt = self.image_fmt(
+                    self.store.open(self.max_level, 0, 0))
+            top_level = self.max_level
+        # Additional levels we take the image coordinate map and shrink
+        self.run_subtiles(top_level)
 
     def run_pim(self):
-        for dst_level in range(self.max_level, self.min_level - 1, -1):
-            print()
-            print('************')
-            print('Zoom level %d' % dst_level)
-
-            # For the first level slice up source
-            # Used to do all levels but it would result in OOM crash on large images
-            # Plus only base level needs needs quality
-            if dst_level == self.max_level:
+        # For the first level slice up source
+        # Used to do all levels but it would result in OOM crash on large images
+        # Plus only base level needs needs quality
+        fn = self.pim.image.filename
+        source_fp = manifest.file_fingerprint(fn)
+        base_fps = None
+        if self.manifest:
+            base_fps = self.manifest.get(self.max_level) or None
+            if base_fps and self.manifest.source == source_fp:
+                # Source is untouched, only need to check the levels below
+                print('Source: unchanged')
+                self.plan(base_fps)
+                self.mark_tiles(self.max_level, {})
+                self.run_subtiles(self.max_level)
+                return
+        spool_fn = None
+        if self.stream:
+            strips = pimage.open_strips(fn)
+        elif self.spool:
+            # Next to the output, /tmp is often in memory
+            fd, spool_fn = tempfile.mkstemp(
+                prefix='pr0nmap_spool_',
+                suffix='.tif',
+                dir=os.path.dirname(os.path.abspath(self.dst_basedir)))
+            os.close(fd)
+            print('Spooling decoded image to %s' % spool_fn)
+            try:
+                strips = pimage.spool_strips(fn, spool_fn)
+            except BaseException:
+                os.unlink(spool_fn)
+                raise
+        else:
+            strips = None
+        # Workers can't see a decode of ours, give them one copy to share
+        # (open_strips() falls back to ImageStrips before anything is decoded)
+        if not isinstance(strips, pimage.FileStrips):
+            print('Decoding into shared memory')
+            strips = pimage.SharedImage.from_file(fn)
+        self.canvas_fmt = (strips.get_mode(), strips.palette())
+        try:
+            if self.block_k():
                 print('Source: single image')
-                pim = self.pim
-                tiler = ImageTiler(pim,
-                                   dst_level,
-                                   self.dst_basedir,
-                                   tw=self.tw,
-                                   th=self.th,
-                                   im_ext=self.im_ext,
-                                   get_tile_name=self.get_tile_name)
-                tiler.run()
-            # Additional levels we take the image coordinate map and shrink
+                top_level = self.blocks(strips)
             else:
-                print('Source: tiles')
-                self.subtile(dst_level, self.dst_basedir, self.get_tile_name,
-                             self.dst_basedir, self.get_tile_name)
+                self.print_level(self.max_level)
+                print('Source: single image')
+                self.mk_canvas(self.max_level - 1)
+                if base_fps:
+                    # Source changed, see which tiles did before we write anything
+                    self.plan(self.fingerprint(strips))
+                fps = self.imtile(self.max_level, strips)
+                if self.manifest:
+                    if not base_fps:
+                        self.plan(fps)
+                    self.manifest.source = source_fp
+                    self.level_done(self.max_level)
+                top_level = self.max_level
+        finally:
+            if isinstance(strips, pimage.SharedImage):
+                strips.unlink()
+            if spool_fn:
+                os.unlink(spool_fn)
+        # Additional levels we take the image coordinate map and shrink
+        self.run_subtiles(top_level)
 
     def run(self):
+        tstart = time.time()
+        ok = False
+        self.emit('run_start',
+                  dst=self.dst_basedir,
+                  max_level=self.max_level,
+                  min_level=self.min_level,
+                  rows=self.rcs[self.max_level][0],
+                  cols=self.rcs[self.max_level][1],
+                  threads=self.threads)
         try:
+            if self.max_memory:
+                self.fit_memory()
             self.wstart()
 
-            if not os.path.exists(self.dst_basedir):
-                os.mkdir(self.dst_basedir)
-
-            if self.src_dir:
-                self.run_src_dir()
-            elif self.pim:
-                self.run_pim()
-            else:
-                raise Exception()
+            # After wstart() so the workers don't inherit our profiler
+            with self.profile.measure(
+                    'parent') if self.profile else contextlib.nullcontext():
+                self.store.create()
+                if self.incremental:
+                    self.load_manifest()
+                if self.regions:
+                    self.check_region_map()
+
+                if self.src_dir:
+                    self.run_src_dir()
+                elif self.pim:
+                    self.run_pim()
+                else:
+                    raise Exception()
+                self.store.finish()
+            ok = True
 
         finally:
             self.wkill()
+            for level in list(self.canvases.keys()):
+                self.drop_canvas(level)
+            self.stats.update(self.store.stats)
+            self.store.stats.clear()
+            self.emit('run_end',
+                      ok=ok,
+                      wall=time.time() - tstart,
+                      tiles=self.stats['tiles'],
+                      bytes=self.stats['bytes'],
+                      peak_rss=budget.peak_rss(),
+                      worker_peak_rss=[
+                          self.worker_rss[wi]
+                          for wi in sorted(self.worker_rss.keys())
+                      ])
+        if self.store.dedupe:
+            tile_store.print_stats(self.stats)
+        # Only worth a line when something other than a plain copy was asked for
+        if getattr(self.store, 'link_mode', 'copy') != 'copy':
+            tile_store.print_link_stats(self.stats)
+        if self.stats['solid_tiles']:
+            print('Solid: %u single color tiles written without decoding' %
+                  self.stats['solid_tiles'])
+        if self.max_memory:
+            self.print_rss()
+        if self.profile:
+            print()
+            print(self.profile.write())
+            print('Profile written to %s' % self.profile.out_dir)
 
     def __del__(self):
         self.wkill()
@@ -0,0 +1,354 @@
+'''
+On demand tile server: pr0nmap serve [options] map_dir
+
+Serves a GroupXIV map directory as is (index.html works unchanged)
+but renders any tile missing from l1-tiles by shrinking its 2x2 children, recursively,
+the same way the tiler would have (tile_reduce.reduce_quads + the store's encoder)
+Build the map with --base-only to skip writing every level above the base
+
+Rendered tiles go in a bounded LRU held in memory
+Tiles pushed out of memory spill to --spill-dir (also bounded) instead of being forgotten
+Concurrent requests for the same tile wait on one render instead of each doing it
+
+Ex: pr0nmap serve --http 8000 --cache-memory 256M --spill-dir /var/cache/pr0nmap map
+'''
+
+from pr0nmap import budget
+from pr0nmap import encoder as tile_encoder
+from pr0nmap import reduce as tile_reduce
+from pr0nmap.tile import calc_max_level
+
+import argparse
+import collections
+import hashlib
+import http.server
+import io
+import json
+import math
+import mimetypes
+import os
+import re
+import signal
+import sys
+import threading
+from PIL import Image
+
+# GroupXIV tile URLs: <layer URL>-tiles/<level + 1>/<col>/<row><ext>
+TILE_RE = re.compile(r'^/(l1-tiles)/([0-9]+)/([0-9]+)/([0-9]+)(\.[a-z]+)$')
+
+
+def read_meta(map_dir):
+    '''initViewer() argument from a GroupXIV index.html'''
+    with open(os.path.join(map_dir, 'index.html')) as f:
+        m = re.search(r'initViewer\((.*)\);', f.read())
+    if not m:
+        raise ValueError('%s/index.html is not a GroupXIV map' % map_dir)
+    return json.loads(m.group(1))
+
+
+class TileCache(object):
+    '''
+    LRU of key => encoded tile bytes, max_bytes in memory
+    then max_spill_bytes of files in spill_dir for what memory pushed out
+    '''
+
+    def __init__(self, max_bytes, spill_dir=None, max_spill_bytes=0):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes if spill_dir else 0
+        # key => data, most recently used last
+        self.memory = collections.OrderedDict()
+        self.memory_bytes = 0
+        # key => size of its spill file, most recently used last
+        self.spilled = collections.OrderedDict()
+        self.spill_bytes = 0
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+        if spill_dir and not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+
+    def spill_fn(self, key):
+        return os.path.join(
+            self.spill_dir,
+            hashlib.sha1(repr(key).encode()).hexdigest() + '.tile')
+
+    def get(self, key):
+        '''Cached bytes, None if not cached'''
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return data
+            if key not in self.spilled:
+                self.stats['misses'] += 1
+                return None
+        try:
+            with open(self.spill_fn(key), 'rb') as f:
+                data = f.read()
+        except IOError:
+            # Evicted while we were reading it
+            with self.lock:
+                self.stats['misses'] += 1
+            return None
+        with self.lock:
+            self.stats['spill_hits'] += 1
+        # Back into memory, the spill file goes away if something else needs the room
+        self.put(key, data)
+        return data
+
+    def put(self, key, data):
+        spill = []
+        with self.lock:
+            old = self.memory.pop(key, None)
+            if old is not None:
+                self.memory_bytes -= len(old)
+            self.memory[key] = data
+            self.memory_bytes += len(data)
+            while self.memory_bytes > self.max_bytes and len(self.memory) > 1:
+                old_key, old_data = self.memory.popitem(last=False)
+                self.memory_bytes -= len(old_data)
+                self.stats['evictions'] += 1
+                if self.max_spill_bytes and old_key not in self.spilled:
+                    spill.append((old_key, old_data))
+        # Disk writes outside the lock, readers only look for files listed in spilled
+        for old_key, old_data in spill:
+            self.spill(old_key, old_data)
+
+    def spill(self, key, data):
+        with open(self.spill_fn(key), 'wb') as f:
+            f.write(data)
+        drop = []
+        with self.lock:
+            self.spilled[key] = len(data)
+            self.spill_bytes += len(data)
+            self.stats['spills'] += 1
+            while self.spill_bytes > self.max_spill_bytes and len(
+                    self.spilled) > 1:
+                old_key, size = self.spilled.popitem(last=False)
+                self.spill_bytes -= size
+                drop.append(old_key)
+        for old_key in drop:
+            try:
+                os.unlink(self.spill_fn(old_key))
+            except OSError:
+                pass
+
+    def clear(self):
+        '''Remove spill files'''
+        with self.lock:
+            for key in self.spilled:
+                try:
+                    os.unlink(self.spill_fn(key))
+                except OSError:
+                    pass
+            self.spilled.clear()
+            self.spill_bytes = 0
+
+
+class LazyPyramid(object):
+    '''
+    A GroupXIV map's tiles, rendering the levels that aren't on disk
+    Levels are tiler levels: 0 is the single tile zoomed out view, max_level the base
+    '''
+
+    def __init__(self, map_dir, cache, reduce='pil', encode_opts=None):
+        self.map_dir = map_dir
+        self.meta = read_meta(map_dir)
+        layer = self.meta['layers'][0]
+        self.tiles_dir = os.path.join(map_dir, layer['URL'] + '-tiles')
+        self.im_ext = layer['tileExt']
+        self.tw = self.th = layer['tileSize']
+        self.max_level = calc_max_level(layer['height'], layer['width'])
+        tile_reduce.check_kernel(reduce)
+        self.reduce = reduce
+        self.encoder = tile_encoder.Encoder(self.im_ext, **(encode_opts or {}))
+        self.cache = cache
+        # level => (rows, cols), same rounding as the tiler
+        self.rcs = {}
+        rows = int(math.ceil(layer['height'] / self.th))
+        cols = int(math.ceil(layer['width'] / self.tw))
+        for level in range(self.max_level, -1, -1):
+            self.rcs[level] = (rows, cols)
+            rows = (rows + 1) // 2
+            cols = (cols + 1) // 2
+        # (level, row, col) => threading.Event of the render in progress
+        self.rendering = {}
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def fn(self, level, row, col):
+        return '%s/%u/%u/%u%s' % (self.tiles_dir, level + 1, col, row,
+                                  self.im_ext)
+
+    def has(self, level, row, col):
+        rows, cols = self.rcs[level]
+        return 0 <= row < rows and 0 <= col < cols
+
+    def get(self, level, row, col):
+        '''Encoded tile bytes, None if there is no such tile'''
+        if level not in self.rcs or not self.has(level, row, col):
+            return None
+        try:
+            with open(self.fn(level, row, col), 'rb') as f:
+                self.stats['disk'] += 1
+                return f.read()
+        except IOError:
+            if level == self.max_level:
+                # Nothing to render the base from
+                return None
+        key = (level, row, col)
+        while True:
+            data = self.cache.get(key)
+            if data is not None:
+                return data
+            with self.lock:
+                event = self.rendering.get(key)
+                if event is None:
+                    event = self.rendering[key] = threading.Event()
+                    break
+            # Someone else is rendering it, take theirs
+            # If it failed or came out empty we render it ourselves
+            self.stats['waits'] += 1
+            event.wait()
+        try:
+            data = self.render(level, row, col)
+            if data is not None:
+                self.cache.put(key, data)
+        finally:
+            with self.lock:
+                del self.rendering[key]
+            event.set()
+        return data
+
+    def render(self, level, row, col):
+        '''Shrink the 2x2 children of a tile, None if none of them exist'''
+        srcs = [[None, None], [None, None]]
+        found = False
+        for r in range(2):
+            for c in range(2):
+                data = self.get(level + 1, 2 * row + r, 2 * col + c)
+                if data is not None:
+                    srcs[r][c] = Image.open(io.BytesIO(data))
+                    found = True
+        if not found:
+            return None
+        im = next(
+            tile_reduce.reduce_quads([srcs], self.reduce, self.tw, self.th))
+        self.stats['rendered'] += 1
+        return self.encoder.encode(im, level)
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            http.server.SimpleHTTPRequestHandler.log_message(
+                self, format, *args)
+
+    def do_GET(self):
+        pyramid = self.server.pyramid
+        m = TILE_RE.match(self.path.split('?')[0])
+        if not m:
+            # index.html and such
+            http.server.SimpleHTTPRequestHandler.do_GET(self)
+            return
+        level = int(m.group(2)) - 1
+        col = int(m.group(3))
+        row = int(m.group(4))
+        if m.group(5) != pyramid.im_ext:
+            self.send_error(404)
+            return
+        data = pyramid.get(level, row, col)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         mimetypes.guess_type('x' + pyramid.im_ext)[0])
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class TileHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def print_stats(pyramid):
+    stats = pyramid.stats + pyramid.cache.stats
+    print('Tiles: %u from disk, %u rendered, %u waited on another request' %
+          (stats['disk'], stats['rendered'], stats['waits']))
+    print('Cache: %u memory hits, %u spill hits, %u misses, %u spilled' %
+          (stats['memory_hits'], stats['spill_hits'], stats['misses'],
+           stats['spills']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='pr0nmap serve',
+        description=
+        'Serve a GroupXIV map, rendering tiles missing above the base level on demand'
+    )
+    parser.add_argument(
+        '--http',
+        default='8000',
+        help='[host:]port to listen on, host defaults to 127.0.0.1')
+    parser.add_argument('--cache-memory',
+                        type=budget.parse_size,
+                        default=budget.parse_size('256M'),
+                        help='Rendered tiles to keep in memory (default 256M)')
+    parser.add_argument(
+        '--spill-dir',
+        default=None,
+        help=
+        'Keep rendered tiles pushed out of memory here instead of dropping them'
+    )
+    parser.add_argument('--spill-max',
+                        type=budget.parse_size,
+                        default=budget.parse_size('1G'),
+                        help='Bytes to keep in --spill-dir (default 1G)')
+    parser.add_argument('--reduce',
+                        choices=tile_reduce.KERNELS,
+                        default='pil',
+                        help='Kernel to shrink 2x2 tiles into their parent')
+    parser.add_argument('--quality',
+                        type=int,
+                        default=None,
+                        help='Rendered tile quality, see main.py --quality')
+    parser.add_argument('--verbose',
+                        action="store_true",
+                        default=False,
+                        help='Log requests')
+    parser.add_argument('map_dir', help='GroupXIV map directory')
+    args = parser.parse_args(argv)
+
+    cache = TileCache(args.cache_memory,
+                      spill_dir=args.spill_dir,
+                      max_spill_bytes=args.spill_max)
+    pyramid = LazyPyramid(args.map_dir,
+                          cache,
+                          reduce=args.reduce,
+                          encode_opts={'quality': args.quality})
+    host, _sep, port = args.http.rpartition(':')
+    server = TileHTTPServer(
+        (host or '127.0.0.1', int(port)),
+        lambda *a, **kw: Handler(*a, directory=args.map_dir, **kw))
+    server.pyramid = pyramid
+    server.verbose = args.verbose
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: sys.exit(0))
+    print('Serving %s on http://%s:%s/, levels 0 to %u' %
+          (args.map_dir, host or '127.0.0.1', port, pyramid.max_level))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        cache.clear()
+        print_stats(pyramid)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())